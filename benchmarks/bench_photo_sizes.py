@@ -0,0 +1,82 @@
+"""
+Замер трафика и времени загрузки фотографий одной анкеты при разных
+правилах выбора размера.
+
+Запускает benchmarks/fake_vk_server.py с ограниченной скоростью отдачи
+фотографий, для каждой анкеты запрашивает photos.get, выбирает топ 3
+фотографии и загружает их через PhotoPipeline, как при показе анкеты.
+Выводит скачанные и загруженные байты и время на одну анкету.
+
+    python -m benchmarks.bench_photo_sizes --profiles 20 --bandwidth 50
+"""
+import argparse
+import time
+
+from benchmarks.fake_vk_server import start_fake_vk
+from bot_runtime.photo_pipeline import Image, PhotoPipeline
+from bot_runtime.vk_clients import create_vk_session
+from finding_users.parse_users_info import top_photos_with_likes
+
+
+def run_policy(vk_session, fake_vk, profiles, target_width, resize_width, quality):
+    pipeline = PhotoPipeline(vk_session, resize_width=resize_width, jpeg_quality=quality)
+    sent, received = fake_vk.sent_bytes, fake_vk.received_bytes
+    timings = []
+    for owner_id in range(1, profiles + 1):
+        started = time.perf_counter()
+        photos = vk_session.method("photos.get", {"owner_id": owner_id, "album_id": "profile", "count": 10})
+        urls = [photo["url"] for photo in top_photos_with_likes(photos["items"], target_width=target_width)]
+        attachments = pipeline.upload_many(urls)
+        timings.append(time.perf_counter() - started)
+        assert len(attachments) == len(urls), "не все фотографии загружены"
+    if pipeline.resize_pool is not None:
+        pipeline.resize_pool.shutdown()
+    timings.sort()
+    return {
+        "download": (fake_vk.sent_bytes - sent) / profiles,
+        "upload": (fake_vk.received_bytes - received) / profiles,
+        "p50": timings[len(timings) // 2],
+        "mean": sum(timings) / len(timings),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", type=int, default=20, help="число анкет на каждое правило")
+    parser.add_argument("--bandwidth", type=float, default=50, help="скорость отдачи фотографий, Мбит/с")
+    parser.add_argument("--target-width", type=int, default=807, help="PHOTO_TARGET_WIDTH")
+    parser.add_argument("--resize-width", type=int, default=604, help="PHOTO_RESIZE_WIDTH")
+    parser.add_argument("--quality", type=int, default=85, help="PHOTO_JPEG_QUALITY")
+    args = parser.parse_args()
+
+    server, fake_vk, api_url = start_fake_vk(bandwidth=args.bandwidth * 125_000)
+    vk_session = create_vk_session("bench-token", api_url)
+    # Тестовый сервер не ограничивает запросы, поэтому паузу vk_api между вызовами убираем
+    vk_session.RPS_DELAY = 0
+
+    policies = [
+        ("Самый большой размер", 0, None),
+        (f"Размер не уже {args.target_width}px", args.target_width, None),
+    ]
+    if Image is not None:
+        policies.append((
+            f"Размер не уже {args.target_width}px, уменьшение до {args.resize_width}px",
+            args.target_width, args.resize_width
+        ))
+    else:
+        print("Pillow не установлен, замер с уменьшением фотографий пропущен")
+
+    # Прогрев: фотографии на сервере генерируются при первом обращении
+    run_policy(vk_session, fake_vk, 1, 0, None, args.quality)
+    run_policy(vk_session, fake_vk, 1, args.target_width, None, args.quality)
+
+    print(f"Анкет: {args.profiles}, скорость отдачи фотографий: {args.bandwidth:g} Мбит/с")
+    for name, target_width, resize_width in policies:
+        result = run_policy(vk_session, fake_vk, args.profiles, target_width, resize_width, args.quality)
+        print(f"{name}: скачано {result['download'] / 1024:.0f} КБ, загружено {result['upload'] / 1024:.0f} КБ, "
+              f"p50 {result['p50'] * 1000:.0f} мс, среднее {result['mean'] * 1000:.0f} мс на анкету")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
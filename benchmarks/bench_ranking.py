@@ -0,0 +1,64 @@
+"""
+Замер скорости ранжирования анкет.
+
+Генерирует пул анкет, похожих на выдачу users.search с фотографиями,
+и выводит время rank_candidates на один пул.
+
+    python -m benchmarks.bench_ranking --candidates 1000 --repeat 200
+"""
+import argparse
+import random
+import time
+
+from finding_users.ranking import rank_candidates
+
+SEARCH_PARAMETERS = {"city": "Москва", "city_id": 1, "gender": "female", "age": 27}
+
+
+def make_candidates(count, seed=1):
+    rng = random.Random(seed)
+    users = []
+    for user_id in range(count):
+        bdate = f"{rng.randint(1, 28)}.{rng.randint(1, 12)}"
+        if rng.random() < 0.7:
+            bdate += f".{rng.randint(1990, 2003)}"
+        user = {
+            "id": user_id,
+            "first_name": "Анна",
+            "last_name": "Иванова",
+            "sex": 1,
+            "bdate": bdate,
+            "photo_max": "https://vk.com/images/camera_200.png" if rng.random() < 0.1 else "https://sun.userapi.com/x",
+            "top_photos": ["https://sun.userapi.com/p"] * rng.randint(0, 3),
+            "photo_likes": int(rng.paretovariate(1.2) * 10),
+        }
+        if rng.random() < 0.8:
+            user["city"] = rng.choice([{"id": 1, "title": "Москва"}, {"id": 2, "title": "Санкт-Петербург"}])
+        users.append(user)
+    return users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--candidates", type=int, default=1000, help="размер пула анкет")
+    parser.add_argument("--repeat", type=int, default=200, help="число повторов")
+    args = parser.parse_args()
+
+    users = make_candidates(args.candidates)
+    rank_candidates(users, SEARCH_PARAMETERS)
+
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        ranked = rank_candidates(users, SEARCH_PARAMETERS)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    print(f"Анкет: {args.candidates}, повторов: {args.repeat}")
+    print(f"Ранжирование: p50 {timings[len(timings) // 2] * 1000:.2f} мс, "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1000:.2f} мс")
+    best = ranked[0]
+    print(f"Лучшая анкета: id {best['id']}, bdate {best['bdate']}, лайков {best['photo_likes']}")
+
+
+if __name__ == "__main__":
+    main()
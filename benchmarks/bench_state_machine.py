@@ -0,0 +1,63 @@
+"""
+Замер пропускной способности автомата диалога.
+
+Воспроизводит записанный поток событий (recorded_events.jsonl) через
+StateMachine с пустыми обработчиками и выводит число сообщений в секунду.
+
+    python -m benchmarks.bench_state_machine --repeat 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from bot_runtime.conversation import TRANSITIONS, build_state_machine
+from bot_runtime.sessions import Session
+
+EVENTS_PATH = os.path.join(os.path.dirname(__file__), "recorded_events.jsonl")
+
+
+def load_events(path=EVENTS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [(event["user_id"], event["text"]) for event in map(json.loads, f)]
+
+
+async def noop(session, msg):
+    return None
+
+
+async def replay(events, repeat):
+    machine = build_state_machine({name: noop for _, _, name, _ in TRANSITIONS})
+    sessions = {}
+    unmatched = 0
+
+    started = time.perf_counter()
+    for round_number in range(repeat):
+        offset = round_number * 10000
+        for user_id, text in events:
+            user_id += offset
+            session = sessions.get(user_id)
+            if session is None:
+                session = sessions[user_id] = Session(user_id)
+            if not await machine.dispatch(session, text):
+                unmatched += 1
+    elapsed = time.perf_counter() - started
+    return elapsed, unmatched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=1000, help="сколько раз воспроизвести поток событий")
+    parser.add_argument("--events", default=EVENTS_PATH, help="файл с записанными событиями (JSON Lines)")
+    args = parser.parse_args()
+
+    events = load_events(args.events)
+    elapsed, unmatched = asyncio.run(replay(events, args.repeat))
+    total = len(events) * args.repeat
+    print(f"Сообщений: {total}, без перехода: {unmatched}")
+    print(f"Время: {elapsed:.3f} с, {total / elapsed:,.0f} сообщений/с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Замер пропускной способности поиска в зависимости от числа токенов пользователя.
+
+Запускает benchmarks/fake_vk_server.py с лимитом запросов в секунду на токен
+и в нескольких потоках выполняет те же вызовы, что и поиск бота
+(users.search и photos.get через execute), через VkClientPool с 1, 2, 4...
+токенами. С --revoked часть токенов отозвана: пул должен отправить их
+на карантин и продолжить работу на остальных.
+
+    python -m benchmarks.bench_token_pool --tokens 1 2 4 --threads 16 --duration 10
+"""
+import argparse
+import threading
+import time
+
+from vk_api.exceptions import ApiError
+from vk_api.requests_pool import vk_request_one_param_pool
+
+from benchmarks.fake_vk_server import start_fake_vk
+from bot_runtime.vk_clients import VkClientPool
+
+
+def search_page(pool, offset):
+    response = pool.method("users.search", {"sex": 1, "age_from": 25, "age_to": 25, "offset": offset, "count": 10})
+    owner_ids = [user["id"] for user in response["items"]]
+    vk_request_one_param_pool(
+        pool.get_api(), "photos.get", key="owner_id", values=owner_ids,
+        default_values={"album_id": "profile", "extended": 1, "count": 10}
+    )
+
+
+def run(pool, threads, duration):
+    deadline = time.monotonic() + duration
+    pages = [0] * threads
+    errors = [0] * threads
+
+    def worker(number):
+        while time.monotonic() < deadline:
+            try:
+                search_page(pool, (pages[number] * 10) % 500)
+                pages[number] += 1
+            except ApiError:
+                errors[number] += 1
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    started = time.monotonic()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(pages) / (time.monotonic() - started), sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1, 2, 4], help="размеры пула токенов")
+    parser.add_argument("--threads", type=int, default=16, help="число одновременных поисков")
+    parser.add_argument("--duration", type=float, default=10, help="длительность замера, с")
+    parser.add_argument("--rps", type=int, default=3, help="лимит тестового VK API на токен")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка тестового VK API, с")
+    parser.add_argument("--revoked", type=int, default=0, help="сколько токенов пула отозвано")
+    args = parser.parse_args()
+
+    server, fake_vk, api_url = start_fake_vk(latency=args.latency, rps=args.rps)
+    print(f"Лимит: {args.rps} запроса/с на токен, задержка {args.latency * 1000:.0f} мс, потоков: {args.threads}")
+    baseline = None
+    for count in args.tokens:
+        tokens = [f"bench-token-{count}-{index}" for index in range(count)]
+        fake_vk.revoked = set(tokens[:args.revoked])
+        pool = VkClientPool(tokens, api_url)
+        pages_per_second, errors = run(pool, args.threads, args.duration)
+        if baseline is None and pages_per_second:
+            baseline = pages_per_second / count
+        print(f"Токенов: {count} (отозвано {len(fake_vk.revoked)}): {pages_per_second:.1f} страниц поиска/с, "
+              f"{pages_per_second / (baseline or 1):.1f}x от одного токена, ошибок {errors}, "
+              f"доступно токенов {pool.available()}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
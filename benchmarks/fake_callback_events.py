@@ -0,0 +1,100 @@
+"""
+Генератор событий Callback API для проверки бота без VK.
+
+Отправляет запрос подтверждения, а затем записанный поток сообщений
+(recorded_events.jsonl) в виде событий message_new на адрес сервера бота.
+Выводит число подтвержденных событий в секунду и задержку ответа.
+
+    python -m benchmarks.fake_callback_events --url http://127.0.0.1:8080/ --secret s3cr3t --repeat 100
+"""
+import argparse
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from benchmarks.bench_state_machine import EVENTS_PATH, load_events
+
+
+def message_new(group_id, secret, user_id, text):
+    event = {
+        "type": "message_new",
+        "event_id": uuid.uuid4().hex,
+        "v": "5.199",
+        "group_id": group_id,
+        "object": {
+            "message": {
+                "date": int(time.time()),
+                "from_id": user_id,
+                "peer_id": user_id,
+                "id": 0,
+                "out": 0,
+                "text": text,
+            },
+            "client_info": {},
+        },
+    }
+    if secret:
+        event["secret"] = secret
+    return event
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://127.0.0.1:8080/", help="адрес Callback API сервера бота")
+    parser.add_argument("--secret", default="", help="секретный ключ (CALLBACK_SECRET)")
+    parser.add_argument("--group-id", type=int, default=1, help="id сообщества (GROUP_ID)")
+    parser.add_argument("--repeat", type=int, default=10, help="сколько раз воспроизвести поток событий")
+    parser.add_argument("--concurrency", type=int, default=16, help="число одновременных запросов")
+    parser.add_argument("--events", default=EVENTS_PATH, help="файл с записанными событиями (JSON Lines)")
+    args = parser.parse_args()
+
+    http = requests.Session()
+    http.mount("http://", HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency))
+
+    confirmation = {"type": "confirmation", "group_id": args.group_id}
+    if args.secret:
+        confirmation["secret"] = args.secret
+    response = http.post(args.url, json=confirmation, timeout=5)
+    print(f"Подтверждение: {response.status_code} {response.text!r}")
+
+    events = load_events(args.events)
+    # Каждый повтор - новые пользователи, порядок сообщений одного пользователя сохраняется
+    streams = [
+        [message_new(args.group_id, args.secret, user_id + round_number * 10000, text)
+         for user_id, text in events]
+        for round_number in range(args.repeat)
+    ]
+
+    def send_stream(stream):
+        latencies, failed = [], 0
+        for event in stream:
+            started = time.perf_counter()
+            response = http.post(args.url, data=json.dumps(event, ensure_ascii=False).encode(), timeout=5)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200 or response.text != "ok":
+                failed += 1
+        return latencies, failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send_stream, streams))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for stream_latencies, _ in results for latency in stream_latencies]
+    failed = sum(stream_failed for _, stream_failed in results)
+    print(f"Событий: {len(latencies)}, ошибок: {failed}, {len(latencies) / elapsed:,.0f} событий/с")
+    print(f"Задержка ответа: p50 {percentile(latencies, 0.5) * 1000:.1f} мс, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+Локальный заменитель VK API для нагрузочного тестирования бота.
+
+Поддерживает методы, которые вызывает бот (users.search, photos.get,
+messages.send, execute, загрузку фотографий, database.getCities),
+с настраиваемой задержкой ответа, ограничением запросов в секунду на токен
+и пропускной способностью при отдаче фотографий.
+
+    python -m benchmarks.fake_vk_server --port 8081 --latency 0.05 --rps 20
+
+После запуска укажите боту VK_API_URL=http://127.0.0.1:8081/method/
+"""
+import argparse
+import io
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CITIES = [
+    {"id": 1, "title": "Москва"},
+    {"id": 2, "title": "Санкт-Петербург"},
+    {"id": 60, "title": "Казань"},
+    {"id": 49, "title": "Екатеринбург"},
+    {"id": 99, "title": "Новосибирск"},
+    {"id": 95, "title": "Нижний Новгород"},
+]
+FIRST_NAMES = ["Анна", "Мария", "Елена", "Иван", "Петр", "Алексей"]
+LAST_NAMES = ["Иванова", "Петрова", "Смирнова", "Иванов", "Петров", "Смирнов"]
+# Сколько анкет находит поиск по любым параметрам
+SEARCH_TOTAL = 500
+# Тело "фотографии", которую отдает сервер
+PHOTO_BYTES = b"\xff\xd8\xff\xe0" + bytes(20 * 1024)
+# Размеры фотографий, которые отдает photos.get (портретная фотография 3:4),
+# и типичный объем JPEG каждого размера, если Pillow не установлен
+PHOTO_SIZES = {"s": 75, "m": 130, "x": 604, "y": 807, "z": 1080, "w": 2560}
+PHOTO_SIZE_BYTES = {"s": 4_000, "m": 9_000, "x": 60_000, "y": 105_000, "z": 190_000, "w": 1_600_000}
+PHOTO_URL = re.compile(r"^/photo/\d+/\d+_(?P<type>\w)\.jpg$")
+
+# Вызовы execute, которые формирует vk_api: список вызовов, один метод с разными
+# параметрами (VkRequestsPool) и один метод с одним меняющимся параметром
+EXECUTE_CALL = re.compile(r"API\.([\w.]+)\(")
+ONE_METHOD_CODE = re.compile(r"^var values = (?P<values>.*),i = 0,result = \[\];"
+                             r".*result\.push\(API\.(?P<method>[\w.]+)\(values\[i\]\)\);")
+ONE_PARAM_CODE = re.compile(r"^var def_values = (?P<rest>.*)def_values\.(?P<key>\w+) = values\[i\];"
+                            r"result\.push\(API\.(?P<method>[\w.]+)\(def_values\)\);")
+
+
+class TooManyRequests(Exception):
+    pass
+
+
+class FakeVk:
+    """
+    Состояние тестового сервера: обработчики методов, лимиты и журнал сообщений.
+    """
+
+    def __init__(self, base_url, latency=0.0, rps=0, bandwidth=0):
+        self.base_url = base_url.rstrip("/")
+        self.latency = latency
+        self.rps = rps
+        # Скорость отдачи фотографий одному соединению, байт/с (0 - без ограничения)
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.photos = {}
+        # Отозванные токены: вызовы с ними получают ошибку авторизации
+        self.revoked = set()
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.windows = defaultdict(list)
+        self.calls = defaultdict(int)
+        self.message_id = 0
+        self.photo_id = 0
+        # Вызывается для каждого messages.send: listener(user_id, params)
+        self.listener = None
+
+    def _check_rate(self, token):
+        if not self.rps:
+            return
+        now = time.monotonic()
+        with self.lock:
+            window = [moment for moment in self.windows[token] if now - moment < 1]
+            if len(window) >= self.rps:
+                self.windows[token] = window
+                raise TooManyRequests()
+            window.append(now)
+            self.windows[token] = window
+
+    def photo(self, size_type):
+        """
+        Тело фотографии размера size_type: настоящий JPEG, если установлен Pillow,
+        иначе заглушка типичного объема.
+        """
+        with self.lock:
+            body = self.photos.get(size_type)
+        if body is not None:
+            return body
+        try:
+            from PIL import Image
+        except ImportError:
+            body = b"\xff\xd8\xff\xe0" + bytes(PHOTO_SIZE_BYTES[size_type] - 4)
+        else:
+            # Шум с плавным градиентом сжимается примерно как фотография
+            width = PHOTO_SIZES[size_type]
+            height = width * 4 // 3
+            rng = random.Random(width)
+            noise = Image.frombytes("L", (width, height), rng.randbytes(width * height)).convert("RGB")
+            gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+            output = io.BytesIO()
+            Image.blend(gradient, noise, 0.15).save(output, "JPEG", quality=90)
+            body = output.getvalue()
+        with self.lock:
+            return self.photos.setdefault(size_type, body)
+
+    def call(self, method, values):
+        """
+        Вызов метода API. Возвращает тело ответа в формате VK.
+        """
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if values.get("access_token") in self.revoked:
+            return {"error": {"error_code": 5, "error_msg": "User authorization failed: invalid access_token"}}
+        try:
+            self._check_rate(values.get("access_token", ""))
+        except TooManyRequests:
+            return {"error": {"error_code": 6, "error_msg": "Too many requests per second"}}
+        with self.lock:
+            self.calls[method] += 1
+
+        if method == "execute":
+            return self.execute(values["code"])
+        handler = getattr(self, "m_" + method.replace(".", "_"), None)
+        if handler is None:
+            return {"error": {"error_code": 3, "error_msg": f"Unknown method passed: {method}"}}
+        return {"response": handler(values)}
+
+    def execute(self, code):
+        decoder = json.JSONDecoder()
+        one_method = ONE_METHOD_CODE.search(code)
+        one_param = ONE_PARAM_CODE.search(code)
+        if one_method:
+            values, _ = decoder.raw_decode(one_method.group("values"))
+            calls = [(one_method.group("method"), params) for params in values]
+        elif one_param:
+            default_values, end = decoder.raw_decode(one_param.group("rest"))
+            values, _ = decoder.raw_decode(one_param.group("rest")[end:].split("=", 1)[1].strip())
+            key = one_param.group("key")
+            calls = [(one_param.group("method"), dict(default_values, **{key: value})) for value in values]
+        else:
+            calls = []
+            for call in EXECUTE_CALL.finditer(code):
+                params, _ = decoder.raw_decode(code[call.end():])
+                calls.append((call.group(1), params))
+
+        response, errors = [], []
+        for method, params in calls:
+            handler = getattr(self, "m_" + method.replace(".", "_"), None)
+            if handler is None:
+                response.append(False)
+                errors.append({"method": method, "error_code": 3, "error_msg": "Unknown method passed"})
+            else:
+                response.append(handler({key: str(value) for key, value in params.items()}))
+        result = {"response": response}
+        if errors:
+            result["execute_errors"] = errors
+        return result
+
+    def m_users_search(self, values):
+        offset, count = int(values.get("offset", 0)), int(values.get("count", 20))
+        sex = int(values.get("sex", 1)) or 1
+        query = f'{values.get("city") or values.get("hometown")}|{sex}|{values.get("age_from")}'
+        seed = zlib.crc32(query.encode())
+        items = []
+        for index in range(offset, min(offset + count, SEARCH_TOTAL)):
+            user_id = (seed + index) % 10 ** 8 + 1
+            items.append({
+                "id": user_id,
+                "first_name": FIRST_NAMES[user_id % 3 + (0 if sex == 1 else 3)],
+                "last_name": LAST_NAMES[user_id % 3 + (0 if sex == 1 else 3)],
+                "sex": sex,
+                "bdate": "1.1.1999",
+                "city": {"id": int(values.get("city") or 1), "title": "Москва"},
+                "photo_max": f"{self.base_url}/photo/{user_id}/0.jpg",
+            })
+        return {"count": SEARCH_TOTAL, "items": items}
+
+    def m_photos_get(self, values):
+        owner_id = int(values.get("owner_id", 0))
+        items = []
+        for index in range(int(values.get("count", 10)) // 2):
+            url = f"{self.base_url}/photo/{owner_id}/{index}"
+            items.append({
+                "id": index + 1,
+                "owner_id": owner_id,
+                "likes": {"count": (owner_id * 7 + index * 13) % 100},
+                "sizes": [
+                    {"type": size_type, "width": width, "height": width * 4 // 3, "url": f"{url}_{size_type}.jpg"}
+                    for size_type, width in PHOTO_SIZES.items()
+                ],
+            })
+        return {"count": len(items), "items": items}
+
+    def m_messages_send(self, values):
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        if self.listener is not None:
+            self.listener(int(values.get("user_id", 0)), values)
+        return message_id
+
+    def m_photos_getMessagesUploadServer(self, values):
+        return {"upload_url": f"{self.base_url}/upload", "album_id": -3, "group_id": 1}
+
+    def m_photos_saveMessagesPhoto(self, values):
+        with self.lock:
+            self.photo_id += 1
+            photo_id = self.photo_id
+        return [{"id": photo_id, "owner_id": -1, "access_key": "fake"}]
+
+    def m_photos_getById(self, values):
+        return [{"id": 1, "owner_id": -1}]
+
+    def m_database_getCities(self, values):
+        query = values.get("q", "").lower()
+        items = [city for city in CITIES if city["title"].lower().startswith(query)]
+        return {"count": len(items), "items": items}
+
+
+class FakeVkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_photo(self, body):
+        fake_vk = self.server.fake_vk
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        chunk_size = 64 * 1024
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self.wfile.write(chunk)
+            if fake_vk.bandwidth:
+                time.sleep(len(chunk) / fake_vk.bandwidth)
+        with fake_vk.lock:
+            fake_vk.sent_bytes += len(body)
+
+    def do_GET(self):
+        if not self.path.startswith("/photo/"):
+            self.send_error(404)
+            return
+        match = PHOTO_URL.match(self.path)
+        self._reply_photo(self.server.fake_vk.photo(match["type"]) if match else PHOTO_BYTES)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urlparse(self.path).path
+        if path == "/upload":
+            with self.server.fake_vk.lock:
+                self.server.fake_vk.received_bytes += len(body)
+            self._reply(json.dumps({"server": 1, "photo": "[{}]", "hash": "fake"}).encode())
+            return
+        if not path.startswith("/method/"):
+            self.send_error(404)
+            return
+        values = {key: items[-1] for key, items in parse_qs(body.decode()).items()}
+        response = self.server.fake_vk.call(path[len("/method/"):], values)
+        self._reply(json.dumps(response, ensure_ascii=False).encode())
+
+
+class FakeVkServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def start_fake_vk(host="127.0.0.1", port=0, latency=0.0, rps=0, bandwidth=0):
+    """
+    Запуск сервера в фоновом потоке. Возвращает (server, fake_vk, api_url).
+    """
+    server = FakeVkServer((host, port), FakeVkHandler)
+    base_url = f"http://{host}:{server.server_address[1]}"
+    server.fake_vk = FakeVk(base_url, latency, rps, bandwidth)
+    threading.Thread(target=server.serve_forever, name="fake-vk", daemon=True).start()
+    return server, server.fake_vk, base_url + "/method/"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="средняя задержка ответа, с")
+    parser.add_argument("--rps", type=int, default=0, help="лимит запросов в секунду на токен (0 - без лимита)")
+    parser.add_argument("--bandwidth", type=float, default=0,
+                        help="скорость отдачи фотографий, Мбит/с на соединение (0 - без ограничения)")
+    args = parser.parse_args()
+
+    server, _, api_url = start_fake_vk(args.host, args.port, args.latency, args.rps, args.bandwidth * 125_000)
+    print(f"VK_API_URL={api_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
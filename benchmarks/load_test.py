@@ -0,0 +1,195 @@
+"""
+Нагрузочный тест бота без обращения к VK.
+
+Запускает тестовый сервер VK API (fake_vk_server), бота в режиме Callback API,
+направленного на этот сервер, и множество одновременных диалогов по сценарию
+из recorded_events.jsonl. Выводит число обработанных сообщений в секунду
+и задержку ответа бота (p50/p99) от отправки события до первого messages.send.
+
+    python -m benchmarks.load_test --users 1000 --latency 0.05
+
+Бот использует базу данных из .env (избранное, кэш вложений).
+Если бот уже запущен с VK_API_URL на тестовый сервер, укажите --bot-url.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from urllib.parse import urlparse
+
+from benchmarks.bench_state_machine import EVENTS_PATH, load_events
+from benchmarks.fake_vk_server import start_fake_vk
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "load-test"
+GROUP_ID = 1
+
+
+async def post_event(host, port, event):
+    """
+    Отправка события боту. Возвращает текст ответа.
+    """
+    body = json.dumps(event, ensure_ascii=False).encode()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+            f"POST / HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    return response.split(b"\r\n\r\n", 1)[-1].decode()
+
+
+def message_new(user_id, text):
+    return {
+        "type": "message_new",
+        "event_id": uuid.uuid4().hex,
+        "group_id": GROUP_ID,
+        "secret": SECRET,
+        "object": {"message": {"from_id": user_id, "peer_id": user_id, "out": 0, "text": text}},
+    }
+
+
+class LoadTest:
+    def __init__(self, bot_url, script, think_time, timeout):
+        address = urlparse(bot_url)
+        self.host, self.port = address.hostname, address.port or 80
+        self.script = script
+        self.think_time = think_time
+        self.timeout = timeout
+        self.replies = {}
+        self.latencies = []
+        self.sent = 0
+        self.timeouts = 0
+        self.loop = None
+
+    def on_message(self, user_id, params):
+        # Вызывается из потока тестового сервера VK
+        queue = self.replies.get(user_id)
+        # Бот может досылать ответы после окончания теста
+        if queue is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(queue.put_nowait, time.perf_counter())
+
+    async def conversation(self, user_id):
+        queue = self.replies[user_id] = asyncio.Queue()
+        for text in self.script:
+            while not queue.empty():
+                queue.get_nowait()
+            started = time.perf_counter()
+            await post_event(self.host, self.port, message_new(user_id, text))
+            self.sent += 1
+            try:
+                replied = await asyncio.wait_for(queue.get(), self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                continue
+            self.latencies.append(replied - started)
+            # Пауза пользователя; заодно успевают прийти остальные сообщения ответа
+            await asyncio.sleep(self.think_time)
+
+    async def run(self, users, ramp_up):
+        self.loop = asyncio.get_running_loop()
+        tasks = []
+        for number in range(users):
+            tasks.append(asyncio.create_task(self.conversation(10 ** 6 + number)))
+            if ramp_up:
+                await asyncio.sleep(ramp_up / users)
+        await asyncio.gather(*tasks)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def start_bot(api_url, port, city_index_path, log_file, workers=1):
+    env = dict(
+        os.environ,
+        VK_API_URL=api_url,
+        TOKEN_VK="fake-group-token",
+        USER_TOKEN="fake-user-token",
+        BOT_MODE="callback",
+        CALLBACK_HOST="127.0.0.1",
+        CALLBACK_PORT=str(port),
+        CALLBACK_SECRET=SECRET,
+        CALLBACK_CONFIRMATION="fake",
+        GROUP_ID=str(GROUP_ID),
+        SESSION_BACKEND="memory",
+        CITY_INDEX_PATH=city_index_path,
+        WORKERS=str(workers),
+    )
+    return subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "main.py")], cwd=ROOT, env=env, stdout=log_file, stderr=log_file
+    )
+
+
+async def wait_for_bot(host, port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"Бот не запустился на {host}:{port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="число одновременных диалогов")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="время подключения всех пользователей, с")
+    parser.add_argument("--think-time", type=float, default=0.5, help="пауза пользователя между сообщениями, с")
+    parser.add_argument("--timeout", type=float, default=30.0, help="сколько ждать ответа бота, с")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка тестового VK API, с")
+    parser.add_argument("--rps", type=int, default=0, help="лимит тестового VK API на токен (0 - без лимита)")
+    parser.add_argument("--bot-port", type=int, default=8090, help="порт Callback API запускаемого бота")
+    parser.add_argument("--bot-url", default=None, help="адрес уже запущенного бота")
+    parser.add_argument("--vk-port", type=int, default=0, help="порт тестового VK API")
+    parser.add_argument("--workers", type=int, default=1, help="число процессов-обработчиков бота (WORKERS)")
+    parser.add_argument("--bot-log", default=os.devnull, help="файл для журнала запускаемого бота")
+    parser.add_argument("--events", default=EVENTS_PATH, help="файл с записанными событиями (JSON Lines)")
+    args = parser.parse_args()
+
+    events = load_events(args.events)
+    first_user = events[0][0]
+    script = [text for user_id, text in events if user_id == first_user]
+
+    server, fake_vk, api_url = start_fake_vk(port=args.vk_port, latency=args.latency, rps=args.rps)
+    print(f"Тестовый VK API: {api_url}")
+
+    bot = None
+    bot_url = args.bot_url or f"http://127.0.0.1:{args.bot_port}/"
+    test = LoadTest(bot_url, script, args.think_time, args.timeout)
+    fake_vk.listener = test.on_message
+    with tempfile.TemporaryDirectory() as tmp, open(args.bot_log, "w") as bot_log:
+        if args.bot_url is None:
+            bot = start_bot(api_url, args.bot_port, os.path.join(tmp, "cities.json"), bot_log, args.workers)
+        try:
+            asyncio.run(wait_for_bot(test.host, test.port))
+            started = time.perf_counter()
+            asyncio.run(test.run(args.users, args.ramp_up))
+            elapsed = time.perf_counter() - started
+        finally:
+            if bot is not None:
+                bot.terminate()
+                bot.wait()
+            server.shutdown()
+
+    print(f"Пользователей: {args.users}, сообщений: {test.sent}, без ответа: {test.timeouts}")
+    print(f"Время: {elapsed:.1f} с, {test.sent / elapsed:,.0f} сообщений/с")
+    print(f"Задержка ответа: p50 {percentile(test.latencies, 0.5) * 1000:.0f} мс, "
+          f"p99 {percentile(test.latencies, 0.99) * 1000:.0f} мс")
+    print("Вызовы VK API: " + ", ".join(f"{method} {count}" for method, count in sorted(fake_vk.calls.items())))
+
+
+if __name__ == "__main__":
+    main()
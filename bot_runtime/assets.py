@@ -0,0 +1,92 @@
+import hashlib
+import logging
+
+from vk_api.exceptions import ApiError
+from vk_api.upload import VkUpload
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Метод недоступен с ключом сообщества: проверить вложение нельзя
+GROUP_AUTH_UNAVAILABLE = 27
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AssetRegistry:
+    """
+    Статические картинки бота (приветственный баннер и т.п.).
+
+    Каждая картинка загружается в VK один раз при запуске. Вложение
+    сохраняется в кэше вложений по хэшу содержимого файла, поэтому
+    после перезапуска повторная загрузка не нужна, пока файл не изменился.
+    """
+
+    def __init__(self, vk_session, cache=None):
+        self.vk_session = vk_session
+        self.cache = cache
+        self.paths = {}
+        self.attachments = {}
+
+    def register(self, name, path):
+        self.paths[name] = path
+
+    def _cache_key(self, path):
+        return f"asset://{file_hash(path)}"
+
+    def _is_valid(self, attachment):
+        owner_and_id = attachment[len("photo"):]
+        try:
+            return bool(self.vk_session.method("photos.getById", {"photos": owner_and_id}))
+        except ApiError as e:
+            if e.code == GROUP_AUTH_UNAVAILABLE:
+                return True
+            logging.warning("Вложение %s недоступно: %s", attachment, e)
+            return False
+
+    def _upload(self, path):
+        photo = VkUpload(self.vk_session).photo_messages(path)[0]
+        return f"photo{photo['owner_id']}_{photo['id']}"
+
+    def load(self, name):
+        """
+        Получение вложения для картинки: из кэша, если оно еще действительно, иначе загрузка.
+        """
+        path = self.paths[name]
+        key = self._cache_key(path)
+        attachment = self.cache.get(key) if self.cache is not None else None
+        if attachment is not None and not self._is_valid(attachment):
+            self.cache.invalidate(key)
+            attachment = None
+        if attachment is None:
+            try:
+                attachment = self._upload(path)
+            except Exception as e:
+                logging.error("Ошибка при загрузке изображения %s: %s", path, e)
+                return None
+            if self.cache is not None:
+                self.cache.put(key, attachment)
+            logging.info("Загружено изображение %s: %s", path, attachment)
+        self.attachments[name] = attachment
+        return attachment
+
+    def load_all(self):
+        for name in self.paths:
+            self.load(name)
+
+    def reload(self, name):
+        """
+        Повторная загрузка картинки, если отправка с сохраненным вложением не удалась.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(self._cache_key(self.paths[name]))
+        self.attachments.pop(name, None)
+        return self.load(name)
+
+    def get(self, name):
+        return self.attachments.get(name)
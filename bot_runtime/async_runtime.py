@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from vk_api.exceptions import ApiError
+from vk_api.longpoll import VkEventType
+from vk_api.vk_api import VkApiMethod
+
+from bot_runtime.metrics import VK_CALL_SECONDS, VK_ERRORS
+from bot_runtime.vk_clients import VK_API_URL
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты запросов (token bucket) для асинхронного кода.
+
+    После ошибки VK "слишком много запросов" throttle приостанавливает запросы
+    и вдвое снижает частоту; затем частота за recovery секунд линейно
+    возвращается к исходной.
+    """
+
+    def __init__(self, rate, burst=None, recovery=10.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(1, rate)
+        self.recovery = recovery
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                elapsed = now - self.updated
+                self.rate = min(self.max_rate, self.rate + elapsed * self.max_rate / self.recovery)
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self, delay):
+        """
+        Пауза delay секунд для всех запросов и снижение частоты вдвое.
+        """
+        now = time.monotonic()
+        # Ошибки запросов, отправленных до паузы, не снижают частоту повторно
+        if now >= self.paused_until:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self.paused_until = max(self.paused_until, now + delay)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+
+class AsyncVkApi:
+    """
+    Асинхронный клиент VK API.
+
+    В отличие от VkApi.method, запросы не сериализуются блокировкой:
+    они выполняются в пуле потоков через общий пул keep-alive соединений,
+    а частота ограничивается RateLimiter (20 запросов в секунду для токена сообщества).
+    Блокирующие задачи (поиск, загрузка фото, база данных) выполняются в отдельном
+    пуле потоков, чтобы медленная задача не задерживала вызовы API, например messages.send.
+    """
+
+    def __init__(self, vk_session, rps=20, max_workers=32, timeout=10, api_url=None, blocking_workers=32):
+        self.vk_session = vk_session
+        self.api_url = api_url or VK_API_URL
+        self.timeout = timeout
+        self.limiter = RateLimiter(rps)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vk")
+        self.blocking_executor = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix="vk-blocking")
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+
+    def _call(self, method, values, raw=False):
+        values = dict(values or {})
+        values.setdefault("v", self.vk_session.api_version)
+        values["access_token"] = self.vk_session.token["access_token"]
+
+        with VK_CALL_SECONDS.time(method=method):
+            try:
+                response = self.http.post(self.api_url + method, values, timeout=self.timeout)
+                response.raise_for_status()
+                payload = response.json()
+            except Exception:
+                VK_ERRORS.inc(method=method, code="network")
+                raise
+        if "error" in payload:
+            VK_ERRORS.inc(method=method, code=payload["error"].get("error_code"))
+            raise ApiError(self.vk_session, method, values, raw, payload["error"])
+        for error in payload.get("execute_errors", ()):
+            VK_ERRORS.inc(method=error.get("method", method), code=error.get("error_code"))
+        return payload if raw else payload["response"]
+
+    async def method(self, method, values=None, raw=False):
+        """
+        Вызов метода API без блокировки цикла событий.
+        При raw=True возвращается ответ целиком (нужно для execute_errors).
+        """
+        await self.limiter.acquire()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._call, method, values, raw)
+
+    def blocking(self):
+        """
+        Синхронный клиент для кода в пуле потоков (загрузка фото) с тем же ограничением частоты.
+        Создается из цикла событий.
+        """
+        return BlockingVkApi(self, asyncio.get_running_loop())
+
+    async def run(self, func, *args):
+        """
+        Выполнение блокирующей функции (поиск, загрузка фото) в отдельном пуле потоков.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.blocking_executor, func, *args)
+
+
+class BlockingVkApi:
+    """
+    Синхронный клиент поверх AsyncVkApi для вызовов из пула потоков.
+
+    VkApi.method держит блокировку на все время запроса и выдерживает паузу
+    между запросами, поэтому вызовы через сессию сообщества выполняются по одному.
+    Здесь каждый вызов ждет только общий RateLimiter в цикле событий,
+    а сам запрос выполняется в потоке вызывающего. Поддерживает method и get_api,
+    как VkApi. Нельзя вызывать из потока цикла событий.
+    """
+
+    def __init__(self, vk, loop):
+        self.vk = vk
+        self.loop = loop
+
+    def method(self, method, values=None, captcha_sid=None, captcha_key=None, raw=False):
+        asyncio.run_coroutine_threadsafe(self.vk.limiter.acquire(), self.loop).result()
+        return self.vk._call(method, values, raw)
+
+    def get_api(self):
+        return VkApiMethod(self)
+
+
+class UserDispatcher:
+    """
+    Распределение входящих сообщений по пользователям.
+
+    Для каждого пользователя заводится своя очередь и свой обработчик,
+    поэтому сообщения одного пользователя обрабатываются строго по порядку,
+    а разные пользователи не ждут друг друга. Общее число одновременно
+    работающих обработчиков ограничено max_workers.
+    """
+
+    def __init__(self, handler, max_workers=100, idle_timeout=60):
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.queues = {}
+        self.workers = {}
+
+    def submit(self, user_id, text):
+        queue = self.queues.get(user_id)
+        if queue is None:
+            queue = self.queues[user_id] = asyncio.Queue()
+        queue.put_nowait(text)
+        if user_id not in self.workers:
+            self.workers[user_id] = asyncio.create_task(self._worker(user_id, queue))
+
+    async def _worker(self, user_id, queue):
+        try:
+            while True:
+                try:
+                    text = await asyncio.wait_for(queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        return
+                    continue
+                async with self.semaphore:
+                    try:
+                        await self.handler(user_id, text)
+                    except Exception:
+                        logging.exception("Ошибка при обработке сообщения пользователя %s", user_id)
+                    finally:
+                        queue.task_done()
+        finally:
+            self.workers.pop(user_id, None)
+            self.queues.pop(user_id, None)
+
+    async def join(self):
+        for queue in list(self.queues.values()):
+            await queue.join()
+
+
+async def listen_longpoll(longpoll, dispatcher, executor=None):
+    """
+    Чтение событий Long Poll в отдельном потоке и передача их диспетчеру.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        events = await loop.run_in_executor(executor, longpoll.check)
+        for event in events:
+            if event.type == VkEventType.MESSAGE_NEW and event.to_me:
+                dispatcher.submit(event.user_id, event.text)
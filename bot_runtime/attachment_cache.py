@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from bot_runtime.metrics import cache_hit
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def url_hash(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+class AttachmentCache:
+    """
+    Кэш загруженных в VK фотографий: URL -> строка вложения photo{owner_id}_{id}.
+
+    Перед таблицей photo_attachments в PostgreSQL стоит LRU в памяти процесса.
+    Записи старше ttl считаются устаревшими и загружаются заново.
+    """
+
+    def __init__(self, max_size=5000, ttl=7 * 24 * 3600, persistent=True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if persistent:
+            # Импорт здесь, чтобы кэш в памяти не требовал базы данных
+            from vkinder_db import vkinder_db
+            self.db = vkinder_db
+
+    def _remember(self, key, attachment, created_at):
+        with self.lock:
+            self.entries[key] = (attachment, created_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get(self, url):
+        key = url_hash(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                attachment, created_at = entry
+                if time.time() - created_at <= self.ttl:
+                    self.entries.move_to_end(key)
+                    cache_hit("attachments", True)
+                    return attachment
+                del self.entries[key]
+
+        cache_hit("attachments", False)
+        if self.db is None:
+            return None
+        try:
+            attachment = self.db.select_photo_attachment(key, self.ttl)
+        except Exception as e:
+            logging.error("Ошибка при чтении кэша вложений: %s", e)
+            return None
+        if attachment is not None:
+            self._remember(key, attachment, time.time())
+        cache_hit("attachments_db", attachment is not None)
+        return attachment
+
+    def put(self, url, attachment):
+        key = url_hash(url)
+        self._remember(key, attachment, time.time())
+        if self.db is not None:
+            try:
+                self.db.upsert_photo_attachment(key, url, attachment)
+            except Exception as e:
+                logging.error("Ошибка при записи в кэш вложений: %s", e)
+
+    def invalidate(self, url):
+        key = url_hash(url)
+        with self.lock:
+            self.entries.pop(key, None)
+        if self.db is not None:
+            try:
+                self.db.delete_photo_attachment(key)
+            except Exception as e:
+                logging.error("Ошибка при удалении из кэша вложений: %s", e)
+
+    async def evict_expired(self):
+        """
+        Удаление устаревших записей из памяти и из таблицы.
+        """
+        deadline = time.time() - self.ttl
+        with self.lock:
+            expired = [key for key, (_, created_at) in self.entries.items() if created_at < deadline]
+            for key in expired:
+                del self.entries[key]
+        if self.db is not None:
+            return await asyncio.to_thread(self.db.delete_expired_photo_attachments, self.ttl)
+        return len(expired)
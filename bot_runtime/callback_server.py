@@ -0,0 +1,125 @@
+import asyncio
+import hmac
+import json
+import logging
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Сколько последних event_id помнить, чтобы не обрабатывать повторные доставки VK
+SEEN_EVENTS_SIZE = 10000
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик запросов Callback API.
+
+    Ответ "ok" отправляется сразу после проверки запроса, а само сообщение
+    передается в цикл событий бота. Если VK не получит ответ вовремя,
+    он повторит событие, поэтому обработка не должна задерживать ответ.
+    """
+
+    server_version = "VKinderCallback"
+
+    def log_message(self, format, *args):
+        logging.debug("Callback API: " + format, *args)
+
+    def _reply(self, status, body=b"ok"):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # Проверка работоспособности для балансировщика нагрузки
+        self._reply(200)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            event = json.loads(self.rfile.read(length))
+        except (ValueError, UnicodeDecodeError):
+            event = None
+        if not isinstance(event, dict):
+            self._reply(400, b"bad request")
+            return
+
+        settings = self.server.settings
+        if settings.group_id and event.get("group_id") != settings.group_id:
+            self._reply(403, b"forbidden")
+            return
+        if settings.secret and not hmac.compare_digest(str(event.get("secret", "")), settings.secret):
+            logging.warning("Callback API: неверный secret от %s", self.client_address[0])
+            self._reply(403, b"forbidden")
+            return
+
+        if event.get("type") == "confirmation":
+            self._reply(200, settings.confirmation_code.encode())
+            return
+
+        self._reply(200)
+        if event.get("type") == "message_new" and settings.remember(event.get("event_id")):
+            message = event.get("object")
+            message = message.get("message") if isinstance(message, dict) else None
+            if isinstance(message, dict) and message.get("from_id") and message.get("out", 0) == 0:
+                settings.submit(message["from_id"], message.get("text", ""))
+
+
+class CallbackServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Очередь соединений по умолчанию (5) слишком мала для пиков нагрузки
+    request_queue_size = 128
+
+
+class CallbackSettings:
+    """
+    Настройки сервера и связь с диспетчером сообщений.
+    """
+
+    def __init__(self, dispatcher, loop, confirmation_code, secret=None, group_id=None):
+        self.dispatcher = dispatcher
+        self.loop = loop
+        self.confirmation_code = confirmation_code
+        self.secret = secret
+        self.group_id = group_id
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def remember(self, event_id):
+        """
+        Возвращает False, если событие с таким event_id уже получено.
+        """
+        if not event_id:
+            return True
+        with self.lock:
+            if event_id in self.seen:
+                return False
+            self.seen[event_id] = True
+            if len(self.seen) > SEEN_EVENTS_SIZE:
+                self.seen.popitem(last=False)
+        return True
+
+    def submit(self, user_id, text):
+        # Диспетчер работает в цикле событий, а сервер - в своих потоках
+        self.loop.call_soon_threadsafe(self.dispatcher.submit, user_id, text)
+
+
+async def serve_callback(dispatcher, host, port, confirmation_code, secret=None, group_id=None):
+    """
+    Прием событий через Callback API. Работает, пока задача не будет отменена.
+    """
+    server = CallbackServer((host, port), CallbackHandler)
+    server.settings = CallbackSettings(
+        dispatcher, asyncio.get_running_loop(), confirmation_code, secret, group_id
+    )
+    thread = threading.Thread(target=server.serve_forever, name="callback", daemon=True)
+    thread.start()
+    logging.info("Callback API сервер слушает %s:%s", host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,128 @@
+import logging
+
+from bot_runtime.metrics import HANDLER_SECONDS, REGISTRY
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+UNMATCHED_MESSAGES = REGISTRY.counter("vkinder_unmatched_messages", "Сообщения, не подошедшие ни к одному переходу")
+
+
+class ButtonVK:
+    begin = "Начать"
+    start = "Начать подбор"
+    finish = "Завершить"
+    lets_go = "Привет! Я - бот VKinder, который поможет тебе подобрать пару."
+    enter_city = "Введите город для поиска:"
+    right_city = "Да, верно"
+    modify_city = "Изменить город"
+    boy = "Парень"
+    girl = "Девушка"
+    all_true = "Все верно"
+    change_parameters = "Изменить параметры"
+    city = "Город"
+    age = "Возраст"
+    gender = "Пол"
+    next = "Следующий"
+    add_favourites = "Добавить в избранное"
+    all_fovourites = "Избранное"
+    display = "Начать показ"
+    clear_favourites = "Очистить избранное"
+    more_favourites = "Ещё избранное"
+
+
+# Состояния диалога
+IDLE = ""
+CITY = "city"
+CITY_CONFIRM = "city confirm"
+MODIFY_CITY = "modify city"
+MODIFY_CITY_CONFIRM = "modify city confirm"
+GENDER = "gender"
+MODIFY_GENDER = "modify gender"
+AGE = "age"
+DATA_CONFIRM = "data confirm"
+NAVIGATION = "navigation"
+
+ANY = "*"  # переход доступен из любого состояния
+TEXT = None  # произвольный текст, не совпавший ни с одной кнопкой
+KEEP = None  # состояние не меняется
+
+# (состояние, кнопка, обработчик, следующее состояние)
+TRANSITIONS = (
+    (ANY, ButtonVK.begin, "on_begin", KEEP),
+    (ANY, ButtonVK.finish, "on_finish", KEEP),
+    (ANY, ButtonVK.start, "on_ask_city", CITY),
+    (CITY, TEXT, "on_city_entered", CITY_CONFIRM),
+    (MODIFY_CITY, TEXT, "on_city_entered", MODIFY_CITY_CONFIRM),
+    (CITY_CONFIRM, ButtonVK.right_city, "on_city_saved", GENDER),
+    (MODIFY_CITY_CONFIRM, ButtonVK.right_city, "on_city_updated", DATA_CONFIRM),
+    (ANY, ButtonVK.modify_city, "on_modify_city", MODIFY_CITY),
+    (ANY, ButtonVK.boy, "on_gender_chosen", AGE),
+    (ANY, ButtonVK.girl, "on_gender_chosen", AGE),
+    (MODIFY_GENDER, ButtonVK.boy, "on_gender_updated", DATA_CONFIRM),
+    (MODIFY_GENDER, ButtonVK.girl, "on_gender_updated", DATA_CONFIRM),
+    (AGE, TEXT, "on_age_entered", DATA_CONFIRM),
+    (DATA_CONFIRM, ButtonVK.all_true, "on_search", NAVIGATION),
+    (DATA_CONFIRM, ButtonVK.change_parameters, "on_data_modify", KEEP),
+    (ANY, ButtonVK.city, "on_ask_city", MODIFY_CITY),
+    (ANY, ButtonVK.age, "on_ask_age", AGE),
+    (ANY, ButtonVK.gender, "on_ask_gender", MODIFY_GENDER),
+    (NAVIGATION, ButtonVK.next, "on_next", KEEP),
+    (NAVIGATION, ButtonVK.add_favourites, "on_add_favourite", KEEP),
+    (ANY, ButtonVK.all_fovourites, "on_show_favorites", KEEP),
+    (ANY, ButtonVK.more_favourites, "on_more_favorites", KEEP),
+    (ANY, ButtonVK.clear_favourites, "on_clear_favorites", KEEP),
+)
+
+
+class StateMachine:
+    """
+    Конечный автомат диалога: таблица (состояние, кнопка) -> обработчик.
+
+    Поиск обработчика выполняется за O(1): сначала переход для текущего
+    состояния, затем переход из любого состояния, затем обработчик
+    произвольного текста для текущего состояния.
+    """
+
+    def __init__(self):
+        self.transitions = {}
+
+    def add(self, state, label, handler, next_state=KEEP):
+        self.transitions[(state, label)] = (handler, next_state)
+
+    def resolve(self, state, msg):
+        transition = self.transitions.get((state, msg))
+        if transition is None:
+            transition = self.transitions.get((ANY, msg))
+        if transition is None:
+            transition = self.transitions.get((state, TEXT))
+        return transition
+
+    async def dispatch(self, session, msg):
+        """
+        Обработка сообщения. Обработчик может вернуть новое состояние,
+        иначе используется состояние из таблицы переходов.
+        Возвращает False, если сообщение не подходит ни к одному переходу.
+        """
+        transition = self.resolve(session.flag, msg)
+        if transition is None:
+            logging.debug("Нет перехода из состояния %r по сообщению %r", session.flag, msg)
+            UNMATCHED_MESSAGES.inc()
+            return False
+        handler, next_state = transition
+        with HANDLER_SECONDS.time(handler=handler.__name__):
+            state = await handler(session, msg)
+        if state is not None:
+            session.flag = state
+        elif next_state is not None:
+            session.flag = next_state
+        return True
+
+
+def build_state_machine(handlers, transitions=TRANSITIONS):
+    """
+    Построение автомата по таблице переходов. handlers - словарь имя -> корутина.
+    """
+    machine = StateMachine()
+    for state, label, name, next_state in transitions:
+        machine.add(state, label, handlers[name], next_state)
+    return machine
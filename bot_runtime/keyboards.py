@@ -0,0 +1,58 @@
+from vk_api.keyboard import VkKeyboard, VkKeyboardColor
+
+from bot_runtime.conversation import ButtonVK
+
+# Раскладки клавиатур: строки кнопок (текст, цвет)
+LAYOUTS = {
+    "start": [
+        [(ButtonVK.start, VkKeyboardColor.PRIMARY), (ButtonVK.finish, VkKeyboardColor.NEGATIVE)],
+    ],
+    "city": [
+        [(ButtonVK.finish, VkKeyboardColor.NEGATIVE)],
+    ],
+    "city_confirm": [
+        [(ButtonVK.right_city, VkKeyboardColor.PRIMARY), (ButtonVK.modify_city, VkKeyboardColor.PRIMARY)],
+        [(ButtonVK.finish, VkKeyboardColor.NEGATIVE)],
+    ],
+    "gender": [
+        [(ButtonVK.boy, VkKeyboardColor.PRIMARY), (ButtonVK.girl, VkKeyboardColor.PRIMARY)],
+        [(ButtonVK.finish, VkKeyboardColor.NEGATIVE)],
+    ],
+    "data_confirm": [
+        [(ButtonVK.all_true, VkKeyboardColor.PRIMARY), (ButtonVK.change_parameters, VkKeyboardColor.PRIMARY)],
+        [(ButtonVK.finish, VkKeyboardColor.NEGATIVE)],
+    ],
+    "data_modify": [
+        [(ButtonVK.city, VkKeyboardColor.PRIMARY), (ButtonVK.age, VkKeyboardColor.PRIMARY),
+         (ButtonVK.gender, VkKeyboardColor.PRIMARY)],
+        [(ButtonVK.finish, VkKeyboardColor.NEGATIVE)],
+    ],
+    "navigation": [
+        [(ButtonVK.next, VkKeyboardColor.PRIMARY), (ButtonVK.add_favourites, VkKeyboardColor.PRIMARY),
+         (ButtonVK.all_fovourites, VkKeyboardColor.PRIMARY)],
+        [(ButtonVK.finish, VkKeyboardColor.NEGATIVE)],
+    ],
+    "navigation_for_favorites": [
+        [(ButtonVK.next, VkKeyboardColor.PRIMARY), (ButtonVK.clear_favourites, VkKeyboardColor.NEGATIVE)],
+        [(ButtonVK.finish, VkKeyboardColor.NEGATIVE)],
+    ],
+    "navigation_for_favorites_more": [
+        [(ButtonVK.more_favourites, VkKeyboardColor.PRIMARY), (ButtonVK.next, VkKeyboardColor.PRIMARY),
+         (ButtonVK.clear_favourites, VkKeyboardColor.NEGATIVE)],
+        [(ButtonVK.finish, VkKeyboardColor.NEGATIVE)],
+    ],
+}
+
+
+def build_keyboard(rows, one_time=True):
+    keyboard = VkKeyboard(one_time=one_time)
+    for index, row in enumerate(rows):
+        if index:
+            keyboard.add_line()
+        for label, color in row:
+            keyboard.add_button(label, color)
+    return keyboard
+
+
+# Клавиатуры сериализуются в JSON один раз при импорте
+KEYBOARDS = {name: build_keyboard(rows).get_keyboard() for name, rows in LAYOUTS.items()}
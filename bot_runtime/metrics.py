@@ -0,0 +1,283 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Границы корзин гистограмм в секундах
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    type_name = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получены {tuple(labels)}")
+        try:
+            return tuple([str(labels[name]) for name in self.labelnames])
+        except KeyError:
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получены {tuple(labels)}")
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(f"{name}{labels} {value:g}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    Монотонно растущий счетчик.
+    """
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [(self.name + "_total", _format_labels(self.labelnames, key), value) for key, value in items]
+
+
+class Gauge(Metric):
+    """
+    Текущее значение. Вместо set можно передать функцию, которая вызывается при выгрузке метрик
+    (так удобно отдавать длину очередей и размер кэшей).
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [(self.name, "", self.function())]
+            except Exception as e:
+                logging.error("Ошибка при чтении метрики %s: %s", self.name, e)
+                return []
+        with self.lock:
+            items = list(self.values.items())
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in items]
+
+
+class Histogram(Metric):
+    """
+    Распределение значений (обычно длительностей в секундах) по корзинам.
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self._observe(self._key(labels), value)
+
+    def _observe(self, key, value):
+        # Значение больше последней границы попадает только в +Inf
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, self._key(labels))
+
+    def samples(self):
+        with self.lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        result = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", f"{bound:g}")])
+                result.append((self.name + "_bucket", labels, cumulative))
+            result.append((self.name + "_bucket", _format_labels(self.labelnames, key, [("le", "+Inf")]), count))
+            result.append((self.name + "_sum", _format_labels(self.labelnames, key), total))
+            result.append((self.name + "_count", _format_labels(self.labelnames, key), count))
+        return result
+
+
+class _Timer:
+    """
+    Контекстный менеджер для Histogram.time (легче генератора из contextlib).
+    """
+
+    __slots__ = ("histogram", "key", "started")
+
+    def __init__(self, histogram, key):
+        self.histogram = histogram
+        self.key = key
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram._observe(self.key, time.perf_counter() - self.started)
+
+
+class Registry:
+    """
+    Набор метрик процесса. Метрика с тем же именем создается один раз.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._get_or_create(Gauge, name, documentation, labelnames, function)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        """
+        Все метрики в текстовом формате Prometheus.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    "vkinder_handler_seconds", "Время обработки сообщения обработчиком диалога", ("handler",)
+)
+VK_CALL_SECONDS = REGISTRY.histogram("vkinder_vk_call_seconds", "Время вызова метода VK API", ("method",))
+VK_ERRORS = REGISTRY.counter("vkinder_vk_errors", "Ошибки VK API по методам и кодам", ("method", "code"))
+DB_QUERY_SECONDS = REGISTRY.histogram("vkinder_db_query_seconds", "Время выполнения запроса к базе данных", ("query",))
+CACHE_REQUESTS = REGISTRY.counter("vkinder_cache_requests", "Обращения к кэшам", ("cache", "result"))
+SPAN_SECONDS = REGISTRY.histogram("vkinder_span_seconds", "Длительность отслеживаемых операций", ("span",))
+
+# Трассировка: при включенной трассировке каждая операция пишется в журнал с указанием родительской
+tracing_enabled = False
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def cache_hit(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+@contextmanager
+def span(name):
+    """
+    Замер длительности операции. Вложенные операции (в том числе в других задачах asyncio,
+    созданных внутри) знают свою родительскую операцию.
+    """
+    parent = _current_span.get()
+    path = name if parent is None else f"{parent}/{name}"
+    token = _current_span.set(path)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _current_span.reset(token)
+        SPAN_SECONDS.observe(elapsed, span=name)
+        if tracing_enabled:
+            logging.info("span %s %.1f мс", path, elapsed * 1000)
+
+
+def traced(name):
+    """
+    Декоратор: выполнение функции (обычной или асинхронной) оборачивается в span.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port, host="127.0.0.1", registry=REGISTRY):
+    """
+    HTTP-сервер с метриками по адресу /metrics в фоновом потоке.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info("Метрики доступны по адресу http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+
+from vk_api.exceptions import ApiError
+from vk_api.utils import sjson_dumps
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Ошибки, после которых отправку стоит повторить:
+# 6 - слишком много запросов в секунду, 9 - flood control, 10 - внутренняя ошибка сервера
+RETRY_CODES = {6, 9, 10}
+# Ошибки частоты запросов: после них замедляется общий RateLimiter клиента
+THROTTLE_CODES = {6, 9}
+# Внутренний код для сетевых ошибок, которые тоже повторяем
+NETWORK_ERROR_CODE = 10
+
+
+class OutgoingMessage:
+    __slots__ = ("params", "future", "attempts", "not_before")
+
+    def __init__(self, params, future):
+        self.params = params
+        self.future = future
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений.
+
+    Сообщения разных получателей объединяются в один вызов execute
+    (до 25 messages.send за запрос), частоту запросов ограничивает
+    RateLimiter клиента AsyncVkApi. При ошибках 6/9/10 сообщение
+    отправляется повторно с экспоненциальной задержкой, а после ошибок 6/9
+    RateLimiter приостанавливает и замедляет все запросы клиента,
+    иначе остальные пачки продолжали бы получать те же ошибки.
+
+    Порядок сообщений одному получателю сохраняется: в пачку попадает
+    только первое сообщение из очереди получателя, и следующее не
+    отправляется, пока предыдущее не доставлено или окончательно не отклонено.
+    """
+
+    def __init__(self, vk, batch_size=25, max_in_flight=4, max_retries=5, backoff=0.5, max_code_length=60000):
+        self.vk = vk
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_code_length = max_code_length
+        self.queues = OrderedDict()
+        self.busy = set()
+        self.wakeup = asyncio.Event()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def send(self, params):
+        """
+        Поставить сообщение в очередь и дождаться результата messages.send.
+        """
+        message = OutgoingMessage(params, asyncio.get_running_loop().create_future())
+        queue = self.queues.get(params["user_id"])
+        if queue is None:
+            queue = self.queues[params["user_id"]] = deque()
+        queue.append(message)
+        self.wakeup.set()
+        return await message.future
+
+    def _take_batch(self):
+        now = time.monotonic()
+        batch = []
+        code_length = 0
+        next_time = None
+        for peer, queue in self.queues.items():
+            if peer in self.busy:
+                continue
+            head = queue[0]
+            if head.not_before > now:
+                next_time = head.not_before if next_time is None else min(next_time, head.not_before)
+                continue
+            call = f"API.messages.send({sjson_dumps(head.params)})"
+            if batch and code_length + len(call) > self.max_code_length:
+                break
+            batch.append((peer, head, call))
+            code_length += len(call) + 1
+            if len(batch) >= self.batch_size:
+                break
+
+        for peer, _, _ in batch:
+            self.busy.add(peer)
+            # Получатели, которым только что отправили, уходят в конец очереди
+            self.queues.move_to_end(peer)
+        return batch, next_time
+
+    async def run(self):
+        """
+        Фоновая отправка сообщений из очереди.
+        """
+        while True:
+            batch, next_time = self._take_batch()
+            if not batch:
+                self.wakeup.clear()
+                timeout = None if next_time is None else max(0.0, next_time - time.monotonic())
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.in_flight.acquire()
+            asyncio.create_task(self._send_batch(batch))
+
+    async def _execute(self, batch):
+        """
+        Отправка пачки. Возвращает список (успех, результат или описание ошибки).
+        """
+        if len(batch) == 1:
+            _, message, _ = batch[0]
+            return [(True, await self.vk.method("messages.send", message.params))]
+
+        code = "return [{}];".format(",".join(call for _, _, call in batch))
+        response = await self.vk.method("execute", {"code": code}, raw=True)
+        errors = iter(response.get("execute_errors", []))
+        results = []
+        for result in response["response"]:
+            if result is False:
+                results.append((False, next(errors, {"error_code": 0, "error_msg": "Unknown error"})))
+            else:
+                results.append((True, result))
+        return results
+
+    async def _send_batch(self, batch):
+        try:
+            try:
+                results = await self._execute(batch)
+            except ApiError as e:
+                results = [(False, e.error)] * len(batch)
+            except Exception as e:
+                logging.error("Ошибка при отправке сообщений: %s", e)
+                results = [(False, {"error_code": NETWORK_ERROR_CODE, "error_msg": str(e)})] * len(batch)
+        finally:
+            self.in_flight.release()
+
+        if any(not ok and result["error_code"] in THROTTLE_CODES for ok, result in results):
+            self.vk.limiter.throttle(self.backoff)
+        now = time.monotonic()
+        for (peer, message, _), (ok, result) in zip(batch, results):
+            queue = self.queues[peer]
+            if not ok and result["error_code"] in RETRY_CODES and message.attempts < self.max_retries:
+                message.attempts += 1
+                delay = self.backoff * 2 ** (message.attempts - 1)
+                message.not_before = now + delay * random.uniform(1, 1.5)
+                logging.warning(
+                    "Повторная отправка сообщения пользователю %s через %.1f с: %s",
+                    peer, delay, result["error_msg"]
+                )
+            else:
+                queue.popleft()
+                if not message.future.done():
+                    if ok:
+                        message.future.set_result(result)
+                    else:
+                        message.future.set_exception(
+                            ApiError(self.vk.vk_session, "messages.send", message.params, False, result)
+                        )
+                if not queue:
+                    del self.queues[peer]
+            self.busy.discard(peer)
+        self.wakeup.set()
@@ -0,0 +1,177 @@
+import io
+import logging
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from vk_api.requests_pool import VkRequestsPool
+
+from bot_runtime.metrics import REGISTRY
+
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow нужен только для уменьшения фотографий перед загрузкой (PHOTO_RESIZE_WIDTH)
+    Image = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CHUNK_SIZE = 64 * 1024
+# Файлы меньше этого размера остаются в памяти, большие уходят на диск
+SPOOL_SIZE = 1024 * 1024
+
+PHOTO_BYTES = REGISTRY.counter("vkinder_photo_bytes", "Объем скачанных и загруженных фотографий", ("direction",))
+
+
+def downscale(data, max_width, quality=85):
+    """
+    Уменьшение фотографии до max_width по ширине и пересжатие в JPEG.
+    Выполняется в пуле процессов, чтобы не занимать GIL потоков бота.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width > max_width:
+            image.thumbnail((max_width, image.height), Image.LANCZOS)
+        output = io.BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+class PhotoPipeline:
+    """
+    Скачивание фотографий и их загрузка в VK для отправки в сообщениях.
+
+    Скачивание и загрузка идут в отдельных пулах потоков с ограниченной
+    параллельностью через пул keep-alive соединений. Каждая фотография
+    отправляется на сервер загрузки сразу после скачивания, не дожидаясь
+    остальных. Адрес сервера загрузки запрашивается один раз на пачку,
+    а photos.saveMessagesPhoto для всей пачки выполняется одним запросом execute.
+    Если задан resize_width (и установлен Pillow), фотографии шире него
+    уменьшаются и пересжимаются перед загрузкой в ограниченном пуле процессов.
+    """
+
+    def __init__(self, vk_session, download_workers=8, upload_workers=4, timeout=(5, 30),
+                 resize_width=None, resize_workers=2, jpeg_quality=85):
+        self.vk_session = vk_session
+        self.timeout = timeout
+        self.resize_width = resize_width
+        self.jpeg_quality = jpeg_quality
+        self.resize_pool = None
+        if resize_width and Image is None:
+            logging.warning("Pillow не установлен, фотографии загружаются без уменьшения")
+        elif resize_width:
+            # spawn: fork процесса с потоками может унаследовать захваченные блокировки
+            self.resize_pool = ProcessPoolExecutor(
+                max_workers=resize_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        self.http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=download_workers + upload_workers,
+            pool_maxsize=download_workers + upload_workers,
+            max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504)),
+        )
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        self.download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="photo-download")
+        self.upload_pool = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="photo-upload")
+
+    def download(self, url):
+        """
+        Потоковое скачивание фотографии во временный файл.
+        """
+        with self.http.get(url, stream=True, timeout=self.timeout) as response:
+            if response.status_code != 200:
+                logging.warning("Не удалось загрузить фотографию по URL: %s", url)
+                return None
+            photo_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                photo_file.write(chunk)
+        PHOTO_BYTES.inc(photo_file.tell(), direction="download")
+        photo_file.seek(0)
+        return photo_file
+
+    def _downscale(self, photo_file):
+        """
+        Уменьшенная копия фотографии; если уменьшить не удалось или копия
+        получилась больше оригинала, остается оригинал.
+        """
+        with photo_file:
+            data = photo_file.read()
+        try:
+            resized = self.resize_pool.submit(downscale, data, self.resize_width, self.jpeg_quality).result()
+        except Exception as e:
+            logging.warning("Не удалось уменьшить фотографию: %s", e)
+            resized = data
+        return io.BytesIO(min(resized, data, key=len))
+
+    def _get_upload_url(self):
+        return self.vk_session.method("photos.getMessagesUploadServer")["upload_url"]
+
+    def _post(self, upload_url, photo_file):
+        PHOTO_BYTES.inc(photo_file.seek(0, io.SEEK_END), direction="upload")
+        photo_file.seek(0)
+        try:
+            response = self.http.post(
+                upload_url, files={"photo": ("photo.jpg", photo_file)}, timeout=self.timeout
+            )
+            response.raise_for_status()
+            return response.json()
+        finally:
+            photo_file.close()
+
+    def _download_and_post(self, url, upload_url_future):
+        photo_file = self.download(url)
+        if photo_file is None:
+            return None
+        if self.resize_pool is not None:
+            photo_file = self._downscale(photo_file)
+        return self.upload_pool.submit(self._post, upload_url_future.result(), photo_file).result()
+
+    def _save(self, uploaded):
+        """
+        Сохранение загруженных фотографий одним запросом execute.
+        """
+        pool = VkRequestsPool(self.vk_session.get_api())
+        results = {url: pool.method("photos.saveMessagesPhoto", data) for url, data in uploaded.items()}
+        pool.execute()
+
+        attachments = {}
+        for url, result in results.items():
+            if result.ok:
+                photo = result.result[0]
+                attachments[url] = f"photo{photo['owner_id']}_{photo['id']}"
+            else:
+                logging.error("Ошибка при сохранении фотографии %s: %s", url, result.error)
+        return attachments
+
+    def upload_many(self, urls):
+        """
+        Загрузка фотографий по URL. Возвращает словарь URL -> строка вложения
+        для успешно загруженных фотографий.
+        """
+        if not urls:
+            return {}
+
+        upload_url_future = self.upload_pool.submit(self._get_upload_url)
+        futures = {self.download_pool.submit(self._download_and_post, url, upload_url_future): url for url in urls}
+
+        uploaded = {}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                data = future.result()
+            except Exception as e:
+                logging.error("Ошибка при загрузке или отправке фотографии: %s", e)
+                continue
+            if data is not None:
+                uploaded[url] = data
+
+        if not uploaded:
+            return {}
+        try:
+            return self._save(uploaded)
+        except Exception as e:
+            logging.error("Ошибка при сохранении фотографий: %s", e)
+            return {}
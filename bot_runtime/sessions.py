@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from bot_runtime.metrics import REGISTRY, cache_hit
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SESSION_LOCK_WAITS = REGISTRY.counter(
+    "vkinder_session_lock_waits", "Ожидания сессии, которую обрабатывает другой процесс бота"
+)
+SESSION_LOCKS_LOST = REGISTRY.counter(
+    "vkinder_session_locks_lost", "Сессии, блокировка которых истекла до сохранения"
+)
+
+
+class Session:
+    """
+    Состояние диалога с одним пользователем.
+    """
+
+    __slots__ = ("user_id", "flag", "pending_city", "pending_city_id", "city", "city_id", "gender", "gender_label",
+                 "age", "cursor", "current_user", "favorites_after", "updated_at")
+
+    def __init__(self, user_id, flag="", pending_city="", pending_city_id=None, city="", city_id=None,
+                 gender="", gender_label="", age="",
+                 cursor=None, current_user=None, favorites_after=None, updated_at=None):
+        self.user_id = user_id
+        self.flag = flag
+        self.pending_city = pending_city
+        self.pending_city_id = pending_city_id
+        self.city = city
+        self.city_id = city_id
+        self.gender = gender
+        self.gender_label = gender_label
+        self.age = age
+        self.cursor = cursor
+        self.current_user = current_user
+        self.favorites_after = favorites_after
+        self.updated_at = updated_at or time.time()
+
+    @property
+    def search_parameters(self):
+        """
+        Параметры, которые передаем в функцию поиска.
+        """
+        return {"city": self.city, "city_id": self.city_id, "gender": self.gender, "age": self.age}
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.__slots__}
+        if self.cursor is not None:
+            data["cursor"] = self.cursor.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = {name: data[name] for name in cls.__slots__ if name in data}
+        if data.get("cursor") is not None:
+            from finding_users.search_cursor import SearchCursor
+            data["cursor"] = SearchCursor.from_dict(data["cursor"])
+        return cls(**data)
+
+
+def release_session(session):
+    """
+    Освобождение ресурсов вытесненной сессии (фоновая загрузка анкет).
+    """
+    if session.cursor is not None:
+        session.cursor.close()
+
+
+class MemorySessionStore:
+    """
+    Хранилище сессий в памяти процесса: LRU с ограничением размера и TTL.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+
+    async def get(self, user_id):
+        session = self.sessions.get(user_id)
+        if session is None or time.time() - session.updated_at > self.ttl:
+            cache_hit("sessions", False)
+            return Session(user_id)
+        cache_hit("sessions", True)
+        self.sessions.move_to_end(user_id)
+        return session
+
+    async def save(self, session):
+        session.updated_at = time.time()
+        self.sessions[session.user_id] = session
+        self.sessions.move_to_end(session.user_id)
+        while len(self.sessions) > self.max_size:
+            _, evicted = self.sessions.popitem(last=False)
+            release_session(evicted)
+        return True
+
+    async def delete(self, user_id):
+        self.sessions.pop(user_id, None)
+
+    async def evict_expired(self):
+        deadline = time.time() - self.ttl
+        expired = [user_id for user_id, session in self.sessions.items() if session.updated_at < deadline]
+        for user_id in expired:
+            release_session(self.sessions.pop(user_id))
+        return len(expired)
+
+
+class PostgresSessionStore:
+    """
+    Хранилище сессий в PostgreSQL. Сессии переживают перезапуск бота
+    и доступны нескольким процессам бота одновременно.
+
+    get захватывает сессию пользователя, а save сохраняет ее и отпускает,
+    поэтому сообщения одного пользователя, попавшие в разные копии бота,
+    обрабатываются по очереди. Блокировка хранится в строке сессии
+    и не держит соединение с базой; блокировка упавшего процесса истекает через lock_timeout.
+    """
+
+    def __init__(self, ttl=3600, lock_timeout=60):
+        # Импорт здесь, чтобы хранилище в памяти не требовало базы данных
+        from vkinder_db import vkinder_db
+        self.db = vkinder_db
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.owner = uuid.uuid4().hex
+
+    async def get(self, user_id):
+        delay = 0.02
+        deadline = time.monotonic() + 2 * self.lock_timeout
+        while True:
+            locked, data = await asyncio.to_thread(
+                self.db.lock_session, user_id, self.owner, self.lock_timeout, self.ttl
+            )
+            if locked:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Сессия пользователя {user_id} занята другим процессом бота")
+            SESSION_LOCK_WAITS.inc()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        cache_hit("sessions", data is not None)
+        return Session(user_id) if data is None else Session.from_dict(data)
+
+    async def save(self, session):
+        session.updated_at = time.time()
+        saved = await asyncio.to_thread(
+            self.db.save_session, session.user_id, json.dumps(session.to_dict()), self.owner
+        )
+        # Объект сессии больше не используется: следующий get прочитает ее из базы заново
+        release_session(session)
+        if not saved:
+            SESSION_LOCKS_LOST.inc()
+            logging.error("Блокировка сессии пользователя %s истекла до сохранения", session.user_id)
+        return saved
+
+    async def delete(self, user_id):
+        await asyncio.to_thread(self.db.delete_session, user_id)
+
+    async def evict_expired(self):
+        return await asyncio.to_thread(self.db.delete_expired_sessions, self.ttl)
+
+
+def create_session_store(backend="memory", ttl=3600, max_size=10000, lock_timeout=60):
+    """
+    Создание хранилища сессий: "memory" или "postgres".
+    """
+    if backend == "postgres":
+        return PostgresSessionStore(ttl=ttl, lock_timeout=lock_timeout)
+    return MemorySessionStore(max_size=max_size, ttl=ttl)
+
+
+async def evict_periodically(store, interval=300):
+    """
+    Периодическая очистка устаревших записей хранилища (сессий, кэша).
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            evicted = await store.evict_expired()
+            if evicted:
+                logging.info("Удалено устаревших записей: %s", evicted)
+        except Exception as e:
+            logging.error("Ошибка при очистке устаревших записей: %s", e)
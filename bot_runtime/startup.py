@@ -0,0 +1,38 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from bot_runtime.metrics import REGISTRY
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+STARTUP_SECONDS = REGISTRY.gauge("vkinder_startup_seconds", "Длительность шагов запуска бота", ("step",))
+
+
+class StartupTimer:
+    """
+    Замер длительности шагов запуска (импорт, клиенты, миграции, загрузка данных).
+    """
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.steps = []
+
+    def record(self, name, seconds):
+        self.steps.append((name, seconds))
+        STARTUP_SECONDS.set(seconds, step=name)
+
+    @contextmanager
+    def step(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self):
+        total = time.perf_counter() - self.started
+        STARTUP_SECONDS.set(total, step="total")
+        details = ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in self.steps)
+        logging.info("Запуск занял %.0f мс: %s", total * 1000, details)
+        return total
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+from bot_runtime.metrics import REGISTRY
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+WORKER_RESTARTS = REGISTRY.counter("vkinder_worker_restarts", "Перезапуски упавших процессов-обработчиков", ("worker",))
+EVENTS_ROUTED = REGISTRY.counter("vkinder_events_routed", "Сообщения, переданные процессам-обработчикам", ("worker",))
+
+
+class WorkerChannel:
+    """
+    Односторонний канал сообщений к процессу-обработчику.
+
+    В отличие от multiprocessing.Queue, у канала нет общей блокировки на чтение,
+    которую навсегда захватывает упавший процесс, поэтому перезапущенный
+    обработчик продолжает читать тот же канал. Запись идет из отдельного потока,
+    чтобы медленный обработчик не блокировал прием сообщений.
+    """
+
+    def __init__(self, context):
+        self.reader, self.writer = context.Pipe(duplex=False)
+        self.pending = queue.SimpleQueue()
+        threading.Thread(target=self._feed, name="worker-channel", daemon=True).start()
+
+    def put(self, item):
+        self.pending.put(item)
+
+    def _feed(self):
+        while True:
+            item = self.pending.get()
+            self.writer.send(item)
+            if item is None:
+                return
+
+
+def shard_for(user_id, workers):
+    """
+    Номер процесса-обработчика для пользователя: один и тот же при любом перезапуске.
+    """
+    return zlib.crc32(int(user_id).to_bytes(8, "little", signed=True)) % workers
+
+
+class Supervisor:
+    """
+    Несколько процессов-обработчиков, между которыми сообщения распределяются по user_id.
+
+    Все сообщения одного пользователя попадают в канал одного процесса,
+    поэтому порядок их обработки сохраняется, а сессия пользователя
+    остается в памяти этого процесса. Упавший процесс запускается заново
+    с тем же каналом: сообщения, пришедшие за это время, не теряются
+    (теряются только те, что упавший процесс уже прочитал, но не обработал).
+    Если процесс падает сразу после запуска, пауза перед перезапуском растет.
+    """
+
+    def __init__(self, target, workers=2, restart_delay=1.0, max_restart_delay=30.0, stable_after=30.0):
+        # spawn: fork процесса с потоками может унаследовать захваченные блокировки
+        self.context = multiprocessing.get_context("spawn")
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.channels = [WorkerChannel(self.context) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.started_at = [0.0] * workers
+        self.delays = [restart_delay] * workers
+        self.next_start = [0.0] * workers
+        self.stopping = False
+
+    def _start(self, index):
+        process = self.context.Process(
+            target=self.target,
+            args=(index, len(self.channels), self.channels[index].reader),
+            name=f"vkinder-worker-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        logging.info("Запущен обработчик %s (pid %s)", index, process.pid)
+
+    def start(self):
+        for index in range(len(self.channels)):
+            self._start(index)
+
+    def submit(self, user_id, text):
+        index = shard_for(user_id, len(self.channels))
+        self.channels[index].put((user_id, text))
+        EVENTS_ROUTED.inc(worker=str(index))
+
+    def check(self):
+        """
+        Перезапуск упавших обработчиков. Возвращает номера перезапущенных.
+        """
+        restarted = []
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if self.stopping or process is None or process.is_alive():
+                continue
+            if self.next_start[index] == 0.0:
+                # Процесс, проработавший достаточно долго, перезапускается без задержки
+                if now - self.started_at[index] >= self.stable_after:
+                    self.delays[index] = self.restart_delay
+                logging.error(
+                    "Обработчик %s завершился с кодом %s, перезапуск через %.0f с",
+                    index, process.exitcode, self.delays[index]
+                )
+                self.next_start[index] = now + self.delays[index]
+                self.delays[index] = min(self.delays[index] * 2, self.max_restart_delay)
+            if now >= self.next_start[index]:
+                self.next_start[index] = 0.0
+                process.close()
+                self._start(index)
+                WORKER_RESTARTS.inc(worker=str(index))
+                restarted.append(index)
+        return restarted
+
+    async def watch(self, interval=0.5):
+        while True:
+            await asyncio.sleep(interval)
+            self.check()
+
+    def stop(self, timeout=10.0):
+        """
+        Остановка обработчиков: каждый дорабатывает свою очередь и завершается.
+        """
+        self.stopping = True
+        for channel in self.channels:
+            channel.put(None)
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning("Обработчик %s не завершился вовремя, останавливаем принудительно", index)
+                process.terminate()
+                process.join()
+
+
+async def consume_events(events, dispatcher):
+    """
+    Передача сообщений из канала процесса-обработчика диспетчеру.
+    Завершается, когда супервизор прислал None или сам завершился (канал закрыт).
+    """
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+
+    def read():
+        while True:
+            try:
+                item = events.recv()
+            except EOFError:
+                logging.error("Супервизор завершился, обработчик останавливается")
+                item = None
+            if item is None:
+                loop.call_soon_threadsafe(stopped.set_result, None)
+                return
+            loop.call_soon_threadsafe(dispatcher.submit, *item)
+
+    threading.Thread(target=read, name="worker-events", daemon=True).start()
+    await stopped
+    await dispatcher.join()
@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from urllib.parse import urljoin
+
+import vk_api
+from requests.adapters import HTTPAdapter
+from vk_api.exceptions import ApiError
+from vk_api.vk_api import VkApiMethod
+
+from bot_runtime.metrics import REGISTRY, VK_CALL_SECONDS, VK_ERRORS
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+VK_API_URL = "https://api.vk.com/method/"
+TOO_MANY_RPS_CODE = 6
+# Ошибки VK, после которых токен временно не используется, и длительность карантина, с:
+# 5 - токен отозван или истек, 6 - слишком много запросов в секунду,
+# 9 - flood control, 29 - исчерпан суточный лимит метода
+QUARANTINE_SECONDS = {5: 3600, TOO_MANY_RPS_CODE: 1, 9: 600, 29: 3600}
+
+TOKEN_QUARANTINES = REGISTRY.counter(
+    "vkinder_token_quarantines", "Токены пользователя, временно исключенные из пула", ("token", "code")
+)
+
+
+class ApiUrlAdapter(HTTPAdapter):
+    """
+    Перенаправление запросов к api.vk.com на другой адрес.
+
+    Адрес https://api.vk.com/method/ зашит в VkApi.method, поэтому для работы
+    с тестовым сервером запросы подменяются на уровне транспорта requests.
+    """
+
+    def __init__(self, api_url, **kwargs):
+        super().__init__(**kwargs)
+        self.api_url = api_url
+
+    def send(self, request, **kwargs):
+        if request.url.startswith(VK_API_URL):
+            request.url = urljoin(self.api_url, request.url[len(VK_API_URL):])
+        return super().send(request, **kwargs)
+
+
+class InstrumentedVkApi(vk_api.VkApi):
+    """
+    VkApi, который считает вызовы методов, их время и ошибки.
+    Через него проходят и VkRequestsPool, и VkUpload.
+    """
+
+    def method(self, method, values=None, captcha_sid=None, captcha_key=None, raw=False):
+        with VK_CALL_SECONDS.time(method=method):
+            try:
+                response = super().method(method, values, captcha_sid, captcha_key, raw)
+            except ApiError as e:
+                VK_ERRORS.inc(method=method, code=e.code)
+                raise
+            except Exception:
+                VK_ERRORS.inc(method=method, code="network")
+                raise
+        if raw:
+            for error in response.get("execute_errors", ()):
+                VK_ERRORS.inc(method=error.get("method", method), code=error.get("error_code"))
+        return response
+
+
+def create_vk_session(token, api_url=None):
+    """
+    Сессия VkApi с токеном. Если указан api_url (например, VK_API_URL из .env),
+    все вызовы методов уходят на этот адрес, а не на api.vk.com.
+    """
+    vk_session = InstrumentedVkApi(token=token)
+    if api_url:
+        vk_session.http.mount(VK_API_URL, ApiUrlAdapter(api_url))
+        logging.info("Запросы к VK API направляются на %s", api_url)
+    return vk_session
+
+
+class PooledToken:
+    __slots__ = ("index", "session", "in_flight", "calls", "quarantined_until")
+
+    def __init__(self, index, session):
+        self.index = index
+        self.session = session
+        self.in_flight = 0
+        self.calls = 0
+        self.quarantined_until = 0.0
+
+
+class VkClientPool:
+    """
+    Пул сессий VK с несколькими токенами пользователя.
+
+    У каждого токена своя сессия VkApi и свое ограничение частоты запросов
+    (не больше 3 запросов в секунду на сессию). Вызов уходит токену с наименьшим
+    числом незавершенных вызовов среди доступных. Токен, получивший ошибку
+    авторизации или ограничения частоты, уходит на карантин, а вызов повторяется
+    с другим токеном. Поддерживает method и get_api, как VkApi, поэтому пул
+    можно передавать туда же, куда и сессию.
+    """
+
+    def __init__(self, tokens, api_url=None):
+        if not tokens:
+            raise ValueError("Нужен хотя бы один токен")
+        self.tokens = []
+        for index, token in enumerate(tokens):
+            session = create_vk_session(token, api_url)
+            # Превышение частоты обрабатывает пул: вызов уходит другому токену, а не ждет этот
+            session.error_handlers.pop(TOO_MANY_RPS_CODE, None)
+            self.tokens.append(PooledToken(index, session))
+        self.lock = threading.Lock()
+
+    def available(self):
+        now = time.monotonic()
+        return sum(1 for token in self.tokens if token.quarantined_until <= now)
+
+    def _acquire(self, tried):
+        with self.lock:
+            now = time.monotonic()
+            candidates = [
+                token for token in self.tokens
+                if token.quarantined_until <= now and token.index not in tried
+            ]
+            if not candidates and not tried:
+                # Все токены на карантине: пробуем тот, чей карантин закончится раньше
+                candidates = [min(self.tokens, key=lambda token: token.quarantined_until)]
+            if not candidates:
+                return None
+            token = min(candidates, key=lambda token: (token.in_flight, token.calls))
+            token.in_flight += 1
+            token.calls += 1
+            return token
+
+    def _release(self, token, error_code=None):
+        with self.lock:
+            token.in_flight -= 1
+            if error_code in QUARANTINE_SECONDS:
+                token.quarantined_until = time.monotonic() + QUARANTINE_SECONDS[error_code]
+
+    def method(self, method, values=None, captcha_sid=None, captcha_key=None, raw=False):
+        tried = set()
+        last_error = None
+        while True:
+            token = self._acquire(tried)
+            if token is None:
+                raise last_error
+            tried.add(token.index)
+            try:
+                response = token.session.method(method, values, captcha_sid, captcha_key, raw)
+            except ApiError as e:
+                if e.code not in QUARANTINE_SECONDS:
+                    self._release(token)
+                    raise
+                self._release(token, e.code)
+                TOKEN_QUARANTINES.inc(token=str(token.index), code=e.code)
+                logging.warning(
+                    "Токен пользователя #%s на карантине %s с после ошибки %s при вызове %s",
+                    token.index, QUARANTINE_SECONDS[e.code], e.code, method
+                )
+                last_error = e
+                continue
+            except Exception:
+                self._release(token)
+                raise
+            self._release(token)
+            return response
+
+    def get_api(self):
+        return VkApiMethod(self)
@@ -0,0 +1,185 @@
+import bisect
+import difflib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+import vk_api
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+RUSSIA_COUNTRY_ID = 1
+
+
+def normalize_city_name(name):
+    """
+    Приведение названия к виду для поиска: нижний регистр, ё -> е, одинарные пробелы и тире.
+    """
+    name = name.strip().lower().replace("ё", "е")
+    name = re.sub(r"\s*-\s*", "-", name)
+    return re.sub(r"\s+", " ", name)
+
+
+class CityIndex:
+    """
+    Локальный индекс городов VK: название -> числовой id для фильтра city в users.search.
+
+    Названия хранятся в отсортированном массиве, поэтому точный поиск и поиск
+    по префиксу выполняются двоичным поиском. Опечатки исправляются поиском
+    ближайших названий. Индекс загружается из файла, а если файла нет -
+    из database.getCities и сохраняется в файл.
+
+    Названия и города публикуются одним кортежем entries, поэтому читатели
+    без блокировки всегда видят согласованную пару массивов.
+    """
+
+    def __init__(self, cities=()):
+        self.lock = threading.Lock()
+        self.entries = ([], [])
+        self.add_cities(cities)
+
+    def __len__(self):
+        return len(self.entries[0])
+
+    def add_cities(self, cities):
+        with self.lock:
+            entries = dict(zip(*self.entries))
+            for city in cities:
+                # При совпадении названий остается первый город (database.getCities отдает крупные города первыми)
+                entries.setdefault(normalize_city_name(city["title"]), {"id": city["id"], "title": city["title"]})
+            names = sorted(entries)
+            self.entries = (names, [entries[name] for name in names])
+
+    def lookup(self, name):
+        """
+        Город с точно совпадающим названием или None.
+        """
+        name = normalize_city_name(name)
+        names, cities = self.entries
+        index = bisect.bisect_left(names, name)
+        if index < len(names) and names[index] == name:
+            return cities[index]
+        return None
+
+    def prefix(self, prefix, limit=5):
+        """
+        Города, название которых начинается с prefix.
+        """
+        prefix = normalize_city_name(prefix)
+        names, cities = self.entries
+        index = bisect.bisect_left(names, prefix)
+        result = []
+        while index < len(names) and names[index].startswith(prefix) and len(result) < limit:
+            result.append(cities[index])
+            index += 1
+        return result
+
+    def suggest(self, name, limit=3, cutoff=0.75):
+        """
+        Города с похожими названиями (для исправления опечаток).
+        """
+        names, cities = self.entries
+        matches = difflib.get_close_matches(normalize_city_name(name), names, n=limit, cutoff=cutoff)
+        return [cities[bisect.bisect_left(names, match)] for match in matches]
+
+    def resolve(self, name):
+        """
+        Поиск города по введенному тексту. Возвращает найденный город (или None)
+        и список подсказок, если точного совпадения нет.
+        """
+        city = self.lookup(name)
+        if city is not None:
+            return city, []
+        suggestions = self.suggest(name)
+        # Одна очень близкая подсказка считается опечаткой
+        if len(suggestions) == 1 and difflib.SequenceMatcher(
+                None, normalize_city_name(name), normalize_city_name(suggestions[0]["title"])).ratio() >= 0.85:
+            return suggestions[0], []
+        if not suggestions:
+            suggestions = self.prefix(name, limit=3)
+        return None, suggestions
+
+    def save(self, path):
+        """
+        Запись во временный файл и атомарная замена: другие процессы бота
+        никогда не прочитают наполовину записанный индекс.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self.entries[1], f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+
+def fetch_vk_cities(vk_session, country_id=RUSSIA_COUNTRY_ID, query=None, count=1000):
+    """
+    Список городов из database.getCities (основные города страны или поиск по названию).
+    """
+    vk = vk_session.get_api()
+    params = {"country_id": country_id, "count": count}
+    if query:
+        params["q"] = query
+        params["need_all"] = 1
+    cities = []
+    offset = 0
+    while True:
+        response = vk.database.getCities(offset=offset, **params)
+        cities.extend(response["items"])
+        offset += count
+        if query or offset >= response["count"]:
+            return cities
+
+
+def load_city_index(path, vk_session=None):
+    """
+    Загрузка индекса из файла или, если файла нет или он поврежден, из VK с сохранением в файл.
+    """
+    if os.path.exists(path):
+        try:
+            index = CityIndex.load(path)
+            logging.info("Загружен индекс городов: %s", len(index))
+            return index
+        except (ValueError, TypeError, KeyError) as e:
+            logging.error("Файл индекса городов %s поврежден: %s", path, e)
+
+    index = CityIndex()
+    if vk_session is None:
+        return index
+    try:
+        index.add_cities(fetch_vk_cities(vk_session))
+        index.save(path)
+        logging.info("Индекс городов получен из VK: %s", len(index))
+    except (vk_api.exceptions.ApiError, OSError) as e:
+        logging.error("Не удалось получить список городов: %s", e)
+    return index
+
+
+def resolve_city(index, name, vk_session=None):
+    """
+    Поиск города в индексе. Если город не найден и подсказок нет,
+    название ищется через database.getCities и найденные города добавляются в индекс.
+    """
+    city, suggestions = index.resolve(name)
+    if city is not None or suggestions or vk_session is None:
+        return city, suggestions
+    try:
+        found = fetch_vk_cities(vk_session, query=name, count=5)
+    except vk_api.exceptions.ApiError as e:
+        logging.error("Ошибка при поиске города %s: %s", name, e)
+        return None, []
+    index.add_cities(found)
+    city = index.lookup(name)
+    if city is not None:
+        return city, []
+    return None, [{"id": item["id"], "title": item["title"]} for item in found[:3]]
@@ -1,25 +1,52 @@
 import os
+import threading
 import vk_api
-from vk_api import VkApi
 from dotenv import load_dotenv
 import logging
-import time
+from vk_api.requests_pool import vk_request_one_param_pool
+from bot_runtime.vk_clients import VkClientPool, create_vk_session
+from bot_runtime.metrics import traced
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 load_dotenv()
 
-your_access_token = os.getenv("USER_TOKEN")
-vk_session = VkApi(token=your_access_token)
+_vk_session = None
+_vk_session_lock = threading.Lock()
 
+# Ширина, под которую выбирается размер фотографии; 0 - самый большой размер
+PHOTO_TARGET_WIDTH = int(os.getenv("PHOTO_TARGET_WIDTH", "807"))
+# Ширина типов размеров VK для старых фотографий, у которых width и height равны 0
+SIZE_TYPE_WIDTHS = {"s": 75, "m": 130, "x": 604, "y": 807, "z": 1080, "w": 2560}
+# Типы o, p, q, r - обрезанные копии для миниатюр, для показа анкеты не подходят
+CROPPED_SIZE_TYPES = frozenset("opqr")
 
-def search_vk_users(search_parameters):
+
+def get_vk_session():
     """
-    Поиск пользователей VK по параметрам
+    Сессия VK с токеном пользователя (USER_TOKEN), создается при первом обращении.
+    Если в USER_TOKENS через запятую указано несколько токенов - пул сессий с этими токенами.
+    """
+    global _vk_session
+    if _vk_session is None:
+        with _vk_session_lock:
+            if _vk_session is None:
+                api_url = os.getenv("VK_API_URL") or None
+                tokens = [token.strip() for token in os.getenv("USER_TOKENS", "").split(",") if token.strip()]
+                if len(tokens) > 1:
+                    _vk_session = VkClientPool(tokens, api_url)
+                    logging.info("Пул токенов пользователя: %s", len(tokens))
+                else:
+                    _vk_session = create_vk_session(tokens[0] if tokens else os.getenv("USER_TOKEN"), api_url)
+    return _vk_session
+
+
+def build_search_query(search_parameters, offset=0, count=10):
+    """
+    Параметры запроса users.search
     """
-    vk = vk_session.get_api()
-
     city = search_parameters.get("city", "")
+    city_id = search_parameters.get("city_id")
     gender = search_parameters.get("gender", "")
     age = search_parameters.get("age", "")
 
@@ -27,51 +54,113 @@ def search_vk_users(search_parameters):
     gender_value = gender_map.get(gender.lower(), 0)
 
     search_query = {
-        "hometown": city,
         "sex": gender_value,
         "age_from": age,
         "age_to": age,
-        "count": 10,
+        "offset": offset,
+        "count": count,
         "fields": "city, sex, bdate, photo_max"
     }
-    logging.info(f"Запуск поиска пользователей с параметрами: {search_query}")
+    # Фильтр по id города точнее и быстрее текстового поиска по hometown
+    if city_id:
+        search_query["city"] = city_id
+    else:
+        search_query["hometown"] = city
+    return search_query
+
+
+@traced("fetch_users_page")
+def fetch_users_page(search_parameters, offset=0, count=10):
+    """
+    Получение одной страницы результатов поиска вместе с фотографиями.
+    Возвращает список пользователей и общее количество найденных.
+    """
+    vk = get_vk_session().get_api()
+    search_query = build_search_query(search_parameters, offset, count)
+    logging.info("Запуск поиска пользователей с параметрами: %s", search_query)
 
     try:
         response = vk.users.search(**search_query)
         users = response["items"]
-        logging.info(f"Найдено {len(users)} пользователей")
+        logging.info("Найдено %s пользователей", len(users))
 
         filtered_users = [user for user in users if user.get("sex") in [1, 2]]
+        attach_top_photos(filtered_users)
 
-        # Для каждого пользователя получаем топ 3 фотографии
-        for user in filtered_users:
-            user_id = user["id"]
-            try:
-                photos = vk.photos.get(owner_id=user_id, album_id="profile", extended=1, count=10)
-                photos_items = photos["items"]
+        return filtered_users, response["count"]
 
-                # Выбираем фотографии с максимальным размером
-                max_size_photos = []
-                for photo in photos_items:
-                    max_size_photo = max(photo["sizes"], key=lambda size: size["width"] * size["height"])
-                    max_size_photos.append({
-                        "url": max_size_photo["url"],
-                        "likes": photo["likes"]["count"]
-                    })
+    except vk_api.exceptions.ApiError as e:
+        logging.error("Ошибка в работе VK API: %s", e)
+        return [], 0
 
-                # Сортируем фотографии по количеству лайков и выбираем топ 3
-                top_photos = sorted(max_size_photos, key=lambda x: x["likes"], reverse=True)[:3]
-                user["top_photos"] = [photo["url"] for photo in top_photos]
 
-                time.sleep(0.01)
+def size_width(size):
+    return size.get("width") or SIZE_TYPE_WIDTHS.get(size.get("type"), 0)
 
-            except vk_api.exceptions.ApiError as photo_error:
-                user["top_photos"] = []
-                logging.error(f"Ошибка при получении фотографий пользователя {user_id}: {photo_error}")
 
-        return filtered_users
+def select_photo_size(sizes, target_width=None):
+    """
+    Самый маленький размер фотографии, ширина которого не меньше target_width.
+    Если такого размера нет или target_width равен 0 - самый большой размер.
+    """
+    target_width = PHOTO_TARGET_WIDTH if target_width is None else target_width
+    candidates = [size for size in sizes if size.get("type") not in CROPPED_SIZE_TYPES] or sizes
+    suitable = [size for size in candidates if size_width(size) >= target_width] if target_width else []
+    if suitable:
+        return min(suitable, key=size_width)
+    return max(candidates, key=size_width)
 
-    except vk_api.exceptions.ApiError as e:
-        logging.error(f"Ошибка в работе VK API: {e}")
-        return []
 
+def top_photos_with_likes(photos_items, top=3, target_width=None):
+    """
+    Топ фотографий по количеству лайков: список словарей с url и likes.
+    """
+    # Для каждой фотографии берем размер, достаточный для показа в сообщении
+    sized_photos = []
+    for photo in photos_items:
+        sized_photos.append({
+            "url": select_photo_size(photo["sizes"], target_width)["url"],
+            "likes": photo["likes"]["count"]
+        })
+
+    # Сортируем фотографии по количеству лайков и выбираем топ 3
+    return sorted(sized_photos, key=lambda x: x["likes"], reverse=True)[:top]
+
+
+def attach_top_photos(users):
+    """
+    Получение топ 3 фотографий для каждого пользователя.
+
+    Запросы photos.get объединяются через метод execute (до 25 вызовов
+    за один запрос к API), поэтому 10 пользователей - это один запрос вместо десяти.
+    """
+    owner_ids = [user["id"] for user in users]
+    if not owner_ids:
+        return users
+
+    try:
+        photos_by_owner, errors = vk_request_one_param_pool(
+            get_vk_session().get_api(),
+            "photos.get",
+            key="owner_id",
+            values=owner_ids,
+            default_values={"album_id": "profile", "extended": 1, "count": 10}
+        )
+    except vk_api.exceptions.ApiError as e:
+        logging.error("Ошибка при получении фотографий пользователей: %s", e)
+        photos_by_owner, errors = {}, {}
+
+    for user in users:
+        user_id = user["id"]
+        photos = photos_by_owner.get(user_id)
+        if photos is None:
+            user["top_photos"] = []
+            user["photo_likes"] = 0
+            if user_id in errors:
+                logging.error("Ошибка при получении фотографий пользователя %s: %s", user_id, errors[user_id])
+            continue
+        top_photos = top_photos_with_likes(photos["items"])
+        user["top_photos"] = [photo["url"] for photo in top_photos]
+        # Лайки нужны для ранжирования анкет (finding_users/ranking.py)
+        user["photo_likes"] = sum(photo["likes"] for photo in top_photos)
+    return users
@@ -0,0 +1,102 @@
+import datetime
+import logging
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Признаки анкеты и их веса по умолчанию
+FEATURES = ("likes", "completeness", "city", "age")
+DEFAULT_WEIGHTS = {"likes": 1.0, "completeness": 0.5, "city": 1.0, "age": 1.0}
+# Стандартная заглушка VK вместо фотографии профиля
+NO_PHOTO_MARKERS = ("camera_", "/images/camera", "deactivated_")
+
+
+def parse_weights(text, defaults=DEFAULT_WEIGHTS):
+    """
+    Веса из строки вида "likes=1,city=2" (например, из RANKING_WEIGHTS в .env).
+    Не указанные признаки получают вес по умолчанию.
+    """
+    weights = dict(defaults)
+    for item in filter(None, (part.strip() for part in (text or "").split(","))):
+        name, _, value = item.partition("=")
+        if name.strip() not in FEATURES:
+            logging.warning("Неизвестный признак ранжирования: %s", name)
+            continue
+        weights[name.strip()] = float(value)
+    return weights
+
+
+def birth_year(bdate):
+    """
+    Год рождения из bdate VK ("д.м.гггг"); если год скрыт - None.
+    """
+    parts = (bdate or "").split(".")
+    if len(parts) == 3 and parts[2].isdigit():
+        return int(parts[2])
+    return None
+
+
+def extract_features(users, search_parameters, current_year=None):
+    """
+    Матрица признаков (пользователи x FEATURES), все значения в диапазоне [0, 1].
+    """
+    current_year = current_year or datetime.date.today().year
+    count = len(users)
+    # Признаки собираются по столбцам, дальше все вычисления идут над массивами целиком
+    likes = np.fromiter((user.get("photo_likes", 0) for user in users), float, count)
+    years = np.array([birth_year(user.get("bdate")) for user in users], dtype=float)
+    cities = [user.get("city") or {} for user in users]
+    city_ids = np.fromiter((city.get("id", 0) for city in cities), np.int64, count)
+    has_photo = np.fromiter(
+        (not any(marker in user.get("photo_max", "camera_") for marker in NO_PHOTO_MARKERS) for user in users),
+        bool, count
+    )
+    photo_count = np.fromiter((len(user.get("top_photos") or ()) for user in users), float, count)
+    filled = (~np.isnan(years)).astype(float) + (city_ids != 0) + has_photo + np.minimum(photo_count, 3) / 3
+
+    features = np.empty((count, len(FEATURES)))
+    # Лайки сильно различаются по порядку величины, поэтому берем логарифм
+    likes = np.log1p(likes)
+    features[:, 0] = likes / likes.max() if count and likes.max() > 0 else 0.0
+    features[:, 1] = filled / 4
+
+    city_id = search_parameters.get("city_id")
+    if city_id:
+        features[:, 2] = city_ids == int(city_id)
+    else:
+        city = str(search_parameters.get("city", "")).strip().casefold()
+        features[:, 2] = np.fromiter(
+            (str(item.get("title", "")).casefold() == city for item in cities), bool, count
+        ) if city else 0.0
+
+    try:
+        target_age = float(search_parameters.get("age"))
+    except (TypeError, ValueError):
+        target_age = np.nan
+    # Возраст по году рождения может отличаться от настоящего на год
+    difference = np.abs((current_year - years) - target_age)
+    proximity = 1.0 / (1.0 + np.maximum(difference - 1.0, 0.0))
+    # Скрытый возраст - нейтральное значение
+    features[:, 3] = np.where(np.isnan(proximity), 0.5, proximity)
+    return features
+
+
+def score_candidates(users, search_parameters, weights=None):
+    """
+    Оценка каждой анкеты: взвешенная сумма признаков.
+    """
+    weights = weights or DEFAULT_WEIGHTS
+    vector = np.array([weights.get(name, 0.0) for name in FEATURES])
+    return extract_features(users, search_parameters) @ vector
+
+
+def rank_candidates(users, search_parameters, weights=None):
+    """
+    Анкеты, упорядоченные по убыванию оценки. При равной оценке сохраняется порядок VK.
+    """
+    if len(users) < 2:
+        return list(users)
+    scores = score_candidates(users, search_parameters, weights)
+    order = np.argsort(-scores, kind="stable")
+    return [users[index] for index in order]
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from bot_runtime.metrics import cache_hit
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def search_key(search_parameters):
+    city = search_parameters.get("city_id") or str(search_parameters.get("city", "")).strip().lower()
+    gender = str(search_parameters.get("gender", "")).lower()
+    age = search_parameters.get("age", "")
+    return f"{city}|{gender}|{age}"
+
+
+def cache_key(search_parameters, offset, count):
+    return f"{search_key(search_parameters)}|{offset}|{count}"
+
+
+class SearchCache:
+    """
+    Общий кэш страниц поиска по ключу (город, пол, возраст, offset, count).
+
+    LRU в памяти процесса, за ним необязательная таблица search_cache в PostgreSQL
+    с TTL и ограничением числа строк. Одинаковые запросы, пришедшие одновременно,
+    объединяются: к VK уходит один запрос, остальные ждут его результат.
+    """
+
+    def __init__(self, loader, max_size=1000, ttl=900, persistent=False, max_rows=100000):
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.db = None
+        if persistent:
+            # Импорт здесь, чтобы кэш в памяти не требовал базы данных
+            from vkinder_db import vkinder_db
+            self.db = vkinder_db
+
+    def _get_local(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            page, created_at = entry
+            if time.time() - created_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return page
+
+    def _put_local(self, key, page):
+        with self.lock:
+            self.entries[key] = (page, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def _get_stored(self, key):
+        if self.db is None:
+            return None
+        try:
+            row = self.db.select_search_page(key, self.ttl)
+        except Exception as e:
+            logging.error("Ошибка при чтении кэша поиска: %s", e)
+            return None
+        if row is None:
+            return None
+        users, total = row
+        return users, total
+
+    def _store(self, key, page):
+        if self.db is None:
+            return
+        users, total = page
+        try:
+            self.db.upsert_search_page(key, json.dumps(users), total)
+        except Exception as e:
+            logging.error("Ошибка при записи в кэш поиска: %s", e)
+
+    def _load(self, key, search_parameters, offset, count):
+        page = self._get_stored(key)
+        if self.db is not None:
+            cache_hit("search_db", page is not None)
+        if page is None:
+            page = self.loader(search_parameters, offset, count)
+            users, total = page
+            # Пустой ответ может быть ошибкой API, его не кэшируем
+            if users:
+                self._store(key, page)
+        if page[0]:
+            self._put_local(key, page)
+        return page
+
+    def fetch_page(self, search_parameters, offset=0, count=10):
+        """
+        Страница результатов поиска: из кэша или от VK. Возвращает (users, total).
+        """
+        key = cache_key(search_parameters, offset, count)
+        page = self._get_local(key)
+        cache_hit("search", page is not None)
+        if page is not None:
+            return page
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            page = self._load(key, search_parameters, offset, count)
+            future.set_result(page)
+            return page
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    async def evict_expired(self):
+        """
+        Удаление устаревших записей из памяти, а из таблицы - еще и строк сверх max_rows.
+        """
+        deadline = time.time() - self.ttl
+        with self.lock:
+            expired = [key for key, (_, created_at) in self.entries.items() if created_at < deadline]
+            for key in expired:
+                del self.entries[key]
+        if self.db is not None:
+            return await asyncio.to_thread(self.db.trim_search_cache, self.ttl, self.max_rows)
+        return len(expired)
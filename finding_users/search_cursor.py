@@ -0,0 +1,120 @@
+import asyncio
+import logging
+
+from finding_users.parse_users_info import fetch_users_page
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# users.search отдает не больше 1000 результатов на запрос
+MAX_SEARCH_RESULTS = 1000
+
+
+class SearchCursor:
+    """
+    Постраничный курсор по результатам поиска.
+
+    Страницы users.search запрашиваются по offset. Следующая страница вместе
+    с фотографиями загружается в фоне, пока пользователь смотрит текущую анкету,
+    поэтому "Следующий" отвечает из буфера. Уже показанные анкеты не повторяются.
+    Если задан ranker, буфер упорядочивается по оценке анкет.
+    Если задан exclude (например, SeenFilter пользователя), анкеты из него
+    пропускаются, а показанные анкеты добавляются в него.
+    """
+
+    def __init__(self, search_parameters, page_size=20, prefetch_threshold=5,
+                 offset=0, total=None, buffer=None, seen=None, page_loader=None, ranker=None):
+        self.search_parameters = dict(search_parameters)
+        self.page_size = page_size
+        self.prefetch_threshold = prefetch_threshold
+        self.offset = offset
+        self.total = total
+        self.buffer = list(buffer or [])
+        self.seen = set(seen or [])
+        self.prefetch_task = None
+        # Не сохраняются в to_dict: подставляются владельцем курсора.
+        # Функция загрузки страницы (search_parameters, offset, count) -> (users, total),
+        # например SearchCache.fetch_page
+        self.page_loader = page_loader or fetch_users_page
+        # Функция ранжирования (users, search_parameters) -> users или None, чтобы сохранить порядок VK
+        self.ranker = ranker
+        self.exclude = None
+
+    @property
+    def exhausted(self):
+        """
+        True, если все страницы поиска уже запрошены.
+        """
+        limit = MAX_SEARCH_RESULTS if self.total is None else min(self.total, MAX_SEARCH_RESULTS)
+        return self.offset >= limit
+
+    def _start_prefetch(self):
+        if self.prefetch_task is None and not self.exhausted:
+            self.prefetch_task = asyncio.create_task(self._fetch_page())
+
+    async def _fetch_page(self):
+        users, total = await asyncio.to_thread(
+            self.page_loader, self.search_parameters, self.offset, self.page_size
+        )
+        # Страница может быть общей для нескольких курсоров (кэш), поэтому копируем
+        return [dict(user) for user in users], total
+
+    async def _take_page(self):
+        self._start_prefetch()
+        task = self.prefetch_task
+        if task is None:
+            return
+        try:
+            users, total = await task
+        finally:
+            self.prefetch_task = None
+        self.offset += self.page_size
+        # При ошибке API или пустой выдаче поиск считается законченным
+        self.total = total if users else 0
+        self.buffer.extend(users)
+        if self.ranker is not None:
+            # Еще не показанные анкеты ранжируются вместе с новой страницей
+            self.buffer = self.ranker(self.buffer, self.search_parameters)
+
+    async def next(self):
+        """
+        Следующая анкета или None, если анкеты закончились.
+        """
+        while True:
+            while not self.buffer:
+                if self.exhausted and self.prefetch_task is None:
+                    return None
+                await self._take_page()
+            user = self.buffer.pop(0)
+            # Страницы поиска могут пересекаться, повторы пропускаем
+            if user["id"] not in self.seen and (self.exclude is None or user["id"] not in self.exclude):
+                break
+
+        self.seen.add(user["id"])
+        if self.exclude is not None:
+            self.exclude.add(user["id"])
+        if len(self.buffer) <= self.prefetch_threshold:
+            self._start_prefetch()
+        return user
+
+    def close(self):
+        """
+        Отмена фоновой загрузки.
+        """
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+
+    def to_dict(self):
+        return {
+            "search_parameters": self.search_parameters,
+            "page_size": self.page_size,
+            "prefetch_threshold": self.prefetch_threshold,
+            "offset": self.offset,
+            "total": self.total,
+            "buffer": self.buffer,
+            "seen": list(self.seen),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
@@ -0,0 +1,266 @@
+import asyncio
+import hashlib
+import logging
+import math
+import struct
+import time
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+FORMAT_VERSION = 2
+# Версия формата, число слоев, начальная емкость и общая доля ложных срабатываний
+HEADER = struct.Struct("<BBId")
+# Емкость, размер в битах, число анкет, число хэшей и доля ложных срабатываний слоя
+LAYER_HEADER = struct.Struct("<IIIBd")
+# Формат 1 не хранил параметры фильтра и долю ложных срабатываний слоев
+HEADER_V1 = struct.Struct("<BB")
+LAYER_HEADER_V1 = struct.Struct("<IIIB")
+# После стольких записей в журнале seen_profiles_log он переносится в снимок фильтра
+COMPACT_AFTER = 256
+
+
+def _hashes(vk_id):
+    """
+    Два 64-битных хэша id анкеты; позиции в фильтре получаются как h1 + i * h2.
+    """
+    digest = hashlib.blake2b(int(vk_id).to_bytes(8, "little", signed=True), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+
+class BloomLayer:
+    """
+    Фильтр Блума фиксированного размера на bytearray.
+    """
+
+    __slots__ = ("capacity", "error_rate", "size", "hash_count", "count", "bits")
+
+    def __init__(self, capacity, error_rate, size=None, hash_count=None, count=0, bits=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        if size is None:
+            size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+            hash_count = max(1, round(size / capacity * math.log(2)))
+        self.size = size
+        self.hash_count = hash_count
+        self.count = count
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    def contains(self, h1, h2):
+        bits, size = self.bits, self.size
+        for _ in range(self.hash_count):
+            position = h1 % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            h1 += h2
+        return True
+
+    def add(self, h1, h2):
+        bits, size = self.bits, self.size
+        for _ in range(self.hash_count):
+            position = h1 % size
+            bits[position >> 3] |= 1 << (position & 7)
+            h1 += h2
+        self.count += 1
+
+
+class SeenFilter:
+    """
+    Множество уже показанных анкет одного пользователя бота.
+
+    Масштабируемый фильтр Блума: когда слой заполняется, добавляется новый
+    слой вдвое большей емкости и вдвое меньшей доли ложных срабатываний,
+    поэтому общая доля не превышает error_rate при любом числе анкет.
+    Память растет вместе с числом просмотренных анкет (2-3 байта на анкету),
+    а проверка занимает O(число слоев) на анкету.
+    Ложные срабатывания возможны (анкета будет пропущена, хотя ее не показывали),
+    пропусков показанных анкет нет. Новые анкеты, еще не записанные в базу,
+    копятся в pending.
+    """
+
+    def __init__(self, initial_capacity=1024, error_rate=0.005, layers=None):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.layers = layers or []
+        self.pending = set()
+        # Версия снимка в seen_profiles и число записей журнала на момент последнего чтения
+        self.version = None
+        self.logged = 0
+        self.used_at = time.time()
+
+    def __contains__(self, vk_id):
+        h1, h2 = _hashes(vk_id)
+        return any(layer.contains(h1, h2) for layer in self.layers)
+
+    def __len__(self):
+        return sum(layer.count for layer in self.layers)
+
+    @property
+    def nbytes(self):
+        return sum(len(layer.bits) for layer in self.layers)
+
+    def _insert(self, vk_id):
+        h1, h2 = _hashes(vk_id)
+        if any(layer.contains(h1, h2) for layer in self.layers):
+            return False
+        if not self.layers or self.layers[-1].count >= self.layers[-1].capacity:
+            capacity = self.initial_capacity * 2 ** len(self.layers)
+            error_rate = self.error_rate * 0.5 ** (len(self.layers) + 1)
+            self.layers.append(BloomLayer(capacity, error_rate))
+        self.layers[-1].add(h1, h2)
+        return True
+
+    def add(self, vk_id):
+        if not self._insert(vk_id):
+            return False
+        self.pending.add(vk_id)
+        return True
+
+    def merge(self, vk_ids):
+        """
+        Добавление анкет, уже записанных в базу (например, другим процессом бота).
+        """
+        for vk_id in vk_ids:
+            self._insert(vk_id)
+
+    def to_bytes(self):
+        parts = [HEADER.pack(FORMAT_VERSION, len(self.layers), self.initial_capacity, self.error_rate)]
+        for layer in self.layers:
+            parts.append(LAYER_HEADER.pack(
+                layer.capacity, layer.size, layer.count, layer.hash_count, layer.error_rate
+            ))
+            parts.append(bytes(layer.bits))
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = memoryview(data)
+        version = data[0]
+        if version == FORMAT_VERSION:
+            _, layer_count, initial_capacity, error_rate = HEADER.unpack_from(data)
+            offset = HEADER.size
+        elif version == 1:
+            _, layer_count = HEADER_V1.unpack_from(data)
+            initial_capacity, error_rate = 1024, 0.005
+            offset = HEADER_V1.size
+        else:
+            raise ValueError(f"Неизвестная версия фильтра: {version}")
+        layers = []
+        for _ in range(layer_count):
+            if version == FORMAT_VERSION:
+                capacity, size, count, hash_count, layer_rate = LAYER_HEADER.unpack_from(data, offset)
+                offset += LAYER_HEADER.size
+            else:
+                capacity, size, count, hash_count = LAYER_HEADER_V1.unpack_from(data, offset)
+                layer_rate = error_rate
+                offset += LAYER_HEADER_V1.size
+            length = (size + 7) // 8
+            bits = bytearray(data[offset:offset + length])
+            offset += length
+            layers.append(BloomLayer(capacity, layer_rate, size=size, hash_count=hash_count, count=count, bits=bits))
+        return cls(initial_capacity, error_rate, layers)
+
+
+def merge_snapshot(bits, vk_ids):
+    """
+    Снимок фильтра bits (или пустой фильтр) с добавленными анкетами vk_ids.
+    """
+    seen = SeenFilter.from_bytes(bits) if bits else SeenFilter()
+    seen.merge(vk_ids)
+    return seen.to_bytes()
+
+
+class SeenStore:
+    """
+    Фильтры показанных анкет активных пользователей (LRU в памяти)
+    с хранением в PostgreSQL.
+
+    Несколько процессов бота могут показывать анкеты одному пользователю,
+    поэтому фильтр в базе не перезаписывается целиком. Каждый процесс
+    дописывает новые id в журнал seen_profiles_log, а перед выбором анкеты
+    дочитывает журнал (и снимок фильтра, если его версия изменилась).
+    Когда журнал разрастается, он переносится в снимок seen_profiles
+    под блокировкой строки.
+    """
+
+    def __init__(self, max_size=10000, persistent=True):
+        self.max_size = max_size
+        self.filters = OrderedDict()
+        self.db = None
+        if persistent:
+            # Импорт здесь, чтобы хранилище в памяти не требовало базы данных
+            from vkinder_db import vkinder_db
+            self.db = vkinder_db
+
+    def _refresh(self, owner_id, seen):
+        version, bits, vk_ids = self.db.select_seen_state(owner_id, seen.version if seen is not None else None)
+        if seen is None or bits is not None or version != seen.version:
+            fresh = SeenFilter.from_bytes(bits) if bits else SeenFilter()
+            fresh.version = version
+            if seen is not None:
+                # Анкеты, которые еще не удалось записать в базу, не теряем
+                for vk_id in seen.pending:
+                    fresh.add(vk_id)
+            seen = fresh
+        seen.merge(vk_ids)
+        seen.logged = len(vk_ids)
+        return seen
+
+    async def get(self, owner_id):
+        seen = self.filters.get(owner_id)
+        if self.db is not None:
+            try:
+                seen = await asyncio.to_thread(self._refresh, owner_id, seen)
+            except Exception as e:
+                logging.error("Ошибка при чтении просмотренных анкет: %s", e)
+        if seen is None:
+            seen = SeenFilter()
+        self.filters[owner_id] = seen
+        self.filters.move_to_end(owner_id)
+        seen.used_at = time.time()
+        while len(self.filters) > self.max_size:
+            evicted_id, evicted = self.filters.popitem(last=False)
+            await self._store(evicted_id, evicted)
+        return seen
+
+    async def _store(self, owner_id, seen):
+        if not seen.pending:
+            return
+        if self.db is None:
+            seen.pending.clear()
+            return
+        vk_ids = list(seen.pending)
+        try:
+            await asyncio.to_thread(self.db.append_seen_ids, owner_id, vk_ids)
+        except Exception as e:
+            logging.error("Ошибка при сохранении просмотренных анкет: %s", e)
+            return
+        seen.pending.difference_update(vk_ids)
+        seen.logged += len(vk_ids)
+        if seen.logged >= COMPACT_AFTER:
+            try:
+                await asyncio.to_thread(self.db.compact_seen_filter, owner_id, merge_snapshot)
+                # Версия снимка изменилась: при следующем чтении он будет загружен заново
+                seen.logged = 0
+            except Exception as e:
+                logging.error("Ошибка при переносе журнала просмотренных анкет: %s", e)
+
+    async def save(self, owner_id):
+        """
+        Запись новых показанных анкет пользователя, если они есть.
+        """
+        seen = self.filters.get(owner_id)
+        if seen is not None:
+            await self._store(owner_id, seen)
+
+    async def evict_expired(self, idle=3600):
+        """
+        Выгрузка из памяти фильтров пользователей, которые давно не писали боту.
+        """
+        deadline = time.time() - idle
+        expired = [owner_id for owner_id, seen in self.filters.items() if seen.used_at < deadline]
+        for owner_id in expired:
+            seen = self.filters.pop(owner_id, None)
+            if seen is not None:
+                await self._store(owner_id, seen)
+        return len(expired)
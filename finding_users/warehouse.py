@@ -0,0 +1,52 @@
+import asyncio
+import logging
+
+from bot_runtime.metrics import cache_hit
+from finding_users.search_cache import search_key
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class CandidateWarehouse:
+    """
+    Локальное хранилище анкет в таблице found_users.
+
+    Каждая страница поиска, полученная от VK, записывается в found_users
+    одним запросом. Повторный поиск с теми же параметрами в течение ttl
+    читает страницы из базы без запросов к VK. Анкеты, которые не
+    обновлялись дольше retention и не добавлены в избранное, удаляются.
+    """
+
+    def __init__(self, loader, ttl=86400, retention=30 * 86400):
+        # Импорт здесь, чтобы модуль можно было импортировать без базы данных
+        from vkinder_db import vkinder_db
+        self.db = vkinder_db
+        self.loader = loader
+        self.ttl = ttl
+        self.retention = retention
+
+    def fetch_page(self, search_parameters, offset=0, count=10):
+        """
+        Страница результатов поиска: из found_users или от VK. Возвращает (users, total).
+        """
+        key = search_key(search_parameters)
+        try:
+            page = self.db.select_found_users_page(key, offset, count, self.ttl)
+        except Exception as e:
+            logging.error("Ошибка при чтении найденных пользователей: %s", e)
+            page = None
+        cache_hit("warehouse", page is not None)
+        if page is not None:
+            return page
+
+        users, total = self.loader(search_parameters, offset, count)
+        # Пустой ответ может быть ошибкой API, его не сохраняем
+        if users:
+            try:
+                self.db.upsert_found_users_page(key, search_parameters, offset, count, users, total)
+            except Exception as e:
+                logging.error("Ошибка при сохранении найденных пользователей: %s", e)
+        return users, total
+
+    async def evict_expired(self):
+        return await asyncio.to_thread(self.db.trim_found_users, self.retention)
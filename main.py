@@ -1,104 +1,199 @@
+import asyncio
+import functools
 import os
-from io import BytesIO
-import psycopg2
 import re
-import requests
-from vk_api.upload import VkUpload
+import signal
+from vk_api.exceptions import ApiError
 import vk_api
-from vk_api.longpoll import VkLongPoll, VkEventType
+from vk_api.longpoll import VkLongPoll
 from vk_api.utils import get_random_id
-from vk_api.keyboard import VkKeyboard, VkKeyboardColor
 from dotenv import load_dotenv
-from finding_users.parse_users_info import search_vk_users
-from vkinder_db.vkinder_db import insert_data_found_users, insert_data_favorites, select_favorites, clear_favorites
+from finding_users.parse_users_info import fetch_users_page, get_vk_session
+from finding_users.city_index import load_city_index, resolve_city
+from finding_users.search_cache import SearchCache
+from finding_users.search_cursor import SearchCursor
+from finding_users.seen_filter import SeenStore
+from finding_users.warehouse import CandidateWarehouse
+from finding_users.ranking import parse_weights, rank_candidates
+from vkinder_db.vkinder_db import add_to_favorites, select_favorites, clear_favorites, migrate
+from bot_runtime.async_runtime import AsyncVkApi, UserDispatcher, listen_longpoll
+from bot_runtime.callback_server import serve_callback
+from bot_runtime.vk_clients import VkClientPool, create_vk_session
+from bot_runtime.outbox import Outbox
+from bot_runtime.sessions import create_session_store, evict_periodically
+from bot_runtime.attachment_cache import AttachmentCache
+from bot_runtime.assets import AssetRegistry
+from bot_runtime.keyboards import KEYBOARDS
+from bot_runtime.photo_pipeline import PhotoPipeline
+from bot_runtime.conversation import ButtonVK, IDLE, CITY, AGE, build_state_machine
+from bot_runtime import metrics
+from bot_runtime.startup import StartupTimer
+from bot_runtime.supervisor import Supervisor, consume_events
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 load_dotenv()
 vk_token = os.getenv("TOKEN_VK")
 
-authorize = vk_api.VkApi(token=vk_token)
-longpoll = VkLongPoll(authorize)
-search_parameters = {"city": "", "gender": "", "age": ""}  # параметры, которые передадим в функцию поиска
-
-connection = psycopg2.connect(
-    host=os.getenv("HOST"),
-    user=os.getenv("LOGIN"),
-    password=os.getenv("PASSWORD"),
-    database=os.getenv("NAME_DB")
+# VK_API_URL позволяет направить все запросы на тестовый сервер (benchmarks/fake_vk_server.py)
+vk_api_url = os.getenv("VK_API_URL") or None
+# Источник событий: longpoll (один процесс) или callback (HTTP-сервер, можно запускать несколько копий)
+bot_mode = os.getenv("BOT_MODE", "longpoll")
+# Максимальное количество вложений в одном сообщении VK
+MAX_ATTACHMENTS = 10
+favorites_page_size = int(os.getenv("FAVORITES_PAGE_SIZE", "10"))
+city_index_path = os.getenv(
+    "CITY_INDEX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "finding_users/cities.json")
 )
-connection.autocommit = True
-
-
-class ButtonVK:
-    start = "Начать подбор"
-    finish = "Завершить"
-    lets_go = "Привет! Я - бот VKinder, который поможет тебе подобрать пару."
-    enter_city = "Введите город для поиска:"
-    right_city = "Да, верно"
-    modify_city = "Изменить город"
-    boy = "Парень"
-    girl = "Девушка"
-    all_true = "Все верно"
-    change_parameters = "Изменить параметры"
-    city = "Город"
-    age = "Возраст"
-    gender = "Пол"
-    next = "Следующий"
-    add_favourites = "Добавить в избранное"
-    all_fovourites = "Избранное"
-    display = "Начать показ"
-    clear_favourites = "Очистить избранное"
-
-
-def write_message(sender, message, keyboard=None, attachments=None):
-    logging.info(f'Отправка сообщения пользователю: {sender}')
+banner_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vkinder_pics/VKinder_banner.png")
+
+# Клиенты и хранилища создаются в bootstrap(): импорт модуля не обращается ни к VK, ни к базе данных
+authorize = None
+vk = None
+outbox = None
+sessions = None
+attachments_cache = None
+search_cache = None
+# Загрузка страниц поиска для SearchCursor (кэш и хранилище анкет)
+search_page_loader = fetch_users_page
+# Ранжирование анкет поиска (RANKING=1) или None, чтобы сохранить порядок VK
+search_ranker = None
+warehouse = None
+seen_profiles = None
+photo_pipeline = None
+assets = None
+city_index = None
+
+
+async def bootstrap(timer, worker_count=1):
+    """
+    Создание клиентов, применение миграций и загрузка данных, нужных боту для работы.
+    В режиме нескольких процессов лимит запросов к VK делится между ними.
+    """
+    global authorize, vk, outbox, sessions, attachments_cache, search_cache, seen_profiles, photo_pipeline, assets
+    global city_index, warehouse, search_page_loader, search_ranker
+
+    with timer.step("clients"):
+        authorize = create_vk_session(vk_token, vk_api_url)
+        vk = AsyncVkApi(
+            authorize,
+            rps=max(1, int(os.getenv("VK_RPS", "20")) // worker_count),
+            api_url=vk_api_url,
+            blocking_workers=int(os.getenv("BLOCKING_WORKERS", "32"))
+        )
+        outbox = Outbox(vk)
+        photo_pipeline = PhotoPipeline(
+            vk.blocking(),
+            download_workers=int(os.getenv("PHOTO_DOWNLOAD_WORKERS", "8")),
+            upload_workers=int(os.getenv("PHOTO_UPLOAD_WORKERS", "4")),
+            resize_width=int(os.getenv("PHOTO_RESIZE_WIDTH") or 0) or None,
+            resize_workers=int(os.getenv("PHOTO_RESIZE_WORKERS", "2")),
+            jpeg_quality=int(os.getenv("PHOTO_JPEG_QUALITY", "85"))
+        )
+
+    with timer.step("migrations"):
+        await asyncio.to_thread(migrate)
+
+    with timer.step("stores"):
+        sessions = create_session_store(
+            backend=os.getenv("SESSION_BACKEND", "memory"),
+            ttl=int(os.getenv("SESSION_TTL", "3600")),
+            max_size=int(os.getenv("SESSION_MAX_SIZE", "10000")),
+            lock_timeout=int(os.getenv("SESSION_LOCK_TIMEOUT", "60"))
+        )
+        attachments_cache = AttachmentCache(
+            max_size=int(os.getenv("ATTACHMENT_CACHE_SIZE", "5000")),
+            ttl=int(os.getenv("ATTACHMENT_CACHE_TTL", str(7 * 24 * 3600)))
+        )
+        page_loader = fetch_users_page
+        if os.getenv("WAREHOUSE", "1") == "1":
+            warehouse = CandidateWarehouse(
+                fetch_users_page,
+                ttl=int(os.getenv("WAREHOUSE_TTL", "86400")),
+                retention=int(os.getenv("WAREHOUSE_RETENTION", str(30 * 86400)))
+            )
+            page_loader = warehouse.fetch_page
+        search_cache = SearchCache(
+            page_loader,
+            max_size=int(os.getenv("SEARCH_CACHE_SIZE", "1000")),
+            ttl=int(os.getenv("SEARCH_CACHE_TTL", "900")),
+            persistent=os.getenv("SEARCH_CACHE_BACKEND", "memory") == "postgres"
+        )
+        search_page_loader = search_cache.fetch_page
+        seen_profiles = SeenStore(
+            max_size=int(os.getenv("SEEN_CACHE_SIZE", "10000")),
+            persistent=os.getenv("SEEN_BACKEND", "postgres") == "postgres"
+        )
+        if os.getenv("RANKING", "1") == "1":
+            weights = parse_weights(os.getenv("RANKING_WEIGHTS"))
+            search_ranker = functools.partial(rank_candidates, weights=weights)
+
+    with timer.step("city_index"):
+        city_index = await vk.run(load_city_index, city_index_path, get_vk_session())
+
+    with timer.step("assets"):
+        assets = AssetRegistry(authorize, attachments_cache)
+        assets.register("banner", banner_path)
+        await vk.run(assets.load_all)
+
+
+@metrics.traced("write_message")
+async def write_message(sender, message, keyboard=None, attachments=None):
+    logging.debug('Отправка сообщения пользователю: %s', sender)
     param = {
         "user_id": sender,
         "message": message,
         "random_id": get_random_id(),
     }
     if keyboard is not None:
-        param["keyboard"] = keyboard.get_keyboard()
-    if attachments is not None:
+        # Клавиатура передается готовой JSON-строкой из KEYBOARDS
+        param["keyboard"] = keyboard if isinstance(keyboard, str) else keyboard.get_keyboard()
+    if attachments:
         param["attachment"] = attachments
 
-    authorize.method("messages.send", param)
+    await outbox.send(param)
 
 
-def start(user_id):
-    logging.info(f'Начали общение с пользователем: {user_id}')
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button(ButtonVK.start, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.finish, VkKeyboardColor.NEGATIVE)
+async def start(user_id):
+    logging.info('Начали общение с пользователем: %s', user_id)
+    # Приветственная картинка загружена один раз при запуске бота
+    photo_id = assets.get("banner")
+    message = "Привет! Я - бот VKinder, который поможет тебе подобрать пару."
+    try:
+        await write_message(user_id, message, KEYBOARDS["start"], photo_id)
+    except ApiError as e:
+        if photo_id is None:
+            raise
+        logging.warning("Не удалось отправить приветственную картинку: %s", e)
+        photo_id = await vk.run(assets.reload, "banner")
+        await write_message(user_id, message, KEYBOARDS["start"], photo_id)
 
-    # Загружаем и отправляем приветственную картинку
-    photo_path = "vkinder_pics/VKinder_banner.png"
-    upload = VkUpload(authorize)
-    photo_id = upload_photo(upload, photo_path)
 
-    write_message(user_id, "Привет! Я - бот VKinder, который поможет тебе подобрать пару.", keyboard, photo_id)
+async def finish(user_id):
+    logging.info('Закончили общение с пользователем: %s', user_id)
+    await write_message(user_id, "До новых встреч!")
 
 
-def finish(user_id):
-    logging.info(f'Закончили общение с пользователем: {user_id}')
-    write_message(user_id, "До новых встреч!")
+async def city(user_id):
+    logging.info('Запросили город для пользователя: %s', user_id)
+    keyboard = KEYBOARDS["city"]
+    await write_message(user_id, "Введите город для поиска:", keyboard)
 
 
-def city(user_id):
-    logging.info(f'Запросили город для пользователя: {user_id}')
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button(ButtonVK.finish, VkKeyboardColor.NEGATIVE)
-    write_message(user_id, "Введите город для поиска:", keyboard)
+async def city_confirm(user_id, city):
+    keyboard = KEYBOARDS["city_confirm"]
+    await write_message(user_id, f"Начать поиск в городе {city}?", keyboard)
 
 
-def city_confirm(user_id, city):
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button(ButtonVK.right_city, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.modify_city, VkKeyboardColor.PRIMARY)
-    keyboard.add_line()
-    keyboard.add_button(ButtonVK.finish, VkKeyboardColor.NEGATIVE)
-    write_message(user_id, f"Начать поиск в городе {city.capitalize()}?", keyboard)
+async def city_suggestions(user_id, suggestions):
+    keyboard = KEYBOARDS["city"]
+    if suggestions:
+        titles = ", ".join(city["title"] for city in suggestions)
+        message = f"Такой город не найден. Возможно, вы имели в виду: {titles}? Введите название еще раз:"
+    else:
+        message = "Такой город не найден. Проверьте название и введите его еще раз:"
+    await write_message(user_id, message, keyboard)
 
 
 def validate_city_name(city_name):
@@ -109,19 +204,15 @@ def validate_city_name(city_name):
     return bool(pattern.match(city_name))
 
 
-def gender(user_id):
-    logging.info(f'Запросили пол для пользователя: {user_id}')
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button(ButtonVK.boy, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.girl, VkKeyboardColor.PRIMARY)
-    keyboard.add_line()
-    keyboard.add_button(ButtonVK.finish, VkKeyboardColor.NEGATIVE)
-    write_message(user_id, "Кто вам нужен?", keyboard)
+async def gender(user_id):
+    logging.info('Запросили пол для пользователя: %s', user_id)
+    keyboard = KEYBOARDS["gender"]
+    await write_message(user_id, "Кто вам нужен?", keyboard)
 
 
-def age(user_id):
-    logging.info(f'Запросили возраст для пользователя: {user_id}')
-    write_message(user_id, "укажите возраст")
+async def age(user_id):
+    logging.info('Запросили возраст для пользователя: %s', user_id)
+    await write_message(user_id, "укажите возраст")
 
 
 def get_year_word(age):
@@ -136,247 +227,449 @@ def get_year_word(age):
         return "лет"
 
 
-def data_confirm(user_id, gender, city, age):
-    logging.info(f'Получили данные для пользователя: {user_id}: {gender}, {city}, {age}')
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button(ButtonVK.all_true, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.change_parameters, VkKeyboardColor.PRIMARY)
-    keyboard.add_line()
-    keyboard.add_button(ButtonVK.finish, VkKeyboardColor.NEGATIVE)
+async def data_confirm(user_id, gender, city, age):
+    logging.info('Получили данные для пользователя: %s: %s, %s, %s', user_id, gender, city, age)
+    keyboard = KEYBOARDS["data_confirm"]
     get_year_word(age)
     year_word = get_year_word(age)
-    write_message(user_id, f"Требуется {gender} из города {city.capitalize()} возраст {age}" + " " + year_word + "?",
-                  keyboard)
-
-
-def data_modify(user_id):
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button(ButtonVK.city, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.age, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.gender, VkKeyboardColor.PRIMARY)
-    keyboard.add_line()
-    keyboard.add_button(ButtonVK.finish, VkKeyboardColor.NEGATIVE)
-    write_message(user_id, "Что изменить?", keyboard)
+    message = f"Требуется {gender} из города {city} возраст {age} {year_word}?"
+    await write_message(user_id, message, keyboard)
 
 
-def navigation(user_id):
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button(ButtonVK.next, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.add_favourites, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.all_fovourites, VkKeyboardColor.PRIMARY)
-    keyboard.add_line()
-    keyboard.add_button(ButtonVK.finish, VkKeyboardColor.NEGATIVE)
-    write_message(user_id, "-----------------готово----------------", keyboard)
+async def data_modify(user_id):
+    keyboard = KEYBOARDS["data_modify"]
+    await write_message(user_id, "Что изменить?", keyboard)
 
 
-def navigation_for_added_user_and_favourites(user_id):
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button(ButtonVK.next, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.all_fovourites, VkKeyboardColor.PRIMARY)
-    keyboard.add_line()
-    keyboard.add_button(ButtonVK.finish, VkKeyboardColor.NEGATIVE)
+async def navigation(user_id):
+    keyboard = KEYBOARDS["navigation"]
+    await write_message(user_id, "-----------------готово----------------", keyboard)
 
 
-def display_user(user_id, user):
-    logging.info(f'Показываем пользователя: {user["id"]} пользователю {user_id}')
-
+def profile_text(user):
     vk_id = user["id"]
     first_name = user.get("first_name", "Неизвестно")
     last_name = user.get("last_name", "Неизвестно")
     profile_url = f"https://vk.com/id{vk_id}"
-    top_photos = user.get("top_photos", [])
+    return f"{first_name} {last_name}\nПрофиль: {profile_url}\n"
+
 
-    message = f"{first_name} {last_name}\nПрофиль: {profile_url}\n"
+async def send_with_photos(user_id, message, photo_urls, keyboard=None):
+    """
+    Отправка сообщения с фотографиями по их URL.
+    """
+    attachment_strings = await vk.run(upload_photos, user_id, photo_urls)
+    try:
+        await write_message(user_id, message, keyboard, ",".join(attachment_strings))
+    except ApiError as e:
+        # Вложение из кэша могло стать недоступным: сбрасываем кэш и загружаем заново
+        logging.warning("Не удалось отправить вложения пользователю %s: %s", user_id, e)
+        for url in photo_urls:
+            attachments_cache.invalidate(url)
+        attachment_strings = await vk.run(upload_photos, user_id, photo_urls)
+        await write_message(user_id, message, keyboard, ",".join(attachment_strings))
+
+
+async def display_user(user_id, user):
+    logging.info('Показываем пользователя: %s пользователю %s', user["id"], user_id)
+
+    message = profile_text(user)
+    top_photos = user.get("top_photos", [])
 
     if top_photos:
         # Загрузка фотографий и получение вложений
-        photo_attachments = upload_photos(user_id, top_photos)
-        attachment_strings = [
-            f"photo{photo['owner_id']}_{photo['id']}" for photo in photo_attachments
-        ]
-        write_message(user_id, message, attachments=",".join(attachment_strings))
+        await send_with_photos(user_id, message, top_photos)
     else:
         message += "Нет доступных фотографий."
-        write_message(user_id, message)
-    navigation(user_id)
+        await write_message(user_id, message)
+    await navigation(user_id)
+
+
+def pack_profiles(users, max_attachments=MAX_ATTACHMENTS):
+    """
+    Группировка анкет в сообщения так, чтобы в каждом было не больше
+    max_attachments фотографий. Возвращает список (текст, список URL фотографий).
+    """
+    messages = []
+    lines, photos = [], []
+    for user in users:
+        user_photos = user.get("top_photos", [])[:max_attachments]
+        if lines and len(photos) + len(user_photos) > max_attachments:
+            messages.append(("\n".join(lines), photos))
+            lines, photos = [], []
+        lines.append(profile_text(user))
+        photos.extend(user_photos)
+    if lines:
+        messages.append(("\n".join(lines), photos))
+    return messages
+
+
+async def display_favorites(user_id, favorites, has_more=False):
+    """
+    Показ страницы избранного: несколько анкет в одном сообщении,
+    клавиатура навигации прикрепляется к последнему сообщению страницы.
+    """
+    if not favorites:
+        await write_message(user_id, "Избранных пользователей нет.")
+        await navigation(user_id)
+        return
+
+    # Фотографии всей страницы загружаются одной пачкой, дальше берутся из кэша
+    await vk.run(upload_photos, user_id, [url for user in favorites for url in user.get("top_photos", [])])
+
+    messages = pack_profiles(favorites)
+    for index, (message, photo_urls) in enumerate(messages):
+        keyboard = None
+        if index == len(messages) - 1:
+            keyboard = KEYBOARDS["navigation_for_favorites_more" if has_more else "navigation_for_favorites"]
+        if photo_urls:
+            await send_with_photos(user_id, message, photo_urls, keyboard)
+        else:
+            await write_message(user_id, message, keyboard)
 
 
-def display_favorites(user_id, favorites):
-    if favorites:
-        for user in favorites:
-            display_user(user_id, user)
-        navigation_for_favorites(user_id)
+async def on_begin(session, msg):
+    await start(session.user_id)
+
+
+async def on_finish(session, msg):
+    await finish(session.user_id)
+
+
+async def on_ask_city(session, msg):
+    await city(session.user_id)
+
+
+async def on_city_entered(session, msg):
+    if not validate_city_name(msg):
+        await write_message(session.user_id, "Название города может содержать только буквы, пробелы и тире.",
+                            KEYBOARDS["city"])
+        return session.flag
+
+    if not city_index:
+        # Индекс недоступен: ищем по тексту, как раньше
+        session.pending_city, session.pending_city_id = msg.strip().capitalize(), None
     else:
-        write_message(user_id, "Избранных пользователей нет.")
-        navigation(user_id)
+        found, suggestions = await vk.run(resolve_city, city_index, msg, get_vk_session())
+        if found is None:
+            await city_suggestions(session.user_id, suggestions)
+            return session.flag
+        session.pending_city, session.pending_city_id = found["title"], found["id"]
+    await city_confirm(session.user_id, session.pending_city)
 
 
-def navigation_for_favorites(user_id):
-    keyboard = VkKeyboard(one_time=True)
-    keyboard.add_button(ButtonVK.next, VkKeyboardColor.PRIMARY)
-    keyboard.add_button(ButtonVK.clear_favourites, VkKeyboardColor.NEGATIVE)
-    keyboard.add_line()
-    keyboard.add_button(ButtonVK.finish, VkKeyboardColor.NEGATIVE)
-    write_message(user_id, "--------------конец списка-------------", keyboard)
+async def on_city_saved(session, msg):
+    session.city, session.city_id = session.pending_city, session.pending_city_id
+    await gender(session.user_id)
 
 
-def main():
-    logging.info("Бот запущен")
-    search_parameters = {"city": "", "gender": "", "age": ""}
-    flag = ""
-    search_results = []
-    current_index = 0
-
-    for event in longpoll.listen():
-        if event.type == VkEventType.MESSAGE_NEW and event.to_me:
-            msg = event.text
-            user_id = event.user_id
-
-            if msg == "Начать":
-                start(user_id)
-
-            elif msg == ButtonVK.finish:
-                finish(user_id)
-
-            elif msg == ButtonVK.start:
-                city(user_id)
-                flag = "city"
-
-            elif flag == "city":
-                city_confirm(user_id, msg)
-                flag = msg
-
-            elif msg == ButtonVK.right_city and flag != "data confirm":
-                city_search = flag
-                search_parameters["city"] = city_search.capitalize()
-                flag = "gender"
-                gender(user_id)
-
-            elif msg == ButtonVK.modify_city:
-                city(user_id)
-                if search_parameters["gender"] == "":
-                    flag = "city"
-                else:
-                    flag = "modify city"
-
-            elif msg == ButtonVK.boy and flag != "modify gender":
-                gender_search = msg
-                search_parameters["gender"] = "male"
-                age(user_id)
-                flag = "age"
-
-            elif msg == ButtonVK.girl and flag != "modify gender":
-                gender_search = msg
-                search_parameters["gender"] = "female"
-                age(user_id)
-                flag = "age"
-
-            elif msg == ButtonVK.boy and flag == "modify gender":
-                gender_search = msg
-                search_parameters["gender"] = "male"
-                flag = "data confirm"
-                data_confirm(user_id, gender_search, city_search, age_search)
-
-            elif msg == ButtonVK.girl and flag == "modify gender":
-                gender_search = msg
-                search_parameters["gender"] = "female"
-                flag = "data confirm"
-                data_confirm(user_id, gender_search, city_search, age_search)
-
-            elif flag == "age":
-                try:
-                    age_search = int(msg)
-                    search_parameters["age"] = age_search
-                    flag = "data confirm"
-                    data_confirm(user_id, gender_search, city_search, age_search)
-                except ValueError:
-                    write_message(user_id, "Пожалуйста, введите корректный возраст")
-
-            elif msg == ButtonVK.all_true and flag == "data confirm":
-                write_message(user_id, "Ищу подходящие анкеты...")
-                search_results = search_vk_users(search_parameters)
-                if search_results:
-                    display_user(user_id, search_results[0])
-                    flag = "navigation"
-                else:
-                    write_message(user_id, "Не найдено пользователей по данным параметрам.")
-                    start(user_id)
-
-            elif msg == ButtonVK.change_parameters and flag == "data confirm":
-                data_modify(user_id)
-
-            elif msg == ButtonVK.city:
-                city(user_id)
-                flag = "modify city"
-
-            elif msg == ButtonVK.age:
-                age(user_id)
-                flag = "age"
-
-            elif msg == ButtonVK.gender:
-                gender(user_id)
-                flag = "modify gender"
-
-            elif msg == ButtonVK.next and flag == "navigation":
-                current_index = (current_index + 1) % len(search_results)
-                display_user(user_id, search_results[current_index])
-
-            elif msg == ButtonVK.add_favourites and flag == "navigation":
-                user_id_db = insert_data_found_users(
-                    vk_id=search_results[current_index]["id"],
-                    first_name=search_results[current_index].get("first_name", "Неизвестно"),
-                    last_name=search_results[current_index].get("last_name", "Неизвестно"),
-                    city=search_parameters["city"],
-                    gender=search_parameters["gender"],
-                    age=search_parameters["age"],
-                    top_photos=search_results[current_index].get("top_photos", [])
-                )
-                insert_data_favorites(user_id_db)
-                write_message(user_id, "Пользователь добавлен в избранное")
-                navigation(user_id)
-
-            elif msg == ButtonVK.all_fovourites:
-                favorites = select_favorites()
-                display_favorites(user_id, favorites)
-
-            elif msg == ButtonVK.clear_favourites:
-                clear_favorites()
-                write_message(user_id, "Избранное очищено.")
-                navigation(user_id)
-
-def upload_photo(upload, photo_path):
+async def on_city_updated(session, msg):
+    session.city, session.city_id = session.pending_city, session.pending_city_id
+    await data_confirm(session.user_id, session.gender_label, session.city, session.age)
+
+
+async def on_modify_city(session, msg):
+    await city(session.user_id)
+    if session.gender == "":
+        return CITY
+
+
+async def on_gender_chosen(session, msg):
+    session.gender_label = msg
+    session.gender = "male" if msg == ButtonVK.boy else "female"
+    await age(session.user_id)
+
+
+async def on_gender_updated(session, msg):
+    session.gender_label = msg
+    session.gender = "male" if msg == ButtonVK.boy else "female"
+    await data_confirm(session.user_id, session.gender_label, session.city, session.age)
+
+
+async def on_ask_gender(session, msg):
+    await gender(session.user_id)
+
+
+async def on_ask_age(session, msg):
+    await age(session.user_id)
+
+
+async def on_age_entered(session, msg):
     try:
-        photo = upload.photo_messages(photo_path)[0]
-        return f"photo{photo['owner_id']}_{photo['id']}"
-    except Exception as e:
-        logging.error(f"Ошибка при загрузке изображения: {e}")
+        session.age = int(msg)
+    except ValueError:
+        await write_message(session.user_id, "Пожалуйста, введите корректный возраст")
+        return AGE
+    await data_confirm(session.user_id, session.gender_label, session.city, session.age)
+
+
+async def on_data_modify(session, msg):
+    await data_modify(session.user_id)
+
+
+async def next_candidate(session):
+    """
+    Следующая анкета поиска, которую пользователь еще не видел (в том числе в прошлых поисках).
+    """
+    cursor = session.cursor
+    # Курсор, восстановленный из сессии, не хранит функции загрузки и ранжирования и показанные анкеты
+    cursor.page_loader = search_page_loader
+    cursor.ranker = search_ranker
+    cursor.exclude = await seen_profiles.get(session.user_id)
+    return await cursor.next()
+
+
+async def on_search(session, msg):
+    user_id = session.user_id
+    await write_message(user_id, "Ищу подходящие анкеты...")
+    if session.cursor is not None:
+        session.cursor.close()
+    session.cursor = SearchCursor(
+        session.search_parameters,
+        page_size=int(os.getenv("SEARCH_PAGE_SIZE", "20")),
+        page_loader=search_page_loader,
+        ranker=search_ranker
+    )
+    session.current_user = await next_candidate(session)
+    if session.current_user is not None:
+        await display_user(user_id, session.current_user)
         return None
+    await write_message(user_id, "Не найдено пользователей по данным параметрам.")
+    await start(user_id)
+    return IDLE
+
+
+async def on_next(session, msg):
+    session.current_user = await next_candidate(session)
+    if session.current_user is not None:
+        await display_user(session.user_id, session.current_user)
+        return None
+    await write_message(session.user_id, "Подходящие анкеты закончились.")
+    await start(session.user_id)
+    return IDLE
+
+
+async def on_add_favourite(session, msg):
+    current_user = session.current_user
+    user_id_db, inserted = await vk.run(
+        add_to_favorites,
+        session.user_id,
+        current_user["id"],
+        current_user.get("first_name", "Неизвестно"),
+        current_user.get("last_name", "Неизвестно"),
+        session.city,
+        session.gender,
+        session.age,
+        current_user.get("top_photos", [])
+    )
+    if user_id_db is None:
+        await write_message(session.user_id, "Не удалось добавить пользователя в избранное")
+    elif inserted:
+        await write_message(session.user_id, "Пользователь добавлен в избранное")
+    else:
+        await write_message(session.user_id, "Пользователь уже в избранном")
+    await navigation(session.user_id)
+
+
+async def show_favorites_page(session, after):
+    favorites, session.favorites_after = await vk.run(
+        select_favorites, session.user_id, favorites_page_size, after
+    )
+    await display_favorites(session.user_id, favorites, session.favorites_after is not None)
+
+
+async def on_show_favorites(session, msg):
+    await show_favorites_page(session, None)
+
+
+async def on_more_favorites(session, msg):
+    if session.favorites_after is None:
+        await on_show_favorites(session, msg)
+    else:
+        await show_favorites_page(session, session.favorites_after)
+
+
+async def on_clear_favorites(session, msg):
+    await vk.run(clear_favorites, session.user_id)
+    session.favorites_after = None
+    await write_message(session.user_id, "Избранное очищено.")
+    await navigation(session.user_id)
+
+
+machine = build_state_machine({
+    "on_begin": on_begin,
+    "on_finish": on_finish,
+    "on_ask_city": on_ask_city,
+    "on_city_entered": on_city_entered,
+    "on_city_saved": on_city_saved,
+    "on_city_updated": on_city_updated,
+    "on_modify_city": on_modify_city,
+    "on_gender_chosen": on_gender_chosen,
+    "on_gender_updated": on_gender_updated,
+    "on_ask_gender": on_ask_gender,
+    "on_ask_age": on_ask_age,
+    "on_age_entered": on_age_entered,
+    "on_data_modify": on_data_modify,
+    "on_search": on_search,
+    "on_next": on_next,
+    "on_add_favourite": on_add_favourite,
+    "on_show_favorites": on_show_favorites,
+    "on_more_favorites": on_more_favorites,
+    "on_clear_favorites": on_clear_favorites,
+})
+
+
+async def handle_message(user_id, msg):
+    """
+    Обработка одного входящего сообщения пользователя.
+    """
+    session = await sessions.get(user_id)
+    try:
+        await machine.dispatch(session, msg)
+    finally:
+        await sessions.save(session)
+        await seen_profiles.save(user_id)
+
+
+def register_gauges(dispatcher):
+    """
+    Размеры очередей и кэшей, которые считываются при каждой выгрузке метрик.
+    """
+    gauges = {
+        "vkinder_outbox_depth": ("Сообщения в очереди на отправку", lambda: len(outbox)),
+        "vkinder_dispatcher_pending": (
+            "Входящие сообщения, ожидающие обработки",
+            lambda: sum(queue.qsize() for queue in list(dispatcher.queues.values()))
+        ),
+        "vkinder_dispatcher_active_users": ("Пользователи с активным обработчиком", lambda: len(dispatcher.workers)),
+        "vkinder_attachment_cache_size": ("Записи в кэше вложений", lambda: len(attachments_cache.entries)),
+        "vkinder_search_cache_size": ("Страницы в кэше поиска", lambda: len(search_cache.entries)),
+        "vkinder_seen_filters": ("Фильтры просмотренных анкет в памяти", lambda: len(seen_profiles.filters)),
+        "vkinder_seen_filters_bytes": (
+            "Память фильтров просмотренных анкет",
+            lambda: sum(seen.nbytes for seen in list(seen_profiles.filters.values()))
+        ),
+    }
+    user_session = get_vk_session()
+    if isinstance(user_session, VkClientPool):
+        gauges["vkinder_user_tokens_available"] = ("Токены пользователя вне карантина", user_session.available)
+    for name, (documentation, function) in gauges.items():
+        metrics.REGISTRY.gauge(name, documentation, function=function)
+
+
+async def receive_events(dispatcher, vk_session):
+    """
+    Прием входящих сообщений через Callback API или Long Poll и передача их диспетчеру.
+    """
+    if bot_mode == "callback":
+        await serve_callback(
+            dispatcher,
+            host=os.getenv("CALLBACK_HOST", "0.0.0.0"),
+            port=int(os.getenv("CALLBACK_PORT", "8080")),
+            confirmation_code=os.getenv("CALLBACK_CONFIRMATION", ""),
+            secret=os.getenv("CALLBACK_SECRET") or None,
+            group_id=int(os.getenv("GROUP_ID") or 0) or None
+        )
+    else:
+        await listen_longpoll(VkLongPoll(vk_session), dispatcher)
+
+
+async def run_bot(timer=None, events=None, worker_index=0, worker_count=1):
+    """
+    Работа бота в одном процессе. Если передан канал events, бот работает
+    обработчиком супервизора и получает сообщения из него.
+    """
+    timer = timer or StartupTimer()
+    await bootstrap(timer, worker_count)
+    dispatcher = UserDispatcher(handle_message, max_workers=int(os.getenv("MAX_WORKERS", "100")))
+    register_gauges(dispatcher)
+    metrics.tracing_enabled = os.getenv("TRACE_SPANS", "") == "1"
+    if os.getenv("METRICS_PORT"):
+        # Порт METRICS_PORT занимает супервизор, обработчики - следующие за ним
+        port = int(os.getenv("METRICS_PORT")) + (worker_index + 1 if events is not None else 0)
+        metrics.start_metrics_server(port, os.getenv("METRICS_HOST", "127.0.0.1"))
+    timer.report()
+    background = [
+        asyncio.create_task(outbox.run()),
+        asyncio.create_task(evict_periodically(sessions)),
+        asyncio.create_task(evict_periodically(attachments_cache, interval=3600)),
+        asyncio.create_task(evict_periodically(search_cache, interval=300)),
+        asyncio.create_task(evict_periodically(seen_profiles, interval=600)),
+    ]
+    if warehouse is not None:
+        background.append(asyncio.create_task(evict_periodically(warehouse, interval=3600)))
+    try:
+        if events is not None:
+            await consume_events(events, dispatcher)
+        else:
+            await receive_events(dispatcher, authorize)
+    finally:
+        for task in background:
+            task.cancel()
+
 
+def run_worker(index, count, events):
+    """
+    Точка входа процесса-обработчика (запускается супервизором).
+    """
+    logging.info("Обработчик %s из %s запущен", index + 1, count)
+    try:
+        asyncio.run(run_bot(events=events, worker_index=index, worker_count=count))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_supervisor(workers):
+    """
+    Прием сообщений в этом процессе и их обработка в workers процессах.
+    """
+    supervisor = Supervisor(run_worker, workers)
+    supervisor.start()
+    if os.getenv("METRICS_PORT"):
+        metrics.start_metrics_server(int(os.getenv("METRICS_PORT")), os.getenv("METRICS_HOST", "127.0.0.1"))
+    loop = asyncio.get_running_loop()
+    current = asyncio.current_task()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, current.cancel)
+    watcher = asyncio.create_task(supervisor.watch())
+    try:
+        await receive_events(supervisor, create_vk_session(vk_token, vk_api_url))
+    except asyncio.CancelledError:
+        logging.info("Бот останавливается")
+    finally:
+        watcher.cancel()
+        await asyncio.to_thread(supervisor.stop)
+
+
+def main():
+    logging.info("Бот запущен")
+    workers = int(os.getenv("WORKERS", "1"))
+    if workers > 1:
+        asyncio.run(run_supervisor(workers))
+    else:
+        asyncio.run(run_bot())
+
+
+@metrics.traced("upload_photos")
 def upload_photos(user_id, photo_urls):
     """
     Загрузка фотографий на сервер VK и получение attachment.
+    Уже загруженные фотографии берутся из кэша без скачивания и повторной загрузки.
     """
-    upload = VkUpload(authorize)
-    photo_attachments = []
-
+    attachments = {}
+    missing = []
     for url in photo_urls:
-        try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                photo_data = BytesIO(response.content)
-                # Загружаем фото на сервер VK
-                photo = upload.photo_messages(photos=photo_data)[0]
-                # Формируем аттачмент
-                photo_attachments.append({
-                    "owner_id": photo['owner_id'],
-                    "id": photo['id']
-                })
-            else:
-                logging.warning(f"Не удалось загрузить фотографию по URL: {url}")
-        except Exception as e:
-            logging.error(f"Ошибка при загрузке или отправке фотографии: {e}")
-
-    return photo_attachments
+        attachment = attachments_cache.get(url)
+        if attachment is not None:
+            attachments[url] = attachment
+        else:
+            missing.append(url)
+
+    for url, attachment in photo_pipeline.upload_many(missing).items():
+        attachments_cache.put(url, attachment)
+        attachments[url] = attachment
+
+    return [attachments[url] for url in photo_urls if url in attachments]
 
 
 if __name__ == "__main__":
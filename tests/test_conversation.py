@@ -0,0 +1,152 @@
+"""
+Таблица переходов автомата диалога: основные сценарии и произвольный текст в каждом состоянии.
+
+    python -m unittest discover -s tests
+"""
+import asyncio
+import unittest
+
+from bot_runtime.conversation import (
+    AGE, CITY, CITY_CONFIRM, DATA_CONFIRM, GENDER, IDLE, MODIFY_CITY, MODIFY_CITY_CONFIRM, MODIFY_GENDER,
+    NAVIGATION, TRANSITIONS, ButtonVK, build_state_machine
+)
+from bot_runtime.sessions import Session
+
+STATES = (IDLE, CITY, CITY_CONFIRM, MODIFY_CITY, MODIFY_CITY_CONFIRM, GENDER, MODIFY_GENDER, AGE, DATA_CONFIRM,
+          NAVIGATION)
+UNKNOWN = "абракадабра"
+
+# (сообщение, вызванный обработчик, состояние после обработки)
+MAIN_PATH = (
+    (ButtonVK.begin, "on_begin", IDLE),
+    (ButtonVK.start, "on_ask_city", CITY),
+    ("Москва", "on_city_entered", CITY_CONFIRM),
+    (ButtonVK.right_city, "on_city_saved", GENDER),
+    (ButtonVK.girl, "on_gender_chosen", AGE),
+    ("25", "on_age_entered", DATA_CONFIRM),
+    (ButtonVK.all_true, "on_search", NAVIGATION),
+    (ButtonVK.next, "on_next", NAVIGATION),
+    (ButtonVK.add_favourites, "on_add_favourite", NAVIGATION),
+    (ButtonVK.all_fovourites, "on_show_favorites", NAVIGATION),
+    (ButtonVK.more_favourites, "on_more_favorites", NAVIGATION),
+    (ButtonVK.modify_city, "on_modify_city", MODIFY_CITY),
+    ("Казань", "on_city_entered", MODIFY_CITY_CONFIRM),
+    (ButtonVK.right_city, "on_city_updated", DATA_CONFIRM),
+    (ButtonVK.all_true, "on_search", NAVIGATION),
+    (ButtonVK.clear_favourites, "on_clear_favorites", NAVIGATION),
+    (ButtonVK.finish, "on_finish", NAVIGATION),
+)
+
+CHANGE_PARAMETERS_PATH = (
+    (ButtonVK.change_parameters, "on_data_modify", DATA_CONFIRM),
+    (ButtonVK.gender, "on_ask_gender", MODIFY_GENDER),
+    (ButtonVK.boy, "on_gender_updated", DATA_CONFIRM),
+    (ButtonVK.age, "on_ask_age", AGE),
+    ("30", "on_age_entered", DATA_CONFIRM),
+    (ButtonVK.city, "on_ask_city", MODIFY_CITY),
+    ("Тверь", "on_city_entered", MODIFY_CITY_CONFIRM),
+    (ButtonVK.right_city, "on_city_updated", DATA_CONFIRM),
+)
+
+# Произвольный текст: обработчик и следующее состояние, None - сообщение не подходит ни к одному переходу
+UNKNOWN_INPUT = {
+    IDLE: None,
+    CITY: ("on_city_entered", CITY_CONFIRM),
+    CITY_CONFIRM: None,
+    MODIFY_CITY: ("on_city_entered", MODIFY_CITY_CONFIRM),
+    MODIFY_CITY_CONFIRM: None,
+    GENDER: None,
+    MODIFY_GENDER: None,
+    AGE: ("on_age_entered", DATA_CONFIRM),
+    DATA_CONFIRM: None,
+    NAVIGATION: None,
+}
+
+
+class RecordingHandlers(dict):
+    """
+    Обработчики-заглушки, которые запоминают порядок вызовов и могут вернуть заданное состояние.
+    """
+
+    def __init__(self, results=None):
+        super().__init__()
+        self.calls = []
+        self.results = results or {}
+        for _, _, name, _ in TRANSITIONS:
+            self[name] = self._handler(name)
+
+    def _handler(self, name):
+        async def handler(session, msg):
+            self.calls.append(name)
+            return self.results.get(name)
+        handler.__name__ = name
+        return handler
+
+
+def dispatch(machine, session, msg):
+    return asyncio.run(machine.dispatch(session, msg))
+
+
+class TransitionTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handlers = RecordingHandlers()
+        self.machine = build_state_machine(self.handlers)
+
+    def run_path(self, session, path):
+        for msg, handler, state in path:
+            with self.subTest(state=session.flag, msg=msg):
+                self.assertTrue(dispatch(self.machine, session, msg))
+                self.assertEqual(self.handlers.calls[-1], handler)
+                self.assertEqual(session.flag, state)
+
+    def test_transitions_are_unique(self):
+        keys = [(state, label) for state, label, _, _ in TRANSITIONS]
+        self.assertEqual(len(keys), len(set(keys)))
+
+    def test_main_path(self):
+        self.run_path(Session(1), MAIN_PATH)
+
+    def test_change_parameters_path(self):
+        self.run_path(Session(1, flag=DATA_CONFIRM), CHANGE_PARAMETERS_PATH)
+
+    def test_unknown_input_in_every_state(self):
+        self.assertEqual(set(UNKNOWN_INPUT), set(STATES))
+        for state, expected in UNKNOWN_INPUT.items():
+            with self.subTest(state=state):
+                session = Session(1, flag=state)
+                calls = len(self.handlers.calls)
+                matched = dispatch(self.machine, session, UNKNOWN)
+                if expected is None:
+                    self.assertFalse(matched)
+                    self.assertEqual(len(self.handlers.calls), calls)
+                    self.assertEqual(session.flag, state)
+                else:
+                    self.assertTrue(matched)
+                    self.assertEqual((self.handlers.calls[-1], session.flag), expected)
+
+    def test_state_specific_buttons_outside_their_state(self):
+        cases = (
+            (IDLE, ButtonVK.next),
+            (IDLE, ButtonVK.add_favourites),
+            (GENDER, ButtonVK.right_city),
+            (NAVIGATION, ButtonVK.all_true),
+            (CITY_CONFIRM, ButtonVK.change_parameters),
+        )
+        for state, msg in cases:
+            with self.subTest(state=state, msg=msg):
+                session = Session(1, flag=state)
+                self.assertFalse(dispatch(self.machine, session, msg))
+                self.assertEqual(session.flag, state)
+
+    def test_handler_state_overrides_table(self):
+        # Например, город не найден: обработчик оставляет пользователя в состоянии ввода города
+        handlers = RecordingHandlers({"on_city_entered": CITY})
+        machine = build_state_machine(handlers)
+        session = Session(1, flag=CITY)
+        self.assertTrue(dispatch(machine, session, "Нетакогогорода"))
+        self.assertEqual(session.flag, CITY)
+
+
+if __name__ == "__main__":
+    unittest.main()
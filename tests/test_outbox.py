@@ -0,0 +1,153 @@
+"""
+Очередь исходящих сообщений: порядок сообщений получателю, объединение в execute и повторные отправки.
+
+    python -m unittest discover -s tests
+"""
+import asyncio
+import json
+import re
+import time
+import unittest
+
+from vk_api.exceptions import ApiError
+
+from bot_runtime.async_runtime import RateLimiter
+from bot_runtime.outbox import Outbox
+
+CALL = re.compile(r"API\.messages\.send\((\{.*?\})\)")
+
+
+class FakeVk:
+    """
+    Заглушка AsyncVkApi: запоминает вызовы и отвечает ошибками из errors.
+
+    errors - словарь {текст сообщения: список кодов ошибок}, по одной ошибке на попытку отправки.
+    """
+
+    def __init__(self, errors=None, rps=1000):
+        self.vk_session = None
+        self.limiter = RateLimiter(rps)
+        self.errors = errors or {}
+        self.calls = []
+        self.delivered = []
+
+    def _send(self, params):
+        codes = self.errors.get(params["message"])
+        if codes:
+            return False, {"error_code": codes.pop(0), "error_msg": "Too many requests per second"}
+        self.delivered.append((params["user_id"], params["message"]))
+        return True, len(self.delivered)
+
+    async def method(self, method, values, raw=False):
+        await self.limiter.acquire()
+        await asyncio.sleep(0.001)
+        if method == "messages.send":
+            self.calls.append([values])
+            ok, result = self._send(values)
+            if not ok:
+                raise ApiError(self, method, values, False, result)
+            return result
+        batch = [json.loads(call) for call in CALL.findall(values["code"])]
+        self.calls.append(batch)
+        response, errors = [], []
+        for params in batch:
+            ok, result = self._send(params)
+            response.append(result if ok else False)
+            if not ok:
+                errors.append(result)
+        return {"response": response, "execute_errors": errors}
+
+
+async def send_all(outbox, messages):
+    task = asyncio.create_task(outbox.run())
+    try:
+        return await asyncio.gather(
+            *(outbox.send({"user_id": user_id, "message": text}) for user_id, text in messages),
+            return_exceptions=True
+        )
+    finally:
+        task.cancel()
+
+
+def messages_for(users, count):
+    return [(user_id, f"{user_id}-{i}") for i in range(count) for user_id in range(users)]
+
+
+class OutboxTest(unittest.TestCase):
+
+    def test_order_per_recipient(self):
+        vk = FakeVk()
+        messages = messages_for(users=5, count=10)
+        results = asyncio.run(send_all(Outbox(vk, backoff=0.01), messages))
+        self.assertFalse([result for result in results if isinstance(result, Exception)])
+        for user_id in range(5):
+            with self.subTest(user_id=user_id):
+                sent = [text for peer, text in vk.delivered if peer == user_id]
+                self.assertEqual(sent, [f"{user_id}-{i}" for i in range(10)])
+
+    def test_batching(self):
+        vk = FakeVk()
+        asyncio.run(send_all(Outbox(vk, batch_size=25, max_in_flight=1), messages_for(users=60, count=1)))
+        self.assertEqual(len(vk.delivered), 60)
+        self.assertTrue(all(len(batch) <= 25 for batch in vk.calls))
+        self.assertLessEqual(len(vk.calls), 4)
+        # В одной пачке не бывает двух сообщений одному получателю
+        for batch in vk.calls:
+            peers = [params["user_id"] for params in batch]
+            self.assertEqual(len(peers), len(set(peers)))
+
+    def test_code_length_limit(self):
+        vk = FakeVk()
+        messages = [(user_id, f"{user_id}-" + "x" * 1000) for user_id in range(10)]
+        asyncio.run(send_all(Outbox(vk, max_in_flight=1, max_code_length=3000), messages))
+        self.assertEqual(len(vk.delivered), 10)
+        self.assertTrue(all(len(batch) <= 2 for batch in vk.calls))
+
+    def test_retry_keeps_order(self):
+        vk = FakeVk(errors={"1-0": [6, 10]})
+        results = asyncio.run(send_all(Outbox(vk, backoff=0.01), messages_for(users=3, count=3)))
+        self.assertFalse([result for result in results if isinstance(result, Exception)])
+        self.assertEqual([text for peer, text in vk.delivered if peer == 1], ["1-0", "1-1", "1-2"])
+
+    def test_retries_exhausted(self):
+        vk = FakeVk(errors={"0-0": [10] * 3, "1-0": [100]})
+        results = asyncio.run(send_all(Outbox(vk, max_retries=2, backoff=0.01), messages_for(users=2, count=2)))
+        errors = {user_id: result for (user_id, text), result in zip(messages_for(users=2, count=2), results)
+                  if text.endswith("-0")}
+        self.assertIsInstance(errors[0], ApiError)
+        self.assertEqual(errors[0].code, 10)
+        # Ошибка без повтора отклоняется сразу
+        self.assertIsInstance(errors[1], ApiError)
+        self.assertEqual(errors[1].code, 100)
+        # Следующие сообщения получателей отправляются после отклоненного
+        self.assertEqual(sorted(text for _, text in vk.delivered), ["0-1", "1-1"])
+
+    def test_too_many_requests_throttles_limiter(self):
+        vk = FakeVk(errors={"0-0": [6]}, rps=100)
+        started = time.monotonic()
+        asyncio.run(send_all(Outbox(vk, max_in_flight=1, backoff=0.2), messages_for(users=1, count=1)))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertLess(vk.limiter.rate, 100)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_throttle_pauses_and_recovers(self):
+        async def scenario():
+            limiter = RateLimiter(20, recovery=0.5)
+            limiter.throttle(0.1)
+            self.assertEqual(limiter.rate, 10)
+            # Повторные ошибки во время паузы не снижают частоту еще раз
+            limiter.throttle(0.1)
+            self.assertEqual(limiter.rate, 10)
+            started = time.monotonic()
+            await limiter.acquire()
+            self.assertGreaterEqual(time.monotonic() - started, 0.1)
+            await asyncio.sleep(0.5)
+            await limiter.acquire()
+            self.assertEqual(limiter.rate, 20)
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    unittest.main()
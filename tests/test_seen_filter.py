@@ -0,0 +1,146 @@
+"""
+Фильтр просмотренных анкет: сериализация, доля ложных срабатываний и чтение состояния из базы.
+
+    python -m unittest discover -s tests
+"""
+import struct
+import unittest
+
+from finding_users.seen_filter import HEADER_V1, LAYER_HEADER_V1, SeenFilter, SeenStore, merge_snapshot
+
+
+def probe_ids(count):
+    # id, которые в тестах никогда не добавляются в фильтр
+    return range(10 ** 9, 10 ** 9 + count)
+
+
+class SeenFilterTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for count in (0, 10, 1000, 5000):
+            with self.subTest(count=count):
+                seen = SeenFilter(initial_capacity=256, error_rate=0.01)
+                seen.merge(range(count))
+                restored = SeenFilter.from_bytes(seen.to_bytes())
+                self.assertEqual(restored.to_bytes(), seen.to_bytes())
+                self.assertEqual((restored.initial_capacity, restored.error_rate), (256, 0.01))
+                self.assertEqual(len(restored), len(seen))
+                self.assertEqual(
+                    [(layer.capacity, layer.error_rate, layer.size, layer.hash_count) for layer in restored.layers],
+                    [(layer.capacity, layer.error_rate, layer.size, layer.hash_count) for layer in seen.layers]
+                )
+                self.assertTrue(all(vk_id in restored for vk_id in range(count)))
+
+    def test_restored_filter_keeps_growing(self):
+        seen = SeenFilter(initial_capacity=64)
+        seen.merge(range(100))
+        restored = SeenFilter.from_bytes(seen.to_bytes())
+        restored.merge(range(100, 1000))
+        self.assertEqual([layer.capacity for layer in restored.layers], [64 * 2 ** i for i in range(5)])
+        self.assertTrue(all(vk_id in restored for vk_id in range(1000)))
+
+    def test_pending_is_not_serialized(self):
+        seen = SeenFilter()
+        self.assertTrue(seen.add(1))
+        self.assertFalse(seen.add(1))
+        restored = SeenFilter.from_bytes(seen.to_bytes())
+        self.assertIn(1, restored)
+        self.assertEqual(restored.pending, set())
+
+    def test_reads_format_1(self):
+        seen = SeenFilter()
+        seen.merge(range(2000))
+        parts = [HEADER_V1.pack(1, len(seen.layers))]
+        for layer in seen.layers:
+            parts.append(LAYER_HEADER_V1.pack(layer.capacity, layer.size, layer.count, layer.hash_count))
+            parts.append(bytes(layer.bits))
+        restored = SeenFilter.from_bytes(b"".join(parts))
+        self.assertEqual(len(restored), len(seen))
+        self.assertTrue(all(vk_id in restored for vk_id in range(2000)))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            SeenFilter.from_bytes(struct.pack("<BB", 99, 0))
+
+    def test_error_rate_does_not_grow_with_layers(self):
+        seen = SeenFilter(initial_capacity=256, error_rate=0.01)
+        for count in (256, 4000, 30000):
+            seen.merge(range(len(seen), count))
+            with self.subTest(count=count, layers=len(seen.layers)):
+                false_positives = sum(vk_id in seen for vk_id in probe_ids(20000))
+                self.assertLess(false_positives / 20000, 0.015)
+
+    def test_merge_snapshot(self):
+        bits = merge_snapshot(None, [1, 2])
+        bits = merge_snapshot(bits, [3])
+        seen = SeenFilter.from_bytes(bits)
+        self.assertEqual(len(seen), 3)
+        self.assertTrue(all(vk_id in seen for vk_id in (1, 2, 3)))
+
+
+class FakeSeenDb:
+    """
+    Заглушка vkinder_db: состояние фильтра в базе и запросы к нему.
+    """
+
+    def __init__(self, version=0, bits=None, log=()):
+        self.version = version
+        self.bits = bits
+        self.log = list(log)
+        self.requests = []
+
+    def select_seen_state(self, owner_id, known_version=None):
+        self.requests.append((owner_id, known_version))
+        bits = None if known_version == self.version else self.bits
+        return self.version, bits, list(self.log)
+
+
+class SeenStoreRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = SeenStore(persistent=False)
+
+    def refresh(self, db, seen=None):
+        self.store.db = db
+        return self.store._refresh(1, seen)
+
+    def test_first_read(self):
+        db = FakeSeenDb(version=3, bits=merge_snapshot(None, [1, 2]), log=[5, 6])
+        seen = self.refresh(db)
+        self.assertEqual(db.requests, [(1, None)])
+        self.assertEqual((seen.version, seen.logged), (3, 2))
+        self.assertTrue(all(vk_id in seen for vk_id in (1, 2, 5, 6)))
+        self.assertEqual(seen.pending, set())
+
+    def test_first_read_without_snapshot(self):
+        seen = self.refresh(FakeSeenDb(log=[7]))
+        self.assertIn(7, seen)
+        self.assertEqual((seen.version, seen.logged), (0, 1))
+
+    def test_same_version_merges_log(self):
+        db = FakeSeenDb(version=3, bits=merge_snapshot(None, [1]), log=[5])
+        seen = self.refresh(db)
+        seen.add(9)
+        db.log.append(6)
+        refreshed = self.refresh(db, seen)
+        self.assertIs(refreshed, seen)
+        self.assertEqual(db.requests[-1], (1, 3))
+        self.assertTrue(all(vk_id in seen for vk_id in (1, 5, 6, 9)))
+        self.assertEqual(seen.pending, {9})
+        self.assertEqual(seen.logged, 2)
+
+    def test_new_version_reloads_snapshot_and_keeps_pending(self):
+        db = FakeSeenDb(version=3, bits=merge_snapshot(None, [1]), log=[5])
+        seen = self.refresh(db)
+        seen.add(9)
+        # Другой процесс бота перенес журнал в снимок и дописал новые анкеты
+        db.version, db.bits, db.log = 4, merge_snapshot(None, [1, 5, 20]), [21]
+        refreshed = self.refresh(db, seen)
+        self.assertIsNot(refreshed, seen)
+        self.assertEqual((refreshed.version, refreshed.logged), (4, 1))
+        self.assertTrue(all(vk_id in refreshed for vk_id in (1, 5, 9, 20, 21)))
+        self.assertEqual(refreshed.pending, {9})
+
+
+if __name__ == "__main__":
+    unittest.main()
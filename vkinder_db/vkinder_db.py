@@ -1,7 +1,15 @@
+import json
 import os
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 import logging
 from dotenv import load_dotenv
+from bot_runtime.metrics import DB_QUERY_SECONDS
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -14,26 +22,164 @@ host = os.getenv("HOST")
 port = os.getenv("PORT")
 db_name = os.getenv("NAME_DB")
 
-try:
-    connection = psycopg2.connect(
-        host=host,
-        user=user,
-        password=password,
-        database=db_name,
-        port=port
-    )
-    connection.autocommit = True
-    logging.info("Успешное подключение к базе данных")
-except Exception as e:
-    logging.error(f"Ошибка подключения к базе данных: {e}")
-    raise
+pool_min = int(os.getenv("DB_POOL_MIN", "1"))
+pool_max = int(os.getenv("DB_POOL_MAX", "10"))
+# Сколько секунд ждать свободного соединения, когда все соединения пула заняты
+pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Соединение, простаивавшее дольше этого времени, проверяется перед выдачей
+health_check_interval = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))
+# Владелец избранного, сохраненного до появления owner_id (когда избранное было общим)
+legacy_owner_id = os.getenv("USER_ID")
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Курсор, который замеряет время каждого запроса (метрика vkinder_db_query_seconds).
+    """
+
+    def execute(self, query, vars=None):
+        # execute_values передает запрос в байтах
+        head = query[:64].decode(errors="replace") if isinstance(query, bytes) else query[:64]
+        words = head.split(None, 2)
+        # Для подготовленных запросов метка - имя запроса, для остальных - вид команды
+        label = words[1] if len(words) > 1 and words[0] in ("EXECUTE", "PREPARE") else words[0].lower()
+        with DB_QUERY_SECONDS.time(query=label):
+            return super().execute(query, vars)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    Соединение из пула: помнит подготовленные запросы и время последнего использования.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TimedCursor
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool не ждет свободного соединения, а сразу бросает PoolError,
+# поэтому число выданных соединений ограничивается семафором
+_pool_slots = threading.BoundedSemaphore(pool_max)
+
+
+def get_pool():
+    """
+    Пул соединений с базой данных, создается при первом обращении.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                try:
+                    _pool = psycopg2.pool.ThreadedConnectionPool(
+                        pool_min,
+                        pool_max,
+                        host=host,
+                        user=user,
+                        password=password,
+                        database=db_name,
+                        port=port,
+                        connection_factory=PooledConnection
+                    )
+                    logging.info("Успешное подключение к базе данных")
+                except Exception as e:
+                    logging.error("Ошибка подключения к базе данных: %s", e)
+                    raise
+    return _pool
+
+
+def _is_alive(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < health_check_interval:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout():
+    """
+    Соединение из пула. Если все соединения заняты, ждет освобождения
+    не дольше pool_timeout секунд.
+    """
+    pool = get_pool()
+    if not _pool_slots.acquire(timeout=pool_timeout):
+        raise psycopg2.pool.PoolError(f"Нет свободного соединения с базой данных за {pool_timeout:.0f} с")
+    try:
+        conn = pool.getconn()
+        if not conn.closed:
+            conn.autocommit = True
+        if not _is_alive(conn):
+            logging.warning("Соединение с базой данных потеряно, переподключаемся")
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+            conn.autocommit = True
+    except Exception:
+        _pool_slots.release()
+        raise
+    return conn
+
+
+def _checkin(conn, close=False):
+    conn.last_used = time.monotonic()
+    try:
+        get_pool().putconn(conn, close=close or bool(conn.closed))
+    finally:
+        _pool_slots.release()
+
+
+@contextmanager
+def get_cursor():
+    """
+    Курсор на соединении из пула. Соединение возвращается в пул после выхода из блока,
+    а оборванное соединение закрывается, чтобы пул открыл новое.
+    """
+    conn = _checkout()
+    broken = False
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        _checkin(conn, broken)
+
+
+def execute_prepared(cursor, name, query, params):
+    """
+    Выполнение подготовленного запроса. Запрос с параметрами $1, $2, ...
+    подготавливается один раз на каждом соединении пула.
+    """
+    conn = cursor.connection
+    if name not in conn.prepared:
+        cursor.execute(f"PREPARE {name} AS {query}")
+        conn.prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
 
 
 def create_table_found_users():
     """
     Создаем таблицу для найденных пользователей.
     """
-    with connection.cursor() as cursor:
+    with get_cursor() as cursor:
         cursor.execute(
             """CREATE TABLE IF NOT EXISTS found_users (
                 id SERIAL PRIMARY KEY,
@@ -52,118 +198,315 @@ def create_table_found_users():
 def create_table_favorites():
     """
     Создаем таблицу для избранных пользователей.
+    У каждого пользователя бота (owner_id) свой список избранного.
+
+    Избранное, сохраненное до появления owner_id, было общим, и его владелец неизвестен.
+    Такие записи передаются пользователю USER_ID, а если он не указан - удаляются.
     """
-    with connection.cursor() as cursor:
+    with get_cursor() as cursor:
         cursor.execute(
             """CREATE TABLE IF NOT EXISTS favorites (
                 id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES found_users(id) ON DELETE CASCADE
+                owner_id BIGINT NOT NULL,
+                user_id INTEGER REFERENCES found_users(id) ON DELETE CASCADE,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
             );"""
         )
+        cursor.execute("ALTER TABLE favorites ADD COLUMN IF NOT EXISTS owner_id BIGINT;")
+        cursor.execute("ALTER TABLE favorites ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT NOW();")
+        if legacy_owner_id:
+            cursor.execute("UPDATE favorites SET owner_id = %s WHERE owner_id IS NULL;", (int(legacy_owner_id),))
+            if cursor.rowcount:
+                logging.info("Избранное без владельца (%s) передано пользователю %s", cursor.rowcount, legacy_owner_id)
+        else:
+            cursor.execute("DELETE FROM favorites WHERE owner_id IS NULL;")
+            if cursor.rowcount:
+                logging.warning("Удалено избранное без владельца (%s): USER_ID не указан", cursor.rowcount)
+        cursor.execute("ALTER TABLE favorites ALTER COLUMN owner_id SET NOT NULL;")
+        cursor.execute("DROP INDEX IF EXISTS favorites_user_id_key;")
+        # Удаляем дубли, оставшиеся со времен, когда записи не были уникальными
+        cursor.execute(
+            """DELETE FROM favorites f
+               USING favorites d
+               WHERE f.owner_id = d.owner_id AND f.user_id = d.user_id AND f.id > d.id;"""
+        )
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS favorites_owner_user_key ON favorites (owner_id, user_id);")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS favorites_owner_created_idx ON favorites (owner_id, created_at, id);"
+        )
     logging.info("Таблица избранных пользователей была создана.")
 
 
-def select_favorites():
-    with connection.cursor() as cursor:
-        cursor.execute("SELECT user_id FROM favorites LIMIT 1")
-        columns = [desc[0] for desc in cursor.description]
-        logging.info("Columns in the 'favorites' table: %s", columns)
+def select_favorites(owner_id, limit=10, after=None):
+    """
+    Страница избранного пользователя бота, упорядоченная по времени добавления.
 
-        cursor.execute("""
-            SELECT fu.id, fu.first_name, fu.last_name, fu.city, fu.gender, fu.age, fu.top_photos
-            FROM favorites f
-            JOIN found_users fu ON f.user_id = fu.id
-        """)
+    after - ключ последней записи предыдущей страницы (created_at, id).
+    Возвращает список пользователей и ключ для следующей страницы
+    (None, если страница последняя).
+    """
+    with get_cursor() as cursor:
+        if after is None:
+            execute_prepared(
+                cursor,
+                "select_favorites_first",
+                """SELECT f.created_at, f.id, fu.vk_id, fu.first_name, fu.last_name,
+                          fu.city, fu.gender, fu.age, fu.top_photos
+                   FROM favorites f
+                   JOIN found_users fu ON f.user_id = fu.id
+                   WHERE f.owner_id = $1
+                   ORDER BY f.created_at, f.id
+                   LIMIT $2""",
+                (owner_id, limit + 1)
+            )
+        else:
+            execute_prepared(
+                cursor,
+                "select_favorites_after",
+                """SELECT f.created_at, f.id, fu.vk_id, fu.first_name, fu.last_name,
+                          fu.city, fu.gender, fu.age, fu.top_photos
+                   FROM favorites f
+                   JOIN found_users fu ON f.user_id = fu.id
+                   WHERE f.owner_id = $1 AND (f.created_at, f.id) > ($2::timestamp, $3)
+                   ORDER BY f.created_at, f.id
+                   LIMIT $4""",
+                (owner_id, after[0], after[1], limit + 1)
+            )
         rows = cursor.fetchall()
-        favorites = []
-        for row in rows:
-            user = {
-                "id": row[0],
-                "first_name": row[1],
-                "last_name": row[2],
-                "city": row[3],
-                "gender": row[4],
-                "age": row[5],
-                "top_photos": row[6]
-            }
-            favorites.append(user)
-    return favorites
+
+    favorites = []
+    for row in rows[:limit]:
+        user = {
+            "id": int(row[2]),
+            "first_name": row[3],
+            "last_name": row[4],
+            "city": row[5],
+            "gender": row[6],
+            "age": row[7],
+            "top_photos": row[8] or []
+        }
+        favorites.append(user)
+
+    next_key = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_key = (last[0].isoformat(), last[1])
+    return favorites, next_key
 
 
 def drop_tables():
     """
-    Удаление таблиц.
+    Удаление всех таблиц бота вместе с журналом миграций: следующий migrate() создаст их заново.
     """
-    with connection.cursor() as cursor:
-        cursor.execute("DROP TABLE IF EXISTS favorites CASCADE;")
-        cursor.execute("DROP TABLE IF EXISTS found_users CASCADE;")
+    with get_cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {', '.join(TABLES)}, schema_migrations CASCADE;")
     logging.info('Таблицы успешно удалены.')
 
 
-def creating_database():
-    create_table_found_users()
-    create_table_favorites()
-
-
-# Создание таблиц при запуске
-creating_database()
+def add_to_favorites(owner_id, vk_id, first_name, last_name, city, gender, age, top_photos):
+    """
+    Добавление пользователя в избранное пользователя бота owner_id одним запросом: пользователь
+    записывается в found_users (или обновляется), затем в favorites.
+    Возвращает id пользователя в found_users и признак того, что он
+    добавлен впервые, либо (None, False) при ошибке.
+    """
+    try:
+        with get_cursor() as cursor:
+            execute_prepared(
+                cursor,
+                "add_to_favorites",
+                """WITH found AS (
+                       INSERT INTO found_users (vk_id, first_name, last_name, city, gender, age, top_photos)
+                       VALUES ($2, $3, $4, $5, $6, $7, $8)
+                       ON CONFLICT (vk_id) DO UPDATE SET
+                           first_name = EXCLUDED.first_name,
+                           last_name = EXCLUDED.last_name,
+                           top_photos = EXCLUDED.top_photos
+                       RETURNING id
+                   )
+                   INSERT INTO favorites (owner_id, user_id)
+                   SELECT $1::bigint, id FROM found
+                   ON CONFLICT (owner_id, user_id) DO UPDATE SET user_id = EXCLUDED.user_id
+                   RETURNING user_id, (xmax = 0) AS inserted""",
+                (owner_id, str(vk_id), first_name, last_name, city, gender, age, top_photos)
+            )
+            user_id, inserted = cursor.fetchone()
+    except Exception as e:
+        logging.error("Ошибка при добавлении в избранное: %s", e)
+        return None, False
+    logging.info("Добавлен в избранное пользователя %s пользователь с ID %s", owner_id, user_id)
+    return user_id, inserted
 
 
-def insert_data_found_users(vk_id, first_name, last_name, city, gender, age, top_photos):
+def iter_found_users(search_key=None, batch_size=1000):
     """
-    Вставка данных в таблицу found_users.
+    Потоковое чтение found_users курсором на стороне сервера: в памяти
+    не больше batch_size строк. Если задан search_key - только анкеты этого поиска по порядку.
+    Соединение из пула занято, пока генератор не исчерпан или не закрыт.
     """
-    with connection.cursor() as cursor:
-        try:
-            # Проверка на существование пользователя
-            cursor.execute("SELECT id FROM found_users WHERE vk_id = %s", (str(vk_id),))
-            user_id = cursor.fetchone()
-            if user_id:
-                return user_id[0]
+    conn = _checkout()
+    broken = False
+    conn.autocommit = False
+    try:
+        with conn.cursor(name="iter_found_users") as cursor:
+            cursor.itersize = batch_size
+            if search_key is None:
+                cursor.execute("SELECT * FROM found_users ORDER BY id;")
             else:
-                # Вставка нового пользователя
                 cursor.execute(
-                    """
-                    INSERT INTO found_users (vk_id, first_name, last_name, city, gender, age, top_photos)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                    """,
-                    (str(vk_id), first_name, last_name, city, gender, age, top_photos)
+                    """SELECT f.* FROM found_users_positions p
+                       JOIN found_users f ON f.vk_id = p.vk_id
+                       WHERE p.search_key = %s
+                       ORDER BY p.position;""",
+                    (search_key,)
                 )
-                user_id = cursor.fetchone()
-                if user_id:
-                    return user_id[0]
-                else:
-                    logging.error("Не удалось получить user_id после вставки")
-                    return None
-        except Exception as e:
-            logging.error(f"Ошибка при вставке данных: {e}")
-            return None
+            yield from cursor
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if not broken and not conn.closed:
+            conn.rollback()
+            conn.autocommit = True
+        _checkin(conn, broken)
+
+
+def _found_user_row(user, search_parameters):
+    city = user.get("city") or {}
+    age = str(search_parameters.get("age", ""))
+    return (
+        str(user["id"]),
+        user.get("first_name", "")[:50],
+        user.get("last_name", "")[:25],
+        (city.get("title") or search_parameters.get("city") or "")[:100],
+        {1: "female", 2: "male"}.get(user.get("sex"), ""),
+        int(age) if age.isdigit() else None,
+        user.get("top_photos") or [],
+        city.get("id"),
+        json.dumps(user, ensure_ascii=False),
+    )
 
 
-def insert_data_favorites(user_id):
+def upsert_found_users_page(search_key, search_parameters, offset, count, users, total):
     """
-    Вставка данных в таблицу favorites.
+    Запись страницы поиска в found_users одним запросом (execute_values с ON CONFLICT),
+    позиций анкет в поиске - в found_users_positions, и отметка о том, что страницы
+    поиска до offset + count уже в базе.
     """
-    with connection.cursor() as cursor:
-        cursor.execute(
-            """INSERT INTO favorites (user_id)
-               VALUES (%s)
-               ON CONFLICT DO NOTHING;""",
-            (user_id,)
+    rows = {}
+    positions = []
+    for position, user in enumerate(users, start=offset):
+        # В одном INSERT ... ON CONFLICT строка не может обновляться дважды
+        rows[user["id"]] = _found_user_row(user, search_parameters)
+        positions.append((search_key, position, str(user["id"])))
+    with get_cursor() as cursor:
+        # Одна транзакция: NOW() у анкет и у отметки о поиске совпадает
+        cursor.execute("BEGIN")
+        try:
+            # Поиск с offset 0 начинает новый снимок, следующие страницы продолжают его по порядку
+            execute_prepared(
+                cursor,
+                "upsert_found_users_search",
+                """INSERT INTO found_users_searches (search_key, total, fetched_until, started_at)
+                   VALUES ($1, $2, CASE WHEN $3 = 0 THEN $4 ELSE 0 END, NOW())
+                   ON CONFLICT (search_key) DO UPDATE SET
+                       total = EXCLUDED.total,
+                       fetched_until = CASE
+                           WHEN $3 = 0 OR $3 = found_users_searches.fetched_until THEN $3 + $4
+                           ELSE found_users_searches.fetched_until
+                       END,
+                       started_at = CASE WHEN $3 = 0 THEN NOW() ELSE found_users_searches.started_at END""",
+                (search_key, total, offset, count)
+            )
+            if offset == 0:
+                cursor.execute("DELETE FROM found_users_positions WHERE search_key = %s;", (search_key,))
+            psycopg2.extras.execute_values(
+                cursor,
+                """INSERT INTO found_users (vk_id, first_name, last_name, city, gender, age, top_photos,
+                                            city_id, profile, fetched_at)
+                   VALUES %s
+                   ON CONFLICT (vk_id) DO UPDATE SET
+                       first_name = EXCLUDED.first_name,
+                       last_name = EXCLUDED.last_name,
+                       city = EXCLUDED.city,
+                       gender = EXCLUDED.gender,
+                       age = EXCLUDED.age,
+                       top_photos = EXCLUDED.top_photos,
+                       city_id = EXCLUDED.city_id,
+                       profile = EXCLUDED.profile,
+                       fetched_at = EXCLUDED.fetched_at""",
+                list(rows.values()),
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())",
+                page_size=1000
+            )
+            # Одна анкета может быть в нескольких поисках: позиции хранятся отдельно для каждого поиска
+            psycopg2.extras.execute_values(
+                cursor,
+                """INSERT INTO found_users_positions (search_key, position, vk_id, fetched_at)
+                   VALUES %s
+                   ON CONFLICT (search_key, position) DO UPDATE SET
+                       vk_id = EXCLUDED.vk_id,
+                       fetched_at = EXCLUDED.fetched_at""",
+                positions,
+                template="(%s, %s, %s, NOW())",
+                page_size=1000
+            )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+
+def select_found_users_page(search_key, offset, count, ttl):
+    """
+    Страница поиска из found_users, если она целиком записана в свежем снимке поиска.
+    Возвращает (users, total) или None.
+    """
+    with get_cursor() as cursor:
+        execute_prepared(
+            cursor,
+            "select_found_users_page",
+            """SELECT s.total, f.profile
+               FROM found_users_searches s
+               LEFT JOIN found_users_positions p
+                   ON p.search_key = s.search_key
+                   AND p.position >= $2 AND p.position < $2 + $3
+                   AND p.fetched_at >= s.started_at
+               LEFT JOIN found_users f ON f.vk_id = p.vk_id
+               WHERE s.search_key = $1
+                   AND s.started_at > NOW() - make_interval(secs => $4)
+                   AND s.fetched_until >= $2 + $3
+               ORDER BY p.position""",
+            (search_key, offset, count, ttl)
         )
-        logging.info(f"Добавлен в избранное пользователь с ID {user_id}")
+        rows = cursor.fetchall()
+    if not rows:
+        return None
+    users, total = [profile for _, profile in rows if profile is not None], rows[0][0]
+    # Пустая страница внутри результатов поиска - анкеты удалены из базы, страницу нужно загрузить заново
+    if not users and total > offset:
+        return None
+    return users, total
 
 
-def select_found_users():
+def trim_found_users(retention):
     """
-    Выборка всех пользователей из found_users.
+    Удаление анкет, которые не обновлялись дольше retention секунд и не добавлены в избранное.
+    Возвращает количество удаленных анкет.
     """
-    with connection.cursor() as cursor:
-        cursor.execute("SELECT * FROM found_users;")
-        users = cursor.fetchall()
-        logging.info(f"Выбраны все найденные пользователи, всего {len(users)}")
-        return users
+    with get_cursor() as cursor:
+        cursor.execute(
+            """DELETE FROM found_users_searches
+               WHERE started_at < NOW() - make_interval(secs => %s);""",
+            (retention,)
+        )
+        cursor.execute(
+            """DELETE FROM found_users f
+               WHERE f.fetched_at < NOW() - make_interval(secs => %s)
+                   AND NOT EXISTS (SELECT 1 FROM favorites WHERE user_id = f.id);""",
+            (retention,)
+        )
+        return cursor.rowcount
 
 
 def get_next_user(found_users, current_index):
@@ -173,15 +516,412 @@ def get_next_user(found_users, current_index):
     if found_users:
         next_index = (current_index + 1) % len(found_users)
         next_user = found_users[next_index]
-        logging.info(f"Следующий пользователь с индексом {next_index}")
+        logging.info("Следующий пользователь с индексом %s", next_index)
         return next_user, next_index
     logging.info("Список пользователей пуст")
     return None, current_index
 
 
-def clear_favorites():
+def create_table_sessions():
+    """
+    Создаем таблицу для сессий диалогов с пользователями.
+    """
+    with get_cursor() as cursor:
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS bot_sessions (
+                user_id BIGINT PRIMARY KEY,
+                data JSONB NOT NULL,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                locked_by VARCHAR(64),
+                locked_until TIMESTAMP
+            );"""
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS bot_sessions_updated_at_idx ON bot_sessions (updated_at);")
+    logging.info("Таблица сессий была создана.")
+
+
+def lock_session(user_id, owner, lease, ttl):
+    """
+    Захват сессии пользователя процессом owner на lease секунд и ее выборка одним запросом.
+    Возвращает (True, data) - data равно None, если сессии нет или она устарела, -
+    или (False, None), если сессию держит другой процесс бота.
+    """
+    with get_cursor() as cursor:
+        execute_prepared(
+            cursor,
+            "lock_session",
+            """INSERT INTO bot_sessions (user_id, data, updated_at, locked_by, locked_until)
+               VALUES ($1, '{}', 'epoch', $2, NOW() + make_interval(secs => $3))
+               ON CONFLICT (user_id) DO UPDATE SET
+                   locked_by = EXCLUDED.locked_by,
+                   locked_until = EXCLUDED.locked_until
+               WHERE bot_sessions.locked_until IS NULL
+                   OR bot_sessions.locked_until < NOW()
+                   OR bot_sessions.locked_by = EXCLUDED.locked_by
+               RETURNING CASE WHEN updated_at > NOW() - make_interval(secs => $4) THEN data END""",
+            (user_id, owner, lease, ttl)
+        )
+        row = cursor.fetchone()
+    return (True, row[0]) if row else (False, None)
+
+
+def save_session(user_id, data, owner):
+    """
+    Сохранение сессии и снятие блокировки. Возвращает False, если блокировка
+    процесса owner истекла и сессию захватил другой процесс бота.
+    """
+    with get_cursor() as cursor:
+        execute_prepared(
+            cursor,
+            "save_session",
+            """UPDATE bot_sessions
+               SET data = $2, updated_at = NOW(), locked_by = NULL, locked_until = NULL
+               WHERE user_id = $1 AND locked_by = $3""",
+            (user_id, data, owner)
+        )
+        return cursor.rowcount == 1
+
+
+def delete_session(user_id):
+    with get_cursor() as cursor:
+        cursor.execute("DELETE FROM bot_sessions WHERE user_id = %s;", (user_id,))
+
+
+def delete_expired_sessions(ttl):
+    """
+    Удаление устаревших сессий. Возвращает количество удаленных строк.
+    """
+    with get_cursor() as cursor:
+        cursor.execute(
+            """DELETE FROM bot_sessions
+               WHERE updated_at < NOW() - make_interval(secs => %s)
+                   AND (locked_until IS NULL OR locked_until < NOW());""",
+            (ttl,)
+        )
+        return cursor.rowcount
+
+
+def create_table_photo_attachments():
+    """
+    Создаем таблицу для кэша загруженных в VK фотографий.
+    """
+    with get_cursor() as cursor:
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS photo_attachments (
+                url_hash CHAR(40) PRIMARY KEY,
+                url TEXT NOT NULL,
+                attachment VARCHAR(64) NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );"""
+        )
+    logging.info("Таблица кэша вложений была создана.")
+
+
+def select_photo_attachment(url_hash, ttl):
+    """
+    Выборка вложения по хэшу URL, если запись не устарела.
+    """
+    with get_cursor() as cursor:
+        execute_prepared(
+            cursor,
+            "select_photo_attachment",
+            """SELECT attachment FROM photo_attachments
+               WHERE url_hash = $1 AND created_at > NOW() - make_interval(secs => $2)""",
+            (url_hash, ttl)
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def upsert_photo_attachment(url_hash, url, attachment):
+    with get_cursor() as cursor:
+        execute_prepared(
+            cursor,
+            "upsert_photo_attachment",
+            """INSERT INTO photo_attachments (url_hash, url, attachment, created_at)
+               VALUES ($1, $2, $3, NOW())
+               ON CONFLICT (url_hash) DO UPDATE
+               SET attachment = EXCLUDED.attachment, created_at = EXCLUDED.created_at""",
+            (url_hash, url, attachment)
+        )
+
+
+def delete_photo_attachment(url_hash):
+    with get_cursor() as cursor:
+        cursor.execute("DELETE FROM photo_attachments WHERE url_hash = %s;", (url_hash,))
+
+
+def delete_expired_photo_attachments(ttl):
+    """
+    Удаление устаревших записей кэша вложений.
+    """
+    with get_cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM photo_attachments WHERE created_at < NOW() - make_interval(secs => %s);",
+            (ttl,)
+        )
+        return cursor.rowcount
+
+
+def create_table_search_cache():
+    """
+    Создаем таблицу для кэша страниц поиска.
+    """
+    with get_cursor() as cursor:
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS search_cache (
+                cache_key VARCHAR(200) PRIMARY KEY,
+                users JSONB NOT NULL,
+                total INTEGER NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );"""
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS search_cache_created_at_idx ON search_cache (created_at);")
+    logging.info("Таблица кэша поиска была создана.")
+
+
+def select_search_page(cache_key, ttl):
+    """
+    Выборка страницы поиска из кэша, если она не устарела.
+    """
+    with get_cursor() as cursor:
+        execute_prepared(
+            cursor,
+            "select_search_page",
+            """SELECT users, total FROM search_cache
+               WHERE cache_key = $1 AND created_at > NOW() - make_interval(secs => $2)""",
+            (cache_key, ttl)
+        )
+        row = cursor.fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def upsert_search_page(cache_key, users, total):
+    with get_cursor() as cursor:
+        execute_prepared(
+            cursor,
+            "upsert_search_page",
+            """INSERT INTO search_cache (cache_key, users, total, created_at)
+               VALUES ($1, $2, $3, NOW())
+               ON CONFLICT (cache_key) DO UPDATE
+               SET users = EXCLUDED.users, total = EXCLUDED.total, created_at = EXCLUDED.created_at""",
+            (cache_key, users, total)
+        )
+
+
+def trim_search_cache(ttl, max_rows):
+    """
+    Удаление устаревших страниц поиска и самых старых страниц сверх max_rows.
+    Возвращает количество удаленных строк.
+    """
+    with get_cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM search_cache WHERE created_at < NOW() - make_interval(secs => %s);",
+            (ttl,)
+        )
+        deleted = cursor.rowcount
+        cursor.execute(
+            """DELETE FROM search_cache
+               WHERE cache_key IN (
+                   SELECT cache_key FROM search_cache
+                   ORDER BY created_at DESC
+                   OFFSET %s
+               );""",
+            (max_rows,)
+        )
+        return deleted + cursor.rowcount
+
+
+def create_table_seen_profiles():
+    """
+    Создаем таблицы для фильтров уже показанных анкет: снимок фильтра с версией
+    и журнал новых анкет. Процессы бота дописывают в журнал только новые id,
+    а не перезаписывают фильтр целиком.
+    """
+    with get_cursor() as cursor:
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS seen_profiles (
+                owner_id BIGINT PRIMARY KEY,
+                bits BYTEA NOT NULL,
+                version BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );"""
+        )
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS seen_profiles_log (
+                owner_id BIGINT NOT NULL,
+                vk_id BIGINT NOT NULL,
+                PRIMARY KEY (owner_id, vk_id)
+            );"""
+        )
+    logging.info("Таблицы просмотренных анкет были созданы.")
+
+
+def select_seen_state(owner_id, known_version=None):
+    """
+    Состояние фильтра просмотренных анкет пользователя бота: версия снимка,
+    сам снимок (None, если его нет или версия совпадает с known_version)
+    и id анкет из журнала, еще не вошедшие в снимок.
+    """
+    with get_cursor() as cursor:
+        execute_prepared(
+            cursor,
+            "select_seen_snapshot",
+            """SELECT version, CASE WHEN version IS DISTINCT FROM $2 THEN bits END
+               FROM seen_profiles WHERE owner_id = $1""",
+            (owner_id, known_version)
+        )
+        row = cursor.fetchone()
+        execute_prepared(
+            cursor,
+            "select_seen_log",
+            "SELECT vk_id FROM seen_profiles_log WHERE owner_id = $1",
+            (owner_id,)
+        )
+        vk_ids = [vk_id for vk_id, in cursor.fetchall()]
+    if row is None:
+        return 0, None, vk_ids
+    return row[0], bytes(row[1]) if row[1] is not None else None, vk_ids
+
+
+def append_seen_ids(owner_id, vk_ids):
+    """
+    Запись в журнал новых показанных анкет одним запросом.
+    """
+    with get_cursor() as cursor:
+        psycopg2.extras.execute_values(
+            cursor,
+            """INSERT INTO seen_profiles_log (owner_id, vk_id) VALUES %s
+               ON CONFLICT (owner_id, vk_id) DO NOTHING""",
+            [(owner_id, vk_id) for vk_id in vk_ids]
+        )
+
+
+def compact_seen_filter(owner_id, merge):
+    """
+    Перенос журнала в снимок фильтра под блокировкой строки: merge(bits, vk_ids)
+    возвращает новый снимок. Перенесенные записи журнала удаляются, версия снимка растет.
+    Возвращает новую версию.
+    """
+    with get_cursor() as cursor:
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute(
+                """INSERT INTO seen_profiles (owner_id, bits, version) VALUES (%s, '', 0)
+                   ON CONFLICT (owner_id) DO NOTHING;""",
+                (owner_id,)
+            )
+            cursor.execute("SELECT bits, version FROM seen_profiles WHERE owner_id = %s FOR UPDATE;", (owner_id,))
+            bits, version = cursor.fetchone()
+            cursor.execute("SELECT vk_id FROM seen_profiles_log WHERE owner_id = %s;", (owner_id,))
+            vk_ids = [vk_id for vk_id, in cursor.fetchall()]
+            cursor.execute(
+                """UPDATE seen_profiles SET bits = %s, version = version + 1, updated_at = NOW()
+                   WHERE owner_id = %s;""",
+                (psycopg2.Binary(merge(bytes(bits) or None, vk_ids)), owner_id)
+            )
+            cursor.execute(
+                "DELETE FROM seen_profiles_log WHERE owner_id = %s AND vk_id = ANY(%s);", (owner_id, vk_ids)
+            )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    return version + 1
+
+
+def create_found_users_warehouse():
+    """
+    Колонки found_users для хранения результатов поиска, таблица снимков поиска
+    и позиции анкет в снимках (одна анкета может входить в несколько поисков).
+    """
+    with get_cursor() as cursor:
+        cursor.execute(
+            """ALTER TABLE found_users
+                   ADD COLUMN IF NOT EXISTS city_id INTEGER,
+                   ADD COLUMN IF NOT EXISTS profile JSONB,
+                   ADD COLUMN IF NOT EXISTS fetched_at TIMESTAMP;"""
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS found_users_fetched_at_idx ON found_users (fetched_at);")
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS found_users_searches (
+                search_key VARCHAR(200) PRIMARY KEY,
+                total INTEGER NOT NULL,
+                fetched_until INTEGER NOT NULL,
+                started_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );"""
+        )
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS found_users_positions (
+                search_key VARCHAR(200) NOT NULL REFERENCES found_users_searches(search_key) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                vk_id VARCHAR(20) NOT NULL REFERENCES found_users(vk_id) ON DELETE CASCADE,
+                fetched_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (search_key, position)
+            );"""
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS found_users_positions_vk_id_idx ON found_users_positions (vk_id);")
+    logging.info("Таблица найденных пользователей подготовлена для хранения результатов поиска.")
+
+
+def clear_favorites(owner_id):
+    """
+    Очистка избранного одного пользователя бота.
+    """
     try:
-        with connection.cursor() as cursor:
-            cursor.execute("DELETE FROM favorites")
+        with get_cursor() as cursor:
+            cursor.execute("DELETE FROM favorites WHERE owner_id = %s", (owner_id,))
     except Exception as e:
-        logging.error(f"Ошибка при очистке избранного: {e}")
+        logging.error("Ошибка при очистке избранного: %s", e)
+
+
+# Версии схемы базы данных. Каждый шаг выполняется один раз и записывается в schema_migrations.
+# Шаги написаны так, что их можно применить и к базе, созданной до появления миграций.
+MIGRATIONS = (
+    (1, "found_users", create_table_found_users),
+    (2, "favorites", create_table_favorites),
+    (3, "bot_sessions", create_table_sessions),
+    (4, "photo_attachments", create_table_photo_attachments),
+    (5, "search_cache", create_table_search_cache),
+    (6, "seen_profiles", create_table_seen_profiles),
+    (7, "found_users_warehouse", create_found_users_warehouse),
+)
+# Таблицы, которые создают миграции (для drop_tables)
+TABLES = (
+    "favorites", "found_users_positions", "found_users_searches", "found_users", "bot_sessions",
+    "photo_attachments", "search_cache", "seen_profiles", "seen_profiles_log",
+)
+# Ключ блокировки, чтобы несколько процессов бота не применяли миграции одновременно
+MIGRATION_LOCK_ID = 746_133_581
+
+
+def migrate(migrations=MIGRATIONS):
+    """
+    Применение недостающих миграций. Возвращает список примененных версий.
+    """
+    with get_cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+        try:
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(100) NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );"""
+            )
+            cursor.execute("SELECT version FROM schema_migrations;")
+            applied = {row[0] for row in cursor.fetchall()}
+
+            new_versions = []
+            for version, name, step in migrations:
+                if version in applied:
+                    continue
+                step()
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name)
+                )
+                logging.info("Применена миграция %s: %s", version, name)
+                new_versions.append(version)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+    return new_versions